@@ -2,12 +2,12 @@ import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
 from skimage import io
-import tifffile
+import storage
 from matplotlib.widgets import RectangleSelector
 
 # Load the image
 image_path = 'images\\thorlabs\\10_thorlabs_demos.tif'
-tif = tifffile.imread(image_path)
+tif = storage.read_tiff(image_path)
 image = tif[:, :, :]
 print(f"Shape of tiff after demosaicing:{image.shape}")
 
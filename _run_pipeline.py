@@ -34,6 +34,8 @@ create.distance_cb = dist_cb
 create.manual_imaging = manual
 create.thorlabs_image_folder = os.path.join(save_path, 'thorlabs')
 create.cubert_image_folder = os.path.join(save_path, 'cubert')
+create.manifest_path = os.path.join(save_path, 'manifest.jsonl')
+create.metrics_path = os.path.join(save_path, 'metrics.jsonl')
 create.main()
 
 # Open Paired Image Viewer
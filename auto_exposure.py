@@ -0,0 +1,139 @@
+import os
+import re
+
+import numpy as np
+
+## Parameters
+histogram_stride = 7      # subsampling of the spatial axes, odd so every polarization channel is sampled
+band_stride = 4           # subsampling of the Cubert bands
+target_percentile = 99.5  # this percentile of the counts ...
+target_level = 0.75       # ... should sit at this fraction of full scale
+tolerance = 0.15          # relative deviation of the percentile that is left alone
+max_step = 4.0            # max. exposure factor per adjustment
+saturation_level = 0.98   # fraction of full scale that counts as saturated
+max_counts_tl = 4095      # 12 bit sensors
+max_counts_cb = 4095
+
+
+## histogram based auto exposure of one camera
+# observe() looks at a strided subsample of every capture and picks the exposure of the next one, so
+# the target percentile lands at target_level of full scale. Exposures are restricted to a ladder
+# (e.g. the exposures with a master dark) when one is given. get_fn(handle) / set_fn(handle, ms) read and
+# write the exposure of the camera handle, apply() is called before every capture, so a reopened camera
+# gets the current exposure back.
+class AutoExposure:
+    def __init__(self, name, exposure, max_counts, get_fn, set_fn, ladder=None, limits=(1, 10000), spatial_axes=(-2, -1)):
+        self.name = name
+        self.max_counts = max_counts
+        self.get_fn = get_fn
+        self.set_fn = set_fn
+        self.ladder = None if not ladder else np.array(sorted(ladder), dtype=float)
+        self.limits = limits
+        self.spatial_axes = spatial_axes
+        self.exposure = self._snap(exposure)
+        self.history = []
+
+    # set the exposure on the camera if it differs, returns True if it was changed
+    def apply(self, handle):
+        if np.isclose(self.get_fn(handle), self.exposure):
+            return False
+        self.set_fn(handle, self.exposure)
+        return True
+
+    # histogram statistics of a capture and the exposure for the next one
+    def observe(self, frame):
+        sample = subsample(frame, self.spatial_axes)
+        p, saturated = histogram_stats(sample, self.max_counts)
+        exposure = self.exposure
+        if saturated > 1 - target_percentile / 100:
+            # the percentile is clipped, the real level is unknown
+            factor = 1 / max_step
+        else:
+            factor = target_level * self.max_counts / max(p, 1)
+            if abs(factor - 1) < tolerance:
+                factor = 1
+        self.exposure = self._snap(exposure * min(max(factor, 1 / max_step), max_step))
+        self.history.append((exposure, p, saturated))
+        if self.exposure != exposure:
+            print(f"{self.name}: p{target_percentile} at {p / self.max_counts * 100:.0f}% of full scale, {saturated * 100:.2f}% saturated -> exposure {exposure:g} ms -> {self.exposure:g} ms.")
+        return self.exposure
+
+    def _snap(self, exposure):
+        exposure = min(max(exposure, self.limits[0]), self.limits[1])
+        if self.ladder is None:
+            return exposure
+        return float(self.ladder[np.argmin(np.abs(np.log(self.ladder / exposure)))])
+
+
+## strided view of a frame (2D) or cube, the bands (all other axes) are subsampled by band_stride
+def subsample(frame, spatial_axes=(-2, -1)):
+    index = [slice(None, None, band_stride)] * frame.ndim
+    for axis in spatial_axes:
+        index[axis] = slice(None, None, histogram_stride)
+    return frame[tuple(index)]
+
+
+## target percentile and saturated fraction of a sample, from an integer histogram
+def histogram_stats(sample, max_counts):
+    counts = np.clip(sample, 0, max_counts).astype(np.int64, copy=False).ravel()
+    hist = np.bincount(counts, minlength=max_counts + 1)
+    cumulative = np.cumsum(hist)
+    p = int(np.searchsorted(cumulative, cumulative[-1] * target_percentile / 100))
+    saturated = cumulative[-1] - cumulative[int(saturation_level * max_counts) - 1]
+    return p, saturated / cumulative[-1]
+
+
+## bitmask of saturated pixels (any band for cubes), packed 8 pixels per byte along the last axis
+def saturation_mask(frame, max_counts, band_axis=None):
+    mask = frame >= saturation_level * max_counts
+    if band_axis is not None:
+        mask = mask.any(axis=band_axis)
+    return np.packbits(mask, axis=-1), mask.shape
+
+
+## save a packed saturation mask next to the image
+def save_saturation_mask(path, packed, shape, exposure):
+    np.savez_compressed(path, mask=packed, shape=np.array(shape), exposure_ms=exposure, level=saturation_level)
+
+
+## unpacked boolean mask from a saved file
+def load_saturation_mask(path):
+    data = np.load(path)
+    shape = tuple(data["shape"])
+    return np.unpackbits(data["mask"], axis=-1, count=shape[-1]).astype(bool).reshape(shape)
+
+
+## master darks of all exposures in a folder (files <prefix><exposure>ms.npy), loaded on first use
+# transform(dark) is applied once after loading (e.g. cutting the dark to the sensor readout).
+class MasterDarks:
+    def __init__(self, folder, prefix, transform=None):
+        self.transform = transform
+        self.paths = {}
+        if os.path.isdir(folder):
+            for f in os.listdir(folder):
+                match = re.fullmatch(re.escape(prefix) + r"(\d+(?:\.\d+)?)ms\.npy", f)
+                if match:
+                    self.paths[float(match.group(1))] = os.path.join(folder, f)
+        self.loaded = {}
+
+    @property
+    def exposures(self):
+        return sorted(self.paths)
+
+    # exposure of the dark used for exposure (the nearest one available)
+    def nearest(self, exposure):
+        if len(self.paths) == 0:
+            raise FileNotFoundError("No master darks found.")
+        return min(self.paths, key=lambda e: abs(np.log(e / exposure)))
+
+    # file of the dark used for exposure
+    def path(self, exposure):
+        return self.paths[self.nearest(exposure)]
+
+    # dark of the exposure, or of the nearest one available
+    def get(self, exposure):
+        nearest = self.nearest(exposure)
+        if nearest not in self.loaded:
+            dark = np.load(self.paths[nearest])
+            self.loaded[nearest] = dark if self.transform is None else self.transform(dark)
+        return self.loaded[nearest]
@@ -0,0 +1,459 @@
+import os
+import platform
+import threading
+import time
+from collections import deque, namedtuple
+
+import numpy as np
+
+# Hardware libraries are only needed for the hardware backends
+try:
+    from pylablib.devices import Thorlabs as tl
+except ImportError:
+    tl = None
+try:
+    import cuvis
+except ImportError:
+    cuvis = None
+try:
+    import pygame
+except ImportError:
+    pygame = None
+
+## Parameters of the simulated backends
+sim_latency = 1.0            # factor on all simulated exposure and processing times (0 = as fast as possible)
+sim_failure_rate_tl = 0.0    # probability that a TL snap raises an error
+sim_failure_rate_cb = 0.0    # probability that a CB capture fails
+sim_noise_tl = 4.0           # read noise in counts
+sim_noise_cb = 6.0
+sim_dark_level_tl = 40.0     # dark offset in counts
+sim_dark_level_cb = 80.0
+sim_dark_current_tl = 10.0   # in counts/s
+sim_dark_current_cb = 30.0
+sim_signal_tl = 3000.0       # counts/s of a fully white display pixel
+sim_signal_cb = 2000.0
+sim_readout_tl = 0.03        # in s for the full sensor, scales with the ROI size
+sim_apply_time_cb = 0.15     # in s, duration of procContext.apply()
+sim_sensor_tl = (2048, 2448) # (height, width)
+sim_cube_shape = (410, 410, 106)  # (height, width, bands)
+sim_max_counts = 4095
+
+# Scene shown to the simulated cameras, changed by the display backends
+current_scene = 0
+
+# Calibration of the Cubert camera, set by open_cubert
+cubert_calibration = None
+
+
+## connect to the Thorlabs camera (serial None enumerates the cameras and opens the first one)
+def open_thorlabs(backend="hardware", serial=None):
+    if backend == "simulated":
+        return SimulatedThorlabsCamera()
+    if tl is None:
+        raise ImportError("pylablib is needed for the Thorlabs hardware backend (pip install pylablib).")
+    if serial is None:
+        tl.list_cameras_tlcam()
+    return tl.ThorlabsTLCamera(serial)
+
+
+## serial number of an open Thorlabs camera, used to reopen it without enumerating again
+def thorlabs_serial(cam):
+    try:
+        return cam.get_device_info().serial_number
+    except Exception:
+        return None
+
+
+## load the cuvis contexts and wait for the Cubert camera, returns acquisition and processing context and exporter
+def open_cubert(backend="hardware", export_dir="."):
+    if backend == "simulated":
+        return SimulatedAcquisitionContext(), SimulatedProcessingContext(), None
+    if cuvis is None:
+        raise ImportError("cuvis is needed for the Cubert hardware backend (pip install cuvis).")
+
+    # Default directories and files:
+    data_dir = None
+    lib_dir = None
+
+    if platform.system() == "Windows":
+        lib_dir = os.getenv("CUVIS")
+        data_dir = os.path.normpath(os.path.join(lib_dir, os.path.pardir, "sdk", "sample_data", "set_examples"))
+    elif platform.system() == "Linux":
+        lib_dir = os.getenv("CUVIS_DATA")
+        data_dir = os.path.normpath(os.path.join(lib_dir, "sample_data", "set_examples"))
+
+    # Default factory directory:
+    factory_dir = os.path.join(lib_dir, os.pardir, "factory")
+
+    # Default settings and output directories:
+    userSettingsDir = os.path.join(data_dir, "settings")
+
+    # Start camera
+    print("Loading user settings...")
+    settings = cuvis.General(userSettingsDir)
+    settings.set_log_level("info")
+
+    print("Loading calibration, processing, and acquisition context (factory)...")
+    calibration = cuvis.Calibration(factory_dir)
+    processingContext = cuvis.ProcessingContext(calibration)
+    acquisitionContext = cuvis.AcquisitionContext(calibration)
+
+    saveArgs = cuvis.SaveArgs(export_dir=export_dir, allow_overwrite=True, allow_session_file=True)
+    cubeExporter = cuvis.CubeExporter(saveArgs)
+
+    # Wait for camera to come online
+    while acquisitionContext.state == cuvis.HardwareState.Offline:
+        print(".", end="")
+        time.sleep(1)
+    print("\nCubert camera is online.")
+
+    acquisitionContext.operation_mode = cuvis.OperationMode.Software
+
+    # kept to reopen the acquisition context without reloading the factory calibration
+    global cubert_calibration
+    cubert_calibration = calibration
+    return acquisitionContext, processingContext, cubeExporter
+
+
+## new acquisition context from the calibration loaded by open_cubert
+def reopen_cubert(backend="hardware"):
+    if backend == "simulated":
+        return SimulatedAcquisitionContext()
+    acquisitionContext = cuvis.AcquisitionContext(cubert_calibration)
+    _wait_for_cubert(acquisitionContext)
+    acquisitionContext.operation_mode = cuvis.OperationMode.Software
+    return acquisitionContext
+
+
+## wait until the camera is online again and put it back into software trigger mode
+def rearm_cubert(backend, acquisitionContext):
+    if backend == "simulated":
+        acquisitionContext.operation_mode = "Software"
+        return
+    _wait_for_cubert(acquisitionContext)
+    acquisitionContext.operation_mode = cuvis.OperationMode.Software
+
+
+def _wait_for_cubert(acquisitionContext, timeout=60):
+    t_end = time.monotonic() + timeout
+    while acquisitionContext.state == cuvis.HardwareState.Offline:
+        if time.monotonic() > t_end:
+            raise TimeoutError("Cubert camera did not come online.")
+        time.sleep(1)
+
+
+## open the window showing the display images
+def open_display(backend="pygame", X=1920, Y=1080):
+    if backend == "headless":
+        return HeadlessDisplay(X, Y)
+    return PygameDisplay(X, Y)
+
+
+## fullscreen pygame window on the second monitor
+class PygameDisplay:
+    def __init__(self, X, Y):
+        pygame.init()
+        try:
+            self.scrn = pygame.display.set_mode((X, Y), pygame.FULLSCREEN, display=1) # show on second monitor
+        except:
+            print("No second monitor available, using main monitor.")
+            self.scrn = pygame.display.set_mode((X, Y), pygame.FULLSCREEN)
+
+    # show the image and return the monotonic time of the flip
+    def show(self, img_data, img_rect, img_name):
+        global current_scene
+        self.scrn.blit(img_data, img_rect) # image data, image center
+        pygame.display.flip()
+        flip_time = time.monotonic()
+        pygame.display.set_caption(img_name) # image name
+        current_scene += 1
+        return flip_time
+
+    def wait(self, ms):
+        pygame.time.wait(ms)
+
+    # True if the window was closed or a key was pressed
+    def quit_requested(self):
+        return any(e.type == pygame.QUIT or e.type == pygame.KEYDOWN for e in pygame.event.get())
+
+    def close(self):
+        pygame.quit()
+
+
+## stand-in for the pygame window, only switches the scene of the simulated cameras
+class HeadlessDisplay:
+    def __init__(self, X, Y):
+        self.size = (X, Y)
+        self.shown = []
+
+    def show(self, img_data, img_rect, img_name):
+        global current_scene
+        current_scene += 1
+        self.shown.append(img_name)
+        return time.monotonic()
+
+    def wait(self, ms):
+        time.sleep(ms * 1e-3)
+
+    def quit_requested(self):
+        return False
+
+    def close(self):
+        pass
+
+
+def _sleep(seconds):
+    if sim_latency > 0 and seconds > 0:
+        time.sleep(seconds * sim_latency)
+
+
+# fixed pattern noise of the simulated sensors, the same in every run
+def _fixed_pattern(shape, seed):
+    return np.random.default_rng(seed).normal(0, 2.0, shape).astype(np.float32)
+
+
+## random read noise, cut out of a pregenerated bank at a random offset (generating it per frame is slow)
+class _NoiseBank:
+    def __init__(self, size):
+        self.rng = np.random.default_rng()
+        self.bank = self.rng.standard_normal(2 * size, dtype=np.float32)
+
+    def add_to(self, frame, std):
+        offset = self.rng.integers(0, self.bank.size - frame.size)
+        frame += self.bank[offset:offset + frame.size].reshape(frame.shape) * std
+        return frame
+
+
+# add noise, round and convert to 12-bit counts
+def _to_counts(frame, noise, std):
+    noise.add_to(frame, std)
+    np.rint(frame, out=frame)
+    np.clip(frame, 0, sim_max_counts, out=frame)
+    return frame.astype(np.uint16)
+
+
+## smooth test scene in [0, 1] for the given scene number
+def _scene(scene, y, x):
+    rng = np.random.default_rng(scene)
+    fy, fx = rng.uniform(2, 12, 2)
+    phase = rng.uniform(0, 2 * np.pi)
+    return (0.5 + 0.4 * np.sin(2 * np.pi * fx * x + phase) * np.cos(2 * np.pi * fy * y)).astype(np.float32)
+
+
+SimFrameInfo = namedtuple("SimFrameInfo", ["frame_index"])
+SimDeviceInfo = namedtuple("SimDeviceInfo", ["model", "name", "serial_number", "firmware_version"])
+
+
+## simulated polarization camera with the pylablib ThorlabsTLCamera interface used in this repo
+# Frames are 12-bit polarization mosaics (2x2 super pixels with 90/45 over 135/0 degrees) of a test
+# scene that changes with every displayed image, plus dark offset, dark current and read noise.
+class SimulatedThorlabsCamera:
+    def __init__(self):
+        self.exposure = 0.1
+        self.roi = (0, sim_sensor_tl[1], 0, sim_sensor_tl[0])
+        self.lens_cap = False
+        self.rng = np.random.default_rng()
+        self.fixed_pattern = _fixed_pattern(sim_sensor_tl, 1)
+        self.noise = _NoiseBank(sim_sensor_tl[0] * sim_sensor_tl[1])
+        self._signal_cache = (None, None)
+        self._acquisition = None
+
+    def set_exposure(self, exposure):
+        self.exposure = exposure
+        return exposure
+
+    def get_exposure(self):
+        return self.exposure
+
+    def set_roi(self, hstart=0, hend=None, vstart=0, vend=None, hbin=1, vbin=1):
+        hend = sim_sensor_tl[1] if hend is None else hend
+        vend = sim_sensor_tl[0] if vend is None else vend
+        self.roi = (max(hstart, 0), min(hend, sim_sensor_tl[1]), max(vstart, 0), min(vend, sim_sensor_tl[0]))
+        return self.get_roi()
+
+    def get_roi(self):
+        return (*self.roi, 1, 1)
+
+    def get_roi_limits(self, hbin=1, vbin=1):
+        # (min, max, pstep, sstep, maxbin) per axis like pylablib's TAxisROILimit
+        return ((4, sim_sensor_tl[1], 4, 4, 1), (2, sim_sensor_tl[0], 2, 2, 1))
+
+    def get_device_info(self):
+        return SimDeviceInfo("CS505MUP", "Simulated camera", "SIM00001", "0")
+
+    def get_data_dimensions(self):
+        hstart, hend, vstart, vend = self.roi
+        return (vend - vstart, hend - hstart)
+
+    # noise free signal of the current scene in counts/s
+    def _signal(self):
+        key = (current_scene, self.roi, self.lens_cap)
+        if self._signal_cache[0] != key:
+            hstart, hend, vstart, vend = self.roi
+            y, x = np.ogrid[vstart:vend, hstart:hend]
+            if self.lens_cap:
+                signal = np.zeros((vend - vstart, hend - hstart), dtype=np.float32)
+            else:
+                s0 = _scene(current_scene, y / sim_sensor_tl[0], x / sim_sensor_tl[1])
+                # polarizer angle of every pixel and a partially polarized scene
+                angle = np.where(y % 2 == 0, np.where(x % 2 == 0, 90, 45), np.where(x % 2 == 0, 135, 0))
+                aop = np.deg2rad(30 * (current_scene % 6))
+                signal = s0 * (1 + 0.3 * np.cos(2 * (np.deg2rad(angle) - aop))) / 2 * sim_signal_tl
+            self._signal_cache = (key, signal.astype(np.float32))
+        return self._signal_cache[1]
+
+    def _expose(self):
+        hstart, hend, vstart, vend = self.roi
+        pixels = (hend - hstart) * (vend - vstart)
+        _sleep(self.exposure + sim_readout_tl * pixels / (sim_sensor_tl[0] * sim_sensor_tl[1]))
+        if self.rng.random() < sim_failure_rate_tl:
+            raise RuntimeError("Simulated TL camera error.")
+        frame = self._signal() * np.float32(self.exposure)
+        frame += sim_dark_level_tl + sim_dark_current_tl * self.exposure
+        frame += self.fixed_pattern[vstart:vend, hstart:hend]
+        return _to_counts(frame, self.noise, sim_noise_tl)
+
+    def snap(self):
+        return self._expose()
+
+    def grab(self, nframes=1):
+        return [self._expose() for _ in range(nframes)]
+
+    # continuous acquisition, frames are produced by a thread and kept in a buffer of nframes
+    def setup_acquisition(self, nframes=100):
+        self.buffer_size = nframes
+
+    def start_acquisition(self):
+        self.stop_acquisition()
+        self._frames = deque()
+        self._next_index = 0
+        self._cond = threading.Condition()
+        self._running = True
+        self._acquisition = threading.Thread(target=self._acquisition_loop, daemon=True)
+        self._acquisition.start()
+
+    def _acquisition_loop(self):
+        while self._running:
+            frame = self._expose()
+            with self._cond:
+                self._frames.append((self._next_index, frame))
+                if len(self._frames) > self.buffer_size:
+                    self._frames.popleft()
+                self._next_index += 1
+                self._cond.notify_all()
+
+    def stop_acquisition(self):
+        if self._acquisition is not None:
+            self._running = False
+            self._acquisition.join()
+            self._acquisition = None
+
+    def acquisition_in_progress(self):
+        return self._acquisition is not None
+
+    def wait_for_frame(self, since="lastread", nframes=1, timeout=20.0):
+        with self._cond:
+            if not self._cond.wait_for(lambda: len(self._frames) >= nframes, timeout):
+                raise TimeoutError("Simulated TL camera: timeout waiting for frame.")
+
+    def read_multiple_images(self, return_info=False):
+        with self._cond:
+            frames = list(self._frames)
+            self._frames.clear()
+        images = [frame for _, frame in frames]
+        if return_info:
+            return images, [SimFrameInfo(index) for index, _ in frames]
+        return images
+
+    def close(self):
+        self.stop_acquisition()
+
+
+## simulated Cubert measurement with the parts of the cuvis Measurement interface used in this repo
+class SimulatedImageData:
+    def __init__(self, array):
+        self.array = array
+
+
+class SimulatedMeasurement:
+    def __init__(self, cube):
+        self.name = ""
+        self.data = {"cube": SimulatedImageData(cube)}
+
+    def set_name(self, name):
+        self.name = name
+
+
+## pending simulated capture, get() waits until the exposure is done
+class SimulatedAsync:
+    def __init__(self, context, done_time, failed):
+        self.context = context
+        self.done_time = done_time
+        self.failed = failed
+
+    def get(self, timeout):
+        wait = (self.done_time - time.monotonic()) if sim_latency > 0 else 0
+        if wait > timeout.total_seconds():
+            time.sleep(timeout.total_seconds())
+            raise TimeoutError("Simulated CB camera: capture timed out.")
+        if wait > 0:
+            time.sleep(wait)
+        if self.failed:
+            return None, "Error"
+        return SimulatedMeasurement(self.context._cube()), "Ok"
+
+
+## simulated Cubert acquisition context, exposures run back to back like on the camera
+class SimulatedAcquisitionContext:
+    def __init__(self):
+        self.state = "Online"
+        self.operation_mode = "Software"
+        self.integration_time = 100  # in ms
+        self.queue_size = 1
+        self.lens_cap = False
+        self.rng = np.random.default_rng()
+        self.fixed_pattern = _fixed_pattern(sim_cube_shape, 2)
+        self.noise = _NoiseBank(int(np.prod(sim_cube_shape)))
+        self.busy_until = 0
+        self._signal_cache = (None, None)
+
+    def capture(self):
+        start = max(time.monotonic(), self.busy_until)
+        self.busy_until = start + self.integration_time * 1e-3 * sim_latency
+        return SimulatedAsync(self, self.busy_until, self.rng.random() < sim_failure_rate_cb)
+
+    # noise free cube of the current scene in counts/s: the scene modulated by a spectrum per pixel
+    def _signal(self):
+        key = (current_scene, self.lens_cap)
+        if self._signal_cache[0] != key:
+            height, width, bands = sim_cube_shape
+            if self.lens_cap:
+                signal = np.zeros(sim_cube_shape, dtype=np.float32)
+            else:
+                y, x = np.ogrid[0:height, 0:width]
+                s0 = _scene(current_scene, y / height, x / width)
+                peak = (0.2 + 0.6 * s0)[..., None] * bands
+                b = np.arange(bands, dtype=np.float32)
+                signal = s0[..., None] * np.exp(-0.5 * ((b - peak) / (0.15 * bands)) ** 2) * sim_signal_cb
+            self._signal_cache = (key, signal.astype(np.float32))
+        return self._signal_cache[1]
+
+    def _cube(self):
+        exposure = self.integration_time * 1e-3
+        cube = self._signal() * np.float32(exposure)
+        cube += sim_dark_level_cb + sim_dark_current_cb * exposure
+        cube += self.fixed_pattern
+        return _to_counts(cube, self.noise, sim_noise_cb)
+
+
+## simulated cuvis processing context
+class SimulatedProcessingContext:
+    def __init__(self):
+        self.distance = None
+
+    def calc_distance(self, distance):
+        self.distance = distance
+
+    def apply(self, mesu):
+        _sleep(sim_apply_time_cb)
+        return mesu
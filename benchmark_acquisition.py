@@ -0,0 +1,194 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import backends
+import metrics
+
+## Parameters
+n_pairs = 20
+history_path = "benchmarks/history.jsonl"
+regression_threshold = 0.1  # a drop of more than 10% pairs/h against the last comparable run is a regression
+
+
+## master dark frames from the simulated cameras, saved where the dataset scripts expect them
+def make_darks(folder, exposure_tl, exposure_cb):
+    cam = backends.SimulatedThorlabsCamera()
+    cam.lens_cap = True
+    cam.set_exposure(exposure_tl * 1e-3)
+    path_tl = os.path.join(folder, f"masterdark_tl_{exposure_tl}ms.npy")
+    np.save(path_tl, np.mean(cam.grab(3), axis=0))
+
+    acquContext = backends.SimulatedAcquisitionContext()
+    acquContext.lens_cap = True
+    acquContext.integration_time = exposure_cb
+    path_cb = os.path.join(folder, f"masterdark_cb_{exposure_cb}ms.npy")
+    np.save(path_cb, acquContext._cube().astype(float))
+    return path_tl, path_cb
+
+
+## random display images for the display flow
+def make_display_images(folder, n):
+    import pygame
+    rng = np.random.default_rng(0)
+    for i in range(n):
+        pixels = rng.integers(0, 255, (640, 360, 3), dtype=np.uint8)
+        pygame.image.save(pygame.surfarray.make_surface(pixels), os.path.join(folder, f"{i:05d}.png"))
+
+
+## point a dataset module at the simulated backends and the given storage
+def configure(module, storage, darks):
+    module.camera_backend = "simulated"
+    module.thorlabs_image_folder = os.path.join(storage, "thorlabs")
+    module.cubert_image_folder = os.path.join(storage, "cubert")
+    module.path_dark_tl, module.path_dark_cb = darks
+    module.metrics_path = os.path.join(storage, "metrics.jsonl")
+    # every benchmark run starts a new dataset run
+    module.manifest_path = os.path.join(storage, f"{module.__name__}_manifest.jsonl")
+    module.resume = False
+    if os.path.exists(module.manifest_path):
+        os.remove(module.manifest_path)
+    os.makedirs(module.thorlabs_image_folder, exist_ok=True)
+    os.makedirs(module.cubert_image_folder, exist_ok=True)
+
+
+def run_create_dataset(storage, work_dir, pairs):
+    import create_dataset
+    darks = make_darks(work_dir, create_dataset.exposure_time_tl, create_dataset.exposure_time_cb)
+    configure(create_dataset, storage, darks)
+    create_dataset.manual_imaging = False
+    create_dataset.n_images = pairs
+    create_dataset.main()
+
+
+def run_create_dataset_display(storage, work_dir, pairs):
+    import create_dataset_display
+    darks = make_darks(work_dir, create_dataset_display.exposure_time_tl, create_dataset_display.exposure_time_cb)
+    configure(create_dataset_display, storage, darks)
+    display_folder = os.path.join(work_dir, "display")
+    os.makedirs(display_folder, exist_ok=True)
+    make_display_images(display_folder, pairs)
+    create_dataset_display.display_backend = "headless"
+    create_dataset_display.display_image_folder = display_folder
+    create_dataset_display.main()
+
+
+FLOWS = {"create": run_create_dataset, "display": run_create_dataset_display}
+
+
+## run one flow and collect throughput, stage latencies and peak memory
+def run_benchmark(flow, pairs, storage=None, verbose=False):
+    metrics.reset()
+    with tempfile.TemporaryDirectory() as work_dir:
+        storage = os.path.join(work_dir, "storage") if storage is None else storage
+        output = contextlib.nullcontext() if verbose else contextlib.redirect_stdout(io.StringIO())
+        tracemalloc.start()
+        t_start = time.perf_counter()
+        with output:
+            FLOWS[flow](storage, work_dir, pairs)
+        elapsed = time.perf_counter() - t_start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        metrics.open_log(None)
+
+    # a pair counts if both cameras saved their image
+    saved = {}
+    for rec in metrics.records:
+        if "write" in rec.stages:
+            saved.setdefault(rec.img_name, set()).add(rec.camera)
+    n_saved = sum(1 for cameras in saved.values() if len(cameras) == 2)
+
+    return {
+        "flow": flow,
+        "pairs": n_saved,
+        "elapsed_s": elapsed,
+        "pairs_per_hour": n_saved / elapsed * 3600,
+        "peak_memory_mb": peak / 2**20,
+        "stages": metrics.stage_percentiles(),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+## compare with the last run of the same flow and configuration in the history
+def check_regression(result, history):
+    previous = [r for r in history if r["flow"] == result["flow"] and r["config"] == result["config"]]
+    if len(previous) == 0:
+        return None
+    last = previous[-1]
+    change = result["pairs_per_hour"] / last["pairs_per_hour"] - 1
+    return change, last
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def print_result(result):
+    print(f"\n{result['flow']}: {result['pairs']} pairs in {result['elapsed_s']:.1f} s -> {result['pairs_per_hour']:.0f} pairs/h, peak memory {result['peak_memory_mb']:.0f} MB")
+    print(f"{'stage':<16}{'n':>6}{'mean':>10}{'p50':>10}{'p90':>10}{'p99':>10}  (ms)")
+    for stage, s in result["stages"].items():
+        print(f"{stage:<16}{s['n']:>6}{s['mean']:>10.1f}{s['p50']:>10.1f}{s['p90']:>10.1f}{s['p99']:>10.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="End-to-end acquisition throughput benchmark with simulated cameras.")
+    parser.add_argument("--flow", choices=["create", "display", "both"], default="both")
+    parser.add_argument("--pairs", type=int, default=n_pairs)
+    parser.add_argument("--latency", type=float, default=backends.sim_latency, help="factor on simulated exposure/processing times (0 = CPU bound)")
+    parser.add_argument("--storage", default=None, help="folder to write to (default: temporary folder)")
+    parser.add_argument("--history", default=history_path)
+    parser.add_argument("--label", default="")
+    parser.add_argument("--no-save", action="store_true", help="do not append the result to the history")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the dataset scripts")
+    args = parser.parse_args(argv)
+
+    backends.sim_latency = args.latency
+    history = load_history(args.history)
+    regressed = False
+    for flow in (["create", "display"] if args.flow == "both" else [args.flow]):
+        result = run_benchmark(flow, args.pairs, args.storage, args.verbose)
+        result.update({
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "revision": git_revision(),
+            "label": args.label,
+            "config": {"pairs": args.pairs, "latency": args.latency, "storage": args.storage},
+        })
+        print_result(result)
+
+        comparison = check_regression(result, history)
+        if comparison is not None:
+            change, last = comparison
+            print(f"Change against {last['revision']} ({last['timestamp']}): {change * 100:+.1f}% pairs/h")
+            if change < -regression_threshold:
+                print("REGRESSION: throughput dropped by more than", f"{regression_threshold * 100:.0f}%.")
+                regressed = True
+
+        if not args.no_save:
+            os.makedirs(os.path.dirname(args.history) or ".", exist_ok=True)
+            with open(args.history, "a") as f:
+                f.write(json.dumps(result) + "\n")
+            history.append(result)
+
+    return 1 if regressed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,194 @@
+import threading
+import time
+from datetime import timedelta
+
+import backends
+
+## Parameters
+max_retries = 2           # plain retries of a failed operation before the camera is touched
+backoff_base = 0.5        # in s, wait before the first recovery stage, doubles with every further stage
+backoff_max = 30.0        # in s
+breaker_threshold = 3     # failed recovery ladders in a row after which the circuit opens
+breaker_cooldown = 120.0  # in s, the camera is not touched while the circuit is open
+background_stages = ("reopen", "reinit")  # slow stages, run in a background thread
+
+
+## raised when the camera cannot be used right now (recovery running, circuit open, or all stages failed)
+class CameraUnavailable(RuntimeError):
+    pass
+
+
+## runs camera operations and recovers the camera in stages when they fail
+# A failing operation is retried, then the camera is re-armed (acquisition restarted), reopened and
+# finally fully reinitialized, with exponential backoff between the stages. Reopen and reinit take
+# seconds, so they run in a background thread: run() raises CameraUnavailable right away (or waits,
+# with block=True) and the caller can keep the other camera busy. After breaker_threshold failed
+# ladders in a row the circuit opens and the device is left alone for breaker_cooldown seconds. A ladder
+# fails when all its stages fail or the operation still fails after the last stage that worked.
+# recovery is a list of (stage_name, fn(handle) -> handle) in escalation order.
+class CameraSupervisor:
+    def __init__(self, name, handle, recovery):
+        self.name = name
+        self.handle = handle
+        self.recovery = recovery
+        self.ladder_failures = 0
+        self.open_until = 0
+        self.recovered = threading.Event()
+        self.recovered.set()
+        self._thread = None
+        self._lock = threading.Lock()
+        # a background stage worked, the ladder only counts as successful once an operation does
+        self._background_recovered = False
+
+    # call op(handle), recovering the camera if needed, m (metrics.CaptureMetrics) counts the retries
+    # With block=True a background stage is waited for and the operation tried again, until it works or
+    # the circuit opens.
+    def run(self, op, m=None, block=False):
+        while True:
+            if block:
+                self.recovered.wait()
+            if not self.recovered.is_set():
+                raise CameraUnavailable(f"{self.name}: reconnecting in the background.")
+            if time.monotonic() < self.open_until:
+                raise CameraUnavailable(f"{self.name}: circuit open for another {self.open_until - time.monotonic():.0f} s.")
+
+            # plain retries
+            for attempt in range(max_retries + 1):
+                ok, result = self._try(op, m, f"Attempt {attempt + 1}/{max_retries + 1}")
+                if ok:
+                    return result
+            error = result
+            if self._background_recovered:
+                # the camera came back from a background stage but the operation still fails, so that
+                # ladder did not help either
+                self._background_recovered = False
+                self._ladder_failed()
+                continue
+
+            # escalate through the recovery stages
+            for level, (stage, fn) in enumerate(self.recovery):
+                if stage in background_stages:
+                    self._recover_in_background(level)
+                    if not block:
+                        raise CameraUnavailable(f"{self.name}: {stage} started in the background after {error!r}.")
+                    break
+                if not self._recover(level):
+                    continue
+                ok, result = self._try(op, m, f"After {stage}")
+                if ok:
+                    return result
+                error = result
+            else:
+                self._ladder_failed()
+                raise CameraUnavailable(f"{self.name}: all recovery stages failed, last error {error!r}.")
+
+    # one call of op, returns (True, result) or (False, error)
+    def _try(self, op, m, label):
+        try:
+            result = op(self.handle)
+        except Exception as e:
+            if m is not None:
+                m.retries += 1
+            print(f"{self.name}: Operation failed ({e!r}). {label}.")
+            return False, e
+        self.ladder_failures = 0
+        self._background_recovered = False
+        return True, result
+
+    # run one recovery stage after its backoff, True if the stage itself worked
+    def _recover(self, level):
+        stage, fn = self.recovery[level]
+        time.sleep(min(backoff_base * 2 ** level, backoff_max))
+        print(f"{self.name}: Recovery stage {stage}...")
+        try:
+            with self._lock:
+                self.handle = fn(self.handle)
+            return True
+        except Exception as e:
+            print(f"{self.name}: {stage} failed ({e!r}).")
+            return False
+
+    # run the stages from level on in a thread until one of them works
+    def _recover_in_background(self, level):
+        def recover():
+            try:
+                for next_level in range(level, len(self.recovery)):
+                    if self._recover(next_level):
+                        print(f"{self.name}: Camera is back after {self.recovery[next_level][0]}.")
+                        self._background_recovered = True
+                        return
+                self._ladder_failed()
+            finally:
+                self.recovered.set()
+
+        self.recovered.clear()
+        self._thread = threading.Thread(target=recover, name=f"{self.name}-recovery", daemon=True)
+        self._thread.start()
+
+    # seconds until the circuit closes again, 0 while it is closed
+    def open_for(self):
+        return max(self.open_until - time.monotonic(), 0)
+
+    def _ladder_failed(self):
+        self.ladder_failures += 1
+        if self.ladder_failures >= breaker_threshold:
+            self.open_until = time.monotonic() + breaker_cooldown
+            self.ladder_failures = 0
+            print(f"{self.name}: Recovery failed {breaker_threshold} times in a row, leaving the camera alone for {breaker_cooldown:.0f} s.")
+
+    def close(self):
+        if self._thread is not None:
+            self._thread.join()
+        with self._lock:
+            if hasattr(self.handle, "close"):
+                self.handle.close()
+
+
+## recovery ladder of a Thorlabs camera, setup_fn(serial) opens and configures the camera
+# (serial None enumerates the cameras like the first setup)
+def thorlabs_supervisor(cam, setup_fn, name="TL"):
+    serial = backends.thorlabs_serial(cam)
+
+    def rearm(cam):
+        if hasattr(cam, "get_burst"):
+            # ring buffer stream: restart the continuous acquisition
+            cam.stop()
+            return cam.start()
+        cam.stop_acquisition()
+        return cam
+
+    def reopen(cam):
+        _close_quietly(cam)
+        return setup_fn(serial)
+
+    def reinit(cam):
+        _close_quietly(cam)
+        return setup_fn(None)
+
+    return CameraSupervisor(name, cam, [("rearm", rearm), ("reopen", reopen), ("reinit", reinit)])
+
+
+## recovery ladder of the Cubert acquisition context
+# configure_fn(acquContext) applies the integration time etc. to a new context, reinit_fn() loads
+# calibration and contexts from scratch and returns a new acquisition context.
+def cubert_supervisor(acquContext, backend, configure_fn, reinit_fn, get_timeout, name="CB"):
+    def rearm(acquContext):
+        if hasattr(acquContext, "flush"):
+            acquContext.flush(timedelta(seconds=get_timeout))
+        backends.rearm_cubert(backend, acquContext)
+        return acquContext
+
+    def reopen(acquContext):
+        return configure_fn(backends.reopen_cubert(backend))
+
+    def reinit(acquContext):
+        return reinit_fn()
+
+    return CameraSupervisor(name, acquContext, [("rearm", rearm), ("reopen", reopen), ("reinit", reinit)])
+
+
+def _close_quietly(cam):
+    try:
+        cam.close()
+    except Exception:
+        pass
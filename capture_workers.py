@@ -0,0 +1,150 @@
+import csv
+import queue
+import threading
+import time
+
+import numpy as np
+
+## Parameters
+barrier_timeout = 60  # in s, a worker waiting longer than this for the other camera gives up syncing
+
+
+## long-lived capture thread for one camera
+# The worker owns its camera handle. capture_fn(img_name, handle) takes one image and returns the handle,
+# which may be a new one if the camera had to be restarted. All workers sharing a barrier are released
+# together, so the cameras are triggered at the same time. Every exposure is logged with monotonic
+# start and end timestamps, the start is the release of the barrier unless capture_fn reports that
+# the image was triggered earlier (report_trigger, e.g. a Cubert capture kept in flight).
+class CaptureWorker(threading.Thread):
+    def __init__(self, camera, capture_fn, handle, barrier):
+        super().__init__(name=f"capture-{camera}", daemon=True)
+        self.camera = camera
+        self.capture_fn = capture_fn
+        self.handle = handle
+        self.barrier = barrier
+        self.jobs = queue.Queue()
+        self.done = queue.Queue()
+        self.timestamps = []  # (img_name, t_start, t_end)
+
+    # start capturing an image (non-blocking)
+    def trigger(self, img_name):
+        self.jobs.put(img_name)
+
+    # wait until the triggered image is captured
+    def wait(self):
+        return self.done.get()
+
+    def stop(self):
+        self.jobs.put(None)
+        self.join()
+
+    def run(self):
+        while True:
+            img_name = self.jobs.get()
+            if img_name is None:
+                break
+            try:
+                self.barrier.wait()
+            except threading.BrokenBarrierError:
+                print(f"{self.camera.upper()}: Barrier broken, capturing without sync.")
+            t_start = time.monotonic()
+            _local.release, _local.trigger = t_start, None
+            try:
+                self.handle = self.capture_fn(img_name, self.handle)
+            except Exception as e:
+                print(f"{self.camera.upper()}: Capture of {img_name} failed ({e!r}).")
+            t_end = time.monotonic()
+            self.timestamps.append((img_name, t_start if _local.trigger is None else _local.trigger, t_end))
+            self.done.put(img_name)
+
+
+## trigger time of the image captured by the current worker thread
+_local = threading.local()
+
+## called from a capture_fn when its image was triggered at the monotonic time t_trigger instead of on
+# the release of the barrier, with several captures per image the earliest counts
+def report_trigger(t_trigger):
+    previous = getattr(_local, "trigger", None)
+    _local.trigger = t_trigger if previous is None else min(previous, t_trigger)
+
+## forget a reported trigger time (e.g. of a capture that was rejected and is taken again)
+def reset_trigger():
+    _local.trigger = None
+
+## ms the image of the current worker thread was triggered before the barrier released it (0 if on release)
+def trigger_lead_ms():
+    release, trigger = getattr(_local, "release", None), getattr(_local, "trigger", None)
+    if release is None or trigger is None:
+        return 0.0
+    return max(release - trigger, 0.0) * 1e3
+
+
+## create a barrier for the given number of workers
+def make_barrier(n_workers):
+    return threading.Barrier(n_workers, timeout=barrier_timeout)
+
+
+## trigger all workers with the same image and wait for all of them
+def capture_synchronized(workers, img_name):
+    barrier = workers[0].barrier
+    if barrier.broken:
+        barrier.reset()
+    for worker in workers:
+        worker.trigger(img_name)
+    for worker in workers:
+        worker.wait()
+
+
+## trigger skew between two workers and dead time of each worker (all in ms)
+def skew_stats(worker_a, worker_b):
+    starts_b = {name: (t0, t1) for name, t0, t1 in worker_b.timestamps}
+    start_skew = []
+    end_skew = []
+    for name, t0, t1 in worker_a.timestamps:
+        if name in starts_b:
+            start_skew.append((starts_b[name][0] - t0) * 1e3)
+            end_skew.append((starts_b[name][1] - t1) * 1e3)
+
+    stats = {
+        "start_skew": summarize(start_skew),
+        "end_skew": summarize(end_skew),
+    }
+    for worker in (worker_a, worker_b):
+        # time between the end of one exposure and the start of the next
+        ts = worker.timestamps
+        dead = [(ts[i][1] - ts[i - 1][2]) * 1e3 for i in range(1, len(ts))]
+        busy = [(t1 - t0) * 1e3 for _, t0, t1 in ts]
+        stats[f"{worker.camera}_dead_time"] = summarize(dead)
+        stats[f"{worker.camera}_capture_time"] = summarize(busy)
+    return stats
+
+
+def summarize(values):
+    if len(values) == 0:
+        return {"n": 0}
+    values = np.asarray(values)
+    return {
+        "n": len(values),
+        "mean": float(np.mean(values)),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "max_abs": float(np.max(np.abs(values))),
+    }
+
+
+## print the telemetry summary
+def print_skew_stats(worker_a, worker_b):
+    for key, s in skew_stats(worker_a, worker_b).items():
+        if s["n"] == 0:
+            continue
+        print(f"{key}: mean {s['mean']:.1f} ms, p50 {s['p50']:.1f} ms, p95 {s['p95']:.1f} ms, max |.| {s['max_abs']:.1f} ms (n={s['n']})")
+
+
+## save all timestamps as csv (one row per exposure)
+def save_telemetry(path, workers):
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["img_name", "camera", "t_start", "t_end"])
+        for worker in workers:
+            for name, t0, t1 in worker.timestamps:
+                writer.writerow([name, worker.camera, f"{t0:.6f}", f"{t1:.6f}"])
@@ -1,17 +1,29 @@
-from pylablib.devices import Thorlabs as tl
-import cuvis
-
+import argparse
 import os
 import time
-import platform
 from datetime import timedelta
-from threading import Thread
+from threading import Lock
 
-import tifffile
 import numpy as np
-import polanalyser as pa
+
+import backends
+import metrics
+import pipeline
+import capture_workers
+import camera_supervisor
+import thorlabs_stream
+import cubert_overlap
+import sensor_roi
+import frame_averaging
+import auto_exposure
+import quality_gate
+import storage
+import processing_kernels
+import run_manifest
+import dataset_store
 
 ## Parameters
+camera_backend = "hardware" # "hardware" or "simulated"
 thorlabs_image_folder = 'images/shift_check/thorlabs_post'
 cubert_image_folder = 'images/shift_check/cubert_post'
 
@@ -19,44 +31,162 @@ cubert_image_folder = 'images/shift_check/cubert_post'
 exposure_time_tl = 100 # in ms
 exposure_time_cb = 500 # in ms
 manual_imaging = False
+n_images = None # stop after this many images (None = until "end" is typed in manual mode)
 
 # Additional paramters for Thorlabs cam
 do_dark_subtract_tl = True
 path_dark_tl = f"images//calibration//thorlabs_dark//masterdark_tl_{exposure_time_tl}ms.npy"
 roi_tl = (0, 2448, 0, 2048)
+tl_acquisition_mode = "snap" # "snap" (one acquisition per frame) or "stream" (continuous acquisition into a ring buffer)
+sensor_roi_tl = False # with do_crop_tl, only read out crop_tl (plus a margin for demosaicing) from the sensor instead of roi_tl
+n_average_tl = 1 # light frames averaged per image
+target_snr_tl = None # average until the SNR in snr_roi_tl reaches this instead (at most frame_averaging.max_frames frames)
+snr_roi_tl = None # ((x0, x1), (y0, y1)) in readout coordinates, None = whole frame
+auto_exposure_tl = False # adjust the exposure between captures from a subsampled histogram (with dark subtraction only to exposures with a master dark)
 
 # Additional paramters for Cubert cam
 do_dark_subtract_cb = True
 path_dark_cb = f"images//calibration//cubert_dark//masterdark_cb_{exposure_time_cb}ms.npy"
 
 distance_cb = 6000 # in mm (20 feet)
+wavelength_range_cb = (450, 850) # in nm, centres of the first and last band (spread evenly, as in the viewer)
 get_time_cb = 1000 # in ms
+cb_in_flight = 0 # captures issued ahead while the previous cube is processed (0 = serial capture)
+n_average_cb = 1 # light frames averaged per image
+target_snr_cb = None # average until the SNR in snr_roi_cb reaches this instead (at most frame_averaging.max_frames frames)
+snr_roi_cb = None # ((x0, x1), (y0, y1)) in cube coordinates, None = whole cube
+auto_exposure_cb = False # adjust the integration time between captures from a subsampled histogram (with dark subtraction only to exposures with a master dark)
+quality_checks_cb = quality_gate.default_checks # checks on a strided sample of the raw cube, thresholds in quality_gate.py (with auto_exposure_cb also quality_gate.exposure_checks, else they are only logged)
+quality_tries_cb = 15 # captures tried until one passes the gate, before the pair is dropped
 
 # Cropping
 crop_tl = ((1200-350-100, 1200+350+100), (400-100, 1100+100)) #((550-50, 1350+50), (850-50, 1650+50))
 crop_cb = ((50-11, 150-7), (150-17, 250-13)) #((188+3, 234-1), (64+3, 110-1))
+do_crop_tl = False
+do_crop_cb = False
+
+# Pipelined processing: capture threads only grab raw frames, workers calibrate/demosaic/crop, a writer saves
+use_pipeline = True
+
+# On-disk dtype of the images: "float32", "float16" or "uint16" (offset and scale in the TIFF metadata, read with storage.read_tiff)
+storage_dtype_tl = "float32"
+storage_dtype_cb = "float32"
+storage_layout_tl = "planes" # "planes" (0/45/90/135 deg and raw) or "mosaic" (only the dark subtracted raw mosaic, demosaiced by storage.read_thorlabs)
+compression_tl = None        # TIFF codec: None, "lzw", "deflate" or "zstd", compare with python storage.py benchmark
+compression_cb = None
+predictor_tl = "auto"        # None, "horizontal", "floatingpoint" (byte shuffle + delta) or "auto" (by storage dtype)
+predictor_cb = "auto"
+
+# Single HDF5 file the pairs are appended to instead of loose TIFFs (dataset_store.py), e.g. 'images/shift_check/dataset.h5'
+dataset_store_path = None
+
+# Packed bitmask of saturated pixels saved next to every image (<name>_thorlabs_saturation.npz, <name>_cubert_saturation.npz)
+save_saturation_masks = True
+
+# CSV file with monotonic start/end timestamps of every exposure (None to only print the summary)
+telemetry_path = None
+
+# JSONL file with the stage durations of every capture, summarize with "python metrics.py summary <file>"
+# ("auto": metrics.jsonl next to the image folders, None to disable)
+metrics_path = "auto"
+
+# Run manifest with one line per saved pair (paths, exposures, darks), written atomically after every pair
+# ("auto": manifest.jsonl next to the image folders, so every dataset folder has its own run)
+manifest_path = "auto"
+resume = False # continue the run in manifest_path and its numbering (also "python create_dataset.py --resume")
+
+# Store the pairs are written to, opened by main() when dataset_store_path is set
+pair_store = None
+# id of the run (from the manifest), embedded in the TIFFs so the index can tell runs apart
+run_id = None
+
+## file of the run, "auto" places it in the folder above thorlabs_image_folder
+def run_file(path, name):
+    if path != "auto":
+        return path
+    return os.path.join(os.path.dirname(os.path.normpath(thorlabs_image_folder)), name)
 
 ## Main function
 def main():
-    # Setup the Thorlabs cam
-    cam_tl = setup_thorlabs_cam()
+    global pair_store, run_id
+    metrics.open_log(run_file(metrics_path, "metrics.jsonl"))
+    manifest = run_manifest.RunManifest(run_file(manifest_path, "manifest.jsonl"), resume)
+    run_id = manifest.run_id
+    if dataset_store_path is not None:
+        pair_store = dataset_store.DatasetStore(dataset_store_path)
+
+    # Setup the Thorlabs cam, failures are handled by a supervisor with staged recovery
+    cam_tl = camera_supervisor.thorlabs_supervisor(setup_thorlabs_cam(), setup_thorlabs_cam)
     print("TL: Setup done.")
 
-    # Get Thorlabs masterdark calibration frame
+    # Crop in coordinates of the sensor readout
+    readout_roi = cam_tl.handle.get_roi()[:4]
+    frame_crop_tl = sensor_roi.shift_crop(crop_tl, roi_tl, readout_roi)
+
+    # Get Thorlabs masterdark calibration frame (taken with roi_tl) and cut it to the readout
+    dark_calibration_tl = None
     if do_dark_subtract_tl:
-        dark_calibration_tl = np.load(path_dark_tl)
+        dark_calibration_tl = sensor_roi.crop_frame(np.load(path_dark_tl), roi_tl, readout_roi)
+    ae_tl, darks_tl = setup_auto_exposure_tl(readout_roi)
 
     # Setup the the Cubert cam
     acquisitionContext, processingContext, cubeExporter = setup_cubert_cam()
+    acquisitionContext = camera_supervisor.cubert_supervisor(acquisitionContext, camera_backend, configure_cubert_acquisition,
+                                                             lambda: setup_cubert_cam()[0], get_time_cb * 1e-3)
     print("CB: Setup done.")
 
     # Calibrate the Cubert cam
+    dark_calibration_cb = None
     if do_dark_subtract_cb:
         dark_calibration_cb = np.load(path_dark_cb)
+    ae_cb, darks_cb = setup_auto_exposure_cb()
+
+    # Start the processing and writing stages
+    if use_pipeline:
+        pairs = pipeline.PairCollector(("tl", "cb"), lambda img_name, parts: write_pair(img_name, parts, manifest))
+        pipe = pipeline.Pipeline(
+            process_fn=lambda item: process_item(item, frame_crop_tl, processingContext),
+            write_fn=pairs.add,
+            on_drop=pairs.discard).start()
+
+    # Start one long-lived capture worker per camera, both are triggered together through a barrier
+    # Without the pipeline the settings of the saved images are collected here for the manifest
+    saved_settings = {}
+    def capture_tl(img_name, cam):
+        settings = capture_settings(exposure_time_tl, path_dark_tl if do_dark_subtract_tl else None, ae_tl, darks_tl)
+        dark = current_dark(dark_calibration_tl, ae_tl, darks_tl)
+        if use_pipeline:
+            # Only grabbing raw frames here, processing and saving happens in the pipeline
+            return capture_thorlabs_to_pipeline(img_name, cam, pipe, dark, ae_tl, frame_crop_tl, settings)
+        # Taking and saving photo with Thorlabs cam
+        success, cam = take_and_save_thorlabs_image(img_name, dark, frame_crop_tl, cam, ae_tl, settings)
+        if success:
+            saved_settings.setdefault(img_name, {})["tl"] = settings
+        return cam
+
+    def capture_cb(img_name, acquContext):
+        settings = capture_settings(exposure_time_cb, path_dark_cb if do_dark_subtract_cb else None, ae_cb, darks_cb)
+        dark = current_dark(dark_calibration_cb, ae_cb, darks_cb)
+        if use_pipeline:
+            return capture_cubert_to_pipeline(img_name, acquContext, pipe, dark, ae_cb, settings, processingContext)
+        # Taking and saving photo with Cubert cam
+        if take_and_save_cubert_image(img_name, dark, acquContext, processingContext, ae_cb, settings):
+            saved_settings.setdefault(img_name, {})["cb"] = settings
+        return acquContext
 
-    # Loop over all loaded display images
+    barrier = capture_workers.make_barrier(2)
+    tl_worker = capture_workers.CaptureWorker("tl", capture_tl, cam_tl, barrier)
+    cb_worker = capture_workers.CaptureWorker("cb", capture_cb, acquisitionContext, barrier)
+    tl_worker.start()
+    cb_worker.start()
+
+    # Loop over all loaded display images, a resumed run continues after its last saved pair
     img_name = 30
-    while True:
+    if resume:
+        img_name = manifest.next_index(img_name + 1) - 1
+        print(f"Resuming run of {manifest.path}: {len(manifest.completed())} pairs saved, continuing after image {img_name}.")
+    first_image = img_name
+    while n_images is None or img_name < first_image + n_images:
         img_name = img_name + 1
 
         if manual_imaging:
@@ -68,181 +198,401 @@ def main():
                         )  # import time
             print(f"\nImage count: {img_name}")
 
-        # Taking and saving photo with Thorlabs cam
-        tl_thread = Thread(target=take_and_save_thorlabs_image, args=(str(img_name), dark_calibration_tl, cam_tl))
-        tl_thread.start()
-
-        # Taking and saving photo with Cubert cam
-        cb_thread = Thread(target=take_and_save_cubert_image, args=(str(img_name), dark_calibration_cb, acquisitionContext, processingContext))
-        cb_thread.start()
-
-        # Waiting for both threads to finish
-        tl_thread.join()
-        cb_thread.join()
+        # Taking photos with both cams and waiting for both workers to finish
+        capture_workers.capture_synchronized([tl_worker, cb_worker], str(img_name))
+        if not use_pipeline:
+            settings = saved_settings.pop(str(img_name), {})
+            if len(settings) == 2:
+                record_pair(manifest, str(img_name), settings["tl"], settings["cb"])
+            elif pair_store is not None:
+                # the store keeps the image of one camera until the other arrives, drop it
+                pair_store.discard(str(img_name))
+
+    tl_worker.stop()
+    cb_worker.stop()
+    if use_pipeline:
+        pipe.close()
+        pairs.close()
+    manifest.close()
+    if pair_store is not None:
+        pair_store.close()
+
+    # Trigger skew and dead time between exposures
+    capture_workers.print_skew_stats(tl_worker, cb_worker)
+    if telemetry_path is not None:
+        capture_workers.save_telemetry(telemetry_path, [tl_worker, cb_worker])
 
     print("\nDataset creation finished. Quitting.")
-    cam_tl.close()
+    tl_worker.handle.close()
 
 
 ## setup everything for the Thorlabs camera
-def setup_thorlabs_cam():
-    tl.list_cameras_tlcam()
-    cam = tl.ThorlabsTLCamera()
+def setup_thorlabs_cam(serial=None):
+    cam = backends.open_thorlabs(camera_backend, serial)
     cam.set_exposure(exposure_time_tl * 1e-3)
-    cam.set_roi(*roi_tl, hbin=1, vbin=1)
+    cam.set_roi(*readout_roi_tl(cam), hbin=1, vbin=1)
+    if tl_acquisition_mode == "stream":
+        cam = thorlabs_stream.ThorlabsStream(cam).start()
     return cam
 
-## take cubert image as array, do dark calibration and save that as a tiff
-def take_and_save_thorlabs_image(img_name, dark_cal, cam_tl):
-    imaging_failed_counter = 0
-    success = False
-
-    # Try taking and saving images until it works (max 15 times).
-    while imaging_failed_counter < 15:
-        print(f"TL: Taking {exposure_time_tl}ms exposure with TL cam...")
-        try:
-            if do_dark_subtract_tl:
-                img_tl = cam_tl.snap() - dark_cal
-                img_tl = np.maximum(img_tl, 0)
-            else:
-                img_tl = cam_tl.snap()
-            print("TL: Imaging successfull.")
-            success = True
-            break
-        except:
-            imaging_failed_counter += 1
-            print(f"TL: Imaging failed. Restarting cam. Counter {imaging_failed_counter}")
-            cam_tl.close()
-            cam_tl = setup_thorlabs_cam()
+## sensor ROI of the Thorlabs cam: roi_tl or the mosaic-aligned window around crop_tl
+def readout_roi_tl(cam):
+    if sensor_roi_tl and do_crop_tl:
+        return sensor_roi.roi_from_crop(crop_tl, roi_tl, cam)
+    return roi_tl
+
+## auto exposure of the Thorlabs cam (None if off) and the master darks of all exposures it may pick
+def setup_auto_exposure_tl(readout_roi):
+    if not auto_exposure_tl:
+        return None, None
+    darks = auto_exposure.MasterDarks(os.path.dirname(path_dark_tl), "masterdark_tl_", lambda dark: sensor_roi.crop_frame(dark, roi_tl, readout_roi))
+    ae = auto_exposure.AutoExposure("TL", exposure_time_tl, auto_exposure.max_counts_tl,
+                                    lambda cam: cam.get_exposure() * 1e3, lambda cam, ms: cam.set_exposure(ms * 1e-3),
+                                    ladder=darks.exposures if do_dark_subtract_tl else None)
+    return ae, darks
+
+## master dark of the exposure the next capture is taken with
+def current_dark(dark_cal, ae, darks):
+    if dark_cal is None or ae is None:
+        return dark_cal
+    return darks.get(ae.exposure)
+
+## exposure and master dark file of the next capture, as recorded in the run manifest
+def capture_settings(exposure, path_dark, ae, darks):
+    if ae is not None:
+        exposure = ae.exposure
+        if path_dark is not None:
+            path_dark = darks.path(exposure)
+    return {"exposure_ms": exposure, "dark": path_dark}
+
+## feed a raw capture to the auto exposure and return its packed saturation mask, cropped like the saved image
+def exposure_feedback(raw, ae, exposure, crop, max_counts, m, band_axis=None):
+    with m.stage("exposure"):
+        if ae is not None:
+            exposure = ae.exposure
+            ae.observe(raw)
+        if not save_saturation_masks:
+            return None
+        if crop is not None:
+            raw = raw[crop[1][0]:crop[1][1], crop[0][0]:crop[0][1]]
+        packed, shape = auto_exposure.saturation_mask(raw, max_counts, band_axis)
+        return packed, shape, exposure
+
+## take thorlabs image as array, do dark calibration and save that as a tiff
+def take_and_save_thorlabs_image(img_name, dark_cal, crop, cam_tl, ae=None, settings=None):
+    m = metrics.CaptureMetrics("tl", img_name)
+    success, img_tl, cam_tl = capture_thorlabs_frame(cam_tl, m, dark_cal, ae)
 
     if success:
-        # Demonsaicing to different polarization channels
-        img_tl_pol = pa.demosaicing(img_raw=img_tl, code=pa.COLOR_PolarMono)
-        img_tl_pol = np.append(img_tl_pol, [img_tl], axis=0)
-
-        # Crop to size of DFA
-        # img_tl_pol = img_tl_pol[:, crop_tl[1][0]:crop_tl[1][1], crop_tl[0][0]:crop_tl[0][1]]
-
-        # Save Thorlabs image
-        path = os.path.join(thorlabs_image_folder, img_name + "_thorlabs.tif")
-        tifffile.imwrite(path, img_tl_pol,  photometric='minisblack')
-        print(f"TL: Saved image as tiff. (Shape: {img_tl_pol.shape}, Max: {np.max(img_tl_pol)}, Min: {np.min(img_tl_pol)}, Avg: {np.average(img_tl_pol)}, SNR: {snr(img_tl_pol)})")
+        saturation = exposure_feedback(img_tl, ae, exposure_time_tl, crop if do_crop_tl else None, auto_exposure.max_counts_tl, m)
+        img_tl_pol, metadata = process_thorlabs_frame(img_tl, dark_cal, crop, m)
+        write_thorlabs_image(img_name, img_tl_pol, m, saturation, metadata, settings)
     else:
         print("TL: No image to save.")
+    m.finish()
 
-    # Returnign cam_tl in case the camera had to be restarted
     return success, cam_tl
 
+## grab a raw frame from the Thorlabs cam, the supervisor retries and recovers the cam if needed
+def capture_thorlabs_frame(cam_tl, m, dark=None, ae=None):
+    print(f"TL: Taking {exposure_time_tl if ae is None else ae.exposure:g}ms exposure with TL cam...")
+    try:
+        with m.stage("acquire"):
+            img_tl = cam_tl.run(lambda cam: grab_thorlabs_frame(cam, dark, ae), m)
+        print("TL: Imaging successfull.")
+        return True, img_tl, cam_tl
+    except camera_supervisor.CameraUnavailable as e:
+        print(f"TL: Imaging failed. {e}")
+        return False, None, cam_tl
+
+## single frame, or the float32 mean of n_average_tl frames / of as many frames as target_snr_tl needs
+def grab_thorlabs_frame(cam, dark=None, ae=None):
+    if ae is not None:
+        ae.apply(cam)
+    if n_average_tl == 1 and target_snr_tl is None:
+        return cam.snap()
+    dark = 0.0 if dark is None else dark
+    acc = frame_averaging.average_frames(frame_averaging.thorlabs_frames(cam), n_average_tl, target_snr_tl, snr_roi_tl, dark)
+    print(f"TL: Averaged {acc.n} frames (SNR {acc.snr(snr_roi_tl, dark):.1f}).")
+    return acc.mean
+
+## dark calibration, demosaicing and cropping of a raw Thorlabs frame, returns the image and its TIFF metadata
+# One fused kernel only working on the crop window, the float32 result buffer is handed back to it after writing.
+# With storage_layout_tl "mosaic" only the dark subtracted mosaic around the crop is kept.
+thorlabs_kernel = processing_kernels.ThorlabsKernel()
+def process_thorlabs_frame(img_tl, dark_cal, crop, m):
+    dark = dark_cal if do_dark_subtract_tl else None
+    crop = crop if do_crop_tl else None
+    if storage_layout_tl == "mosaic":
+        with m.stage("calibrate"):
+            mosaic = thorlabs_kernel.calibrate_window(img_tl, dark, crop)
+        return mosaic, storage.mosaic_metadata(processing_kernels.window_crop(crop, img_tl.shape))
+    with m.stage("demosaic"):
+        return thorlabs_kernel.process(img_tl, dark, crop), None
+
+## save a processed Thorlabs image as tiff
+def write_thorlabs_image(img_name, img_tl_pol, m, saturation=None, metadata=None, settings=None):
+    path = os.path.join(thorlabs_image_folder, img_name + "_thorlabs.tif")
+    metadata = {**(metadata or {}), **capture_metadata(img_name, "tl", img_tl_pol, settings)}
+    # encoding and writing are one stage, the file is written directly without an in-memory copy
+    with m.stage("write"):
+        if pair_store is not None:
+            pair_store.write(img_name, "tl", img_tl_pol, storage_dtype_tl, metadata)
+        else:
+            storage.save_tiff(path, img_tl_pol, storage_dtype_tl, metadata, compression_tl, predictor_tl)
+        if saturation is not None:
+            auto_exposure.save_saturation_mask(os.path.join(thorlabs_image_folder, img_name + "_thorlabs_saturation.npz"), *saturation)
+    print(f"TL: Saved image as tiff. (Shape: {img_tl_pol.shape}, {quality_gate.describe(metadata['stats'])})")
+    thorlabs_kernel.release(img_tl_pol)
+
 ## setup everything for the Thorlabs camera
 def setup_cubert_cam():
-    # Default directories and files:
-    data_dir = None
-    lib_dir = None
-
-    if platform.system() == "Windows":
-        lib_dir = os.getenv("CUVIS")
-        data_dir = os.path.normpath(os.path.join(lib_dir, os.path.pardir, "sdk", "sample_data", "set_examples"))
-    elif platform.system() == "Linux":
-        lib_dir = os.getenv("CUVIS_DATA")
-        data_dir = os.path.normpath(os.path.join(lib_dir, "sample_data", "set_examples"))
-
-    # Default factory directory:
-    factory_dir = os.path.join(lib_dir, os.pardir, "factory")
-
-    # Default settings and output directories:
-    userSettingsDir = os.path.join(data_dir, "settings")
-
-    # Start camera
-    print("Loading user settings...")
-    settings = cuvis.General(userSettingsDir)
-    settings.set_log_level("info")
-
-    print("Loading calibration, processing, and acquisition context (factory)...")
-    calibration = cuvis.Calibration(factory_dir)
-    processingContext = cuvis.ProcessingContext(calibration)
-    acquisitionContext = cuvis.AcquisitionContext(calibration)
-
-    saveArgs = cuvis.SaveArgs(export_dir=cubert_image_folder, allow_overwrite=True, allow_session_file=True)
-    cubeExporter = cuvis.CubeExporter(saveArgs)
-
-    # Wait for camera to come online
-    while acquisitionContext.state == cuvis.HardwareState.Offline:
-        print(".", end="")
-        time.sleep(1)
-    print("\nCubert camera is online.")
-
-    # Set acquisition context parameters
-    acquisitionContext.operation_mode = cuvis.OperationMode.Software
-    acquisitionContext.integration_time = exposure_time_cb
+    acquisitionContext, processingContext, cubeExporter = backends.open_cubert(camera_backend, export_dir=cubert_image_folder)
+    acquisitionContext = configure_cubert_acquisition(acquisitionContext)
     processingContext.calc_distance(distance_cb)
-
     return acquisitionContext, processingContext, cubeExporter
 
-## take cubert image, extract raw data, do dark calibration and save that as a tiff
-def take_and_save_cubert_image(img_name, dark_cal, acquContext, procContext):
-    imaging_failed_counter = 0
-    saved = False
-    # Try taking and siving images until it works (max 5 times).
-    while imaging_failed_counter < 15:
-        # Take photo with Cubert cam
-        print(f"CB: Taking {exposure_time_cb}ms exposure with CB cam...")
-        try:
-            am = acquContext.capture()
-            mesu, res = am.get(timedelta(milliseconds=get_time_cb))
-            print("CB: Imaging successfull.")
-        except:
-            mesu = None
-            imaging_failed_counter += 1
-            print(f"CB: imaging failed. Counter: {imaging_failed_counter}")
+## auto exposure of the Cubert cam (None if off) and the master darks of all integration times it may pick
+def setup_auto_exposure_cb():
+    if not auto_exposure_cb:
+        return None, None
+    darks = auto_exposure.MasterDarks(os.path.dirname(path_dark_cb), "masterdark_cb_")
+    ae = auto_exposure.AutoExposure("CB", exposure_time_cb, auto_exposure.max_counts_cb,
+                                    lambda context: context.integration_time, lambda context, ms: setattr(context, "integration_time", ms),
+                                    ladder=darks.exposures if do_dark_subtract_cb else None, spatial_axes=(0, 1))
+    return ae, darks
+
+## set acquisition context parameters (also used when the supervisor reopens the context)
+def configure_cubert_acquisition(acquisitionContext):
+    acquisitionContext.integration_time = exposure_time_cb
 
-        # Save Cubert image
-        if mesu is not None:
-            mesu.set_name(img_name + "_cubert")
-            procContext.apply(mesu)
-            print("CB: Exporting image to multi-channel .tif...")
-            # get array from mesurement
-            data_array = np.array(mesu.data['cube'].array)
-            # dark subtraction
-            if do_dark_subtract_cb:
-                data_array = data_array.astype(float) - dark_cal.astype(float)
-                data_array = np.maximum(data_array, 0)
-            else:
-                data_array = data_array.astype(float)
-            # switch third (spectral) dimension to first dimension
-            data_array = data_array.transpose(2,0,1)
-            # crop cube
-            # data_array = data_array[:, crop_cb[1][0]:crop_cb[1][1], crop_cb[0][0]:crop_cb[0][1]]
-            if snr(data_array) > 0.1:
-                # save as tif
-                path = os.path.join(cubert_image_folder, img_name + "_cubert.tif")
-                tifffile.imwrite(path, data_array,  photometric='minisblack')
-                print(f"CB: Saved image as tiff. (Shape: {data_array.shape}, Max: {np.max(data_array)}, Min: {np.min(data_array)}, Avg: {np.average(data_array)}, SNR: {snr(data_array)})")
-                saved = True
-                # end while loop
-                break
-            else:
-                imaging_failed_counter += 1
-                print(f"CB: Image saving failed. Counter: {imaging_failed_counter}")
-        else:   
-            imaging_failed_counter += 1
-            print(f"CB: Image saving failed. Counter: {imaging_failed_counter}")
+    # Keep the next capture(s) in flight while the current cube is processed and exported
+    if cb_in_flight > 0:
+        acquisitionContext = cubert_overlap.OverlappedCubertAcquisition(acquisitionContext, n_in_flight=cb_in_flight)
+    return acquisitionContext
+
+## take cubert image, extract raw data, do dark calibration and save that as a tiff (True if saved)
+def take_and_save_cubert_image(img_name, dark_cal, acquContext, procContext, ae=None, settings=None):
+    m = metrics.CaptureMetrics("cb", img_name)
+    # Captures are retried until one passes the quality gate, capture errors are handled by the supervisor
+    mesu, saturation = capture_checked_cubert_measurement(acquContext, m, dark_cal, ae, procContext)
+    record_trigger_lead(settings)
+    saved = False
+    if mesu is not None:
+        data_array = process_cubert_measurement(img_name, mesu, dark_cal, procContext, m)
+        write_cubert_image(img_name, data_array, m, saturation, settings)
+        saved = True
+    m.finish()
     if saved == False:
         # delete TL image
         print("CB: Deleting corresponding TL image because CB image saving failed...")
         try: 
-            os.remove(os.path.join(thorlabs_image_folder, 
-             + "_thorlabs.tif"))
+            os.remove(os.path.join(thorlabs_image_folder, img_name + "_thorlabs.tif"))
+            if os.path.exists(os.path.join(thorlabs_image_folder, img_name + "_thorlabs_saturation.npz")):
+                os.remove(os.path.join(thorlabs_image_folder, img_name + "_thorlabs_saturation.npz"))
             print("CB: Deleted corresponding TL image.")
         except:
             print("CB: TL image could not be deleted.")
-        
-## calc SNR
-def snr(img, axis=None, ddof=0):
-    img = np.asanyarray(img)
-    m = img.mean(axis)
-    sd = img.std(axis=axis, ddof=ddof)
-    return np.where(sd == 0, 0, m/sd)
+    return saved
+
+## capture until a measurement passes the quality gate, returns (mesu, saturation) or (None, None)
+# The gate only looks at a strided sample of the raw cube, so rejected captures are retried before any
+# processing, conversion or writing happens.
+def capture_checked_cubert_measurement(acquContext, m, dark=None, ae=None, procContext=None):
+    for attempt in range(quality_tries_cb):
+        capture_workers.reset_trigger()
+        mesu = capture_cubert_measurement(acquContext, m, dark, ae, procContext)
+        if mesu is None:
+            break
+        # the auto exposure also learns from rejected (e.g. saturated) captures
+        saturation = cubert_exposure_feedback(mesu, ae, m)
+        reasons = check_cubert_measurement(mesu, dark, m, ae)
+        if not reasons:
+            return mesu, saturation
+        m.retries += 1
+        print(f"CB: Rejecting capture ({'; '.join(reasons)}). Attempt {attempt + 1}/{quality_tries_cb}.")
+    return None, None
+
+## quality gate of a raw Cubert capture, returns the reasons to reject it (empty if it passed)
+def check_cubert_measurement(mesu, dark, m, ae=None):
+    with m.stage("quality"):
+        crop = crop_cb if do_crop_cb else None
+        cube = mesu if isinstance(mesu, np.ndarray) else np.asarray(mesu.data['cube'].array)
+        dark = quality_gate.sample(dark, crop) if do_dark_subtract_cb and dark is not None else None
+        stats = quality_gate.sample_stats(quality_gate.sample(cube, crop), dark, auto_exposure.max_counts_cb, band_axis=2)
+        if ae is None:
+            for note in quality_gate.evaluate(stats, quality_gate.exposure_checks):
+                print(f"CB: Keeping capture ({note}), the exposure is fixed.")
+        return quality_gate.evaluate(stats, quality_gate.gate_checks(quality_checks_cb, ae is not None))
+
+## trigger the Cubert cam and fetch the measurement (None if it failed)
+def capture_cubert_measurement(acquContext, m, dark=None, ae=None, procContext=None):
+    print(f"CB: Taking {exposure_time_cb if ae is None else ae.exposure:g}ms exposure with CB cam...")
+
+    def fetch(context):
+        if ae is not None and ae.apply(context) and hasattr(context, "flush"):
+            # captures in flight were triggered with the old integration time
+            context.flush(timedelta(milliseconds=get_time_cb))
+        return fetch_cubert_average(context, dark, procContext)
+
+    try:
+        with m.stage("acquire"):
+            mesu = acquContext.run(fetch, m)
+        print("CB: Imaging successfull.")
+    except camera_supervisor.CameraUnavailable as e:
+        mesu = None
+        print(f"CB: imaging failed. {e}")
+    return mesu
+
+## one capture of the Cubert cam, raising if no measurement came back
+def fetch_cubert_measurement(acquContext):
+    am = acquContext.capture()
+    mesu, res = am.get(timedelta(milliseconds=get_time_cb))
+    if mesu is None:
+        raise RuntimeError(f"Capture failed ({res}).")
+    return mesu
+
+## single measurement, or the float32 mean cube (height, width, bands) of n_average_cb captures / of as
+# many captures as target_snr_cb needs. Every capture of an average goes through procContext.apply()
+# first, like single captures and the master dark, so averages are processed the same way.
+def fetch_cubert_average(acquContext, dark=None, procContext=None):
+    if n_average_cb == 1 and target_snr_cb is None:
+        return fetch_cubert_measurement(acquContext)
+    # accumulate band first, so snr_roi_cb addresses the spatial axes
+    def next_cube():
+        mesu = fetch_cubert_measurement(acquContext)
+        if procContext is not None:
+            with cubert_processing_lock:
+                procContext.apply(mesu)
+        return np.asarray(mesu.data['cube'].array).transpose(2, 0, 1)
+    dark = 0.0 if dark is None else dark.transpose(2, 0, 1)
+    acc = frame_averaging.average_frames(next_cube, n_average_cb, target_snr_cb, snr_roi_cb, dark)
+    print(f"CB: Averaged {acc.n} captures (SNR {acc.snr(snr_roi_cb, dark):.1f}).")
+    return acc.mean.transpose(1, 2, 0)
+
+## with captures in flight the saved cube was triggered in an earlier cycle than the TL image, record by how much
+def record_trigger_lead(settings):
+    if settings is not None and cb_in_flight > 0:
+        settings["trigger_lead_ms"] = round(capture_workers.trigger_lead_ms(), 1)
+
+## auto exposure and saturation mask of a Cubert capture, from the raw cube (height, width, bands)
+def cubert_exposure_feedback(mesu, ae, m):
+    cube = mesu if isinstance(mesu, np.ndarray) else np.asarray(mesu.data['cube'].array)
+    return exposure_feedback(cube, ae, exposure_time_cb, crop_cb if do_crop_cb else None, auto_exposure.max_counts_cb, m, band_axis=2)
+
+## process a Cubert measurement, do dark calibration and cropping
+# The fused kernel writes the cropped band first float32 cube into a reused buffer, handed back after writing
+cubert_processing_lock = Lock()
+cubert_kernel = processing_kernels.CubertKernel()
+def process_cubert_measurement(img_name, mesu, dark_cal, procContext, m):
+    # the processing context is shared between the pipeline workers
+    if isinstance(mesu, np.ndarray):
+        # mean of several applied cubes from the capture stage
+        data_array = mesu
+    else:
+        with cubert_processing_lock, m.stage("apply"):
+            mesu.set_name(img_name + "_cubert")
+            procContext.apply(mesu)
+            # get array from mesurement
+            data_array = np.asarray(mesu.data['cube'].array)
+    # crop, dark subtraction and switching the third (spectral) dimension to the first one
+    with m.stage("calibrate"):
+        return cubert_kernel.process(data_array, dark_cal if do_dark_subtract_cb else None, crop_cb if do_crop_cb else None)
+
+## save a processed Cubert cube as tiff
+def write_cubert_image(img_name, data_array, m, saturation=None, settings=None):
+    print("CB: Exporting image to multi-channel .tif...")
+    path = os.path.join(cubert_image_folder, img_name + "_cubert.tif")
+    metadata = capture_metadata(img_name, "cb", data_array, settings)
+    with m.stage("write"):
+        if pair_store is not None:
+            pair_store.write(img_name, "cb", data_array, storage_dtype_cb, metadata)
+        else:
+            storage.save_tiff(path, data_array, storage_dtype_cb, metadata, compression_cb, predictor_cb)
+        if saturation is not None:
+            auto_exposure.save_saturation_mask(os.path.join(cubert_image_folder, img_name + "_cubert_saturation.npz"), *saturation)
+    print(f"CB: Saved image as tiff. (Shape: {data_array.shape}, {quality_gate.describe(metadata['stats'])})")
+    cubert_kernel.release(data_array)
+
+## capture stage of the pipeline: only grab the raw TL frame and queue it
+def capture_thorlabs_to_pipeline(img_name, cam_tl, pipe, dark=None, ae=None, crop=None, settings=None):
+    m = metrics.CaptureMetrics("tl", img_name)
+    item = {"camera": "tl", "img_name": img_name, "data": None, "metrics": m, "dark": dark, "saturation": None, "settings": settings}
+    try:
+        success, img_tl, cam_tl = capture_thorlabs_frame(cam_tl, m, dark, ae)
+        saturation = None
+        if success:
+            saturation = exposure_feedback(img_tl, ae, exposure_time_tl, crop if do_crop_tl else None, auto_exposure.max_counts_tl, m)
+    except Exception:
+        # release the CB part of the pair instead of leaving it waiting in the collector
+        pipe.drop(item)
+        raise
+    pipe.submit({**item, "data": img_tl, "saturation": saturation})
+    # Returnign cam_tl in case the camera had to be restarted
+    return cam_tl
+
+## capture stage of the pipeline: only fetch the CB measurement and queue it
+def capture_cubert_to_pipeline(img_name, acquContext, pipe, dark=None, ae=None, settings=None, procContext=None):
+    m = metrics.CaptureMetrics("cb", img_name)
+    item = {"camera": "cb", "img_name": img_name, "data": None, "metrics": m, "dark": dark, "saturation": None, "settings": settings}
+    try:
+        mesu, saturation = capture_checked_cubert_measurement(acquContext, m, dark, ae, procContext)
+        record_trigger_lead(settings)
+    except Exception:
+        # release the TL part of the pair instead of leaving it waiting in the collector
+        pipe.drop(item)
+        raise
+    pipe.submit({**item, "data": mesu, "saturation": saturation})
+    return acquContext
+
+## processing stage of the pipeline (runs in the worker pool)
+def process_item(item, crop_tl, procContext):
+    if item["data"] is None:
+        return item
+    if item["camera"] == "tl":
+        data, metadata = process_thorlabs_frame(item["data"], item["dark"], crop_tl, item["metrics"])
+        return {**item, "data": data, "metadata": metadata}
+    data = process_cubert_measurement(item["img_name"], item["data"], item["dark"], procContext, item["metrics"])
+    return {**item, "data": data}
+
+## writing stage of the pipeline, only saves complete pairs and records them in the manifest
+def write_pair(img_name, parts, manifest):
+    if any(part["data"] is None for part in parts.values()):
+        print(f"Skipping pair {img_name} because not all cameras delivered an image.")
+    else:
+        write_thorlabs_image(img_name, parts["tl"]["data"], parts["tl"]["metrics"], parts["tl"]["saturation"], parts["tl"]["metadata"], parts["tl"]["settings"])
+        write_cubert_image(img_name, parts["cb"]["data"], parts["cb"]["metrics"], parts["cb"]["saturation"], parts["cb"]["settings"])
+        record_pair(manifest, img_name, parts["tl"]["settings"], parts["cb"]["settings"])
+    for part in parts.values():
+        part["metrics"].finish()
+
+## add a saved pair with its files, exposures and darks to the run manifest (and the record of the pair in the store)
+def record_pair(manifest, img_name, settings_tl, settings_cb):
+    paths = {"tl": os.path.join(thorlabs_image_folder, img_name + "_thorlabs.tif"),
+             "cb": os.path.join(cubert_image_folder, img_name + "_cubert.tif")}
+    if pair_store is not None:
+        paths = {"store": dataset_store_path}
+        pair_store.annotate(img_name, tl_settings=settings_tl, cb_settings=settings_cb,
+                            crop_tl=crop_tl if do_crop_tl else None, crop_cb=crop_cb if do_crop_cb else None)
+    if save_saturation_masks:
+        paths["tl_saturation"] = os.path.join(thorlabs_image_folder, img_name + "_thorlabs_saturation.npz")
+        paths["cb_saturation"] = os.path.join(cubert_image_folder, img_name + "_cubert_saturation.npz")
+    manifest.add(img_name, paths=paths, tl=settings_tl, cb=settings_cb,
+                 crop_tl=crop_tl if do_crop_tl else None, crop_cb=crop_cb if do_crop_cb else None)
+
+## capture settings and per-band statistics (from a strided sample) embedded in the TIFF description, indexed by dataset_index.py
+def capture_metadata(img_name, camera, img, settings=None):
+    capture = {"pair": img_name, "run": run_id, "camera": camera, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), **(settings or {})}
+    if camera == "tl":
+        capture["crop"] = crop_tl if do_crop_tl else None
+    else:
+        capture.update({"crop": crop_cb if do_crop_cb else None, "distance_mm": distance_cb,
+                        "wavelengths_nm": np.linspace(*wavelength_range_cb, len(img)).round(2).tolist()})
+    return {"capture": capture, "stats": quality_gate.summary(img)}
 
 ## Run main
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Capture image pairs with the Thorlabs and the Cubert cam.")
+    parser.add_argument("--resume", action="store_true", help="continue the run recorded in manifest_path")
+    resume = parser.parse_args().resume or resume
     main()
\ No newline at end of file
@@ -1,18 +1,26 @@
-import pylablib as pll
-from pylablib.devices import Thorlabs as tl
-import cuvis
-import pygame
-
+import argparse
 import os
 import time
-import platform
 from datetime import timedelta
 
-import tifffile
 import numpy as np
-import polanalyser as pa
+
+import backends
+import metrics
+import camera_supervisor
+import thorlabs_stream
+import display_loader
+import sensor_roi
+import frame_averaging
+import auto_exposure
+import quality_gate
+import storage
+import processing_kernels
+import run_manifest
 
 ## Parameters
+camera_backend = "hardware" # "hardware" or "simulated"
+display_backend = "pygame" # "pygame" (fullscreen window) or "headless"
 display_image_folder = 'images/display'
 thorlabs_image_folder = 'images/thorlabs'
 cubert_image_folder = 'images/cubert'
@@ -24,6 +32,15 @@ img_size_y = 240*2.5
 img_offset_x = 0
 img_offset_y = 180
 
+# Display/capture handshake
+display_startup_time = 1000 # in ms, once after opening the fullscreen window
+display_settle_time = 100 # in ms, time after the flip before the exposures start
+confirm_display_change = False # check a low resolution TL frame for the new image before the exposures
+confirm_stride = 16 # subsampling of the TL frame for the check
+confirm_exposure = 20 # in ms, short TL exposure of the check frames (the capture exposure is restored after each check)
+confirm_threshold = 0.05 # min. relative mean change of the frame
+confirm_timeout = 3000 # in ms, give up confirming and capture anyway
+
 exposure_time_tl = 1000 # in ms
 exposure_time_cb = 250 # in ms
 
@@ -31,267 +48,461 @@ exposure_time_cb = 250 # in ms
 do_dark_subtract_tl = True
 path_dark_tl = f"images//calibration//thorlabs_dark//masterdark_tl_{exposure_time_tl}ms.npy"
 roi_tl = (0, 2448, 0, 2048)
+tl_acquisition_mode = "snap" # "snap" (one acquisition per frame) or "stream" (continuous acquisition into a ring buffer)
+sensor_roi_tl = False # only read out crop_tl (plus a margin for demosaicing) from the sensor instead of roi_tl
+n_average_tl = 1 # light frames averaged per image
+target_snr_tl = None # average until the SNR in snr_roi_tl reaches this instead (at most frame_averaging.max_frames frames)
+snr_roi_tl = None # ((x0, x1), (y0, y1)) in readout coordinates, None = whole frame
+auto_exposure_tl = False # adjust the exposure between captures from a subsampled histogram (with dark subtraction only to exposures with a master dark)
 
 # Additional paramters for Cubert cam
 do_dark_subtract_cb = True
 path_dark_cb = f"images//calibration//cubert_dark//masterdark_cb_{exposure_time_cb}ms.npy"
 distance_cb = 640 # in mm
+wavelength_range_cb = (450, 850) # in nm, centres of the first and last band (spread evenly, as in the viewer)
+n_average_cb = 1 # light frames averaged per image
+target_snr_cb = None # average until the SNR in snr_roi_cb reaches this instead (at most frame_averaging.max_frames frames)
+snr_roi_cb = None # ((x0, x1), (y0, y1)) in cube coordinates, None = whole cube
+auto_exposure_cb = False # adjust the integration time between captures from a subsampled histogram (with dark subtraction only to exposures with a master dark)
+quality_checks_cb = quality_gate.default_checks # checks on a strided sample of the raw cube, thresholds in quality_gate.py (with auto_exposure_cb also quality_gate.exposure_checks, else they are only logged)
+quality_tries_cb = 15 # captures tried until one passes the gate
 get_time_cb = 1000 # in ms
 
 # Cropping
 crop_tl = ((1250, 1910), (510, 1170))
 crop_cb = ((153, 273), (93, 213))
 
+# On-disk dtype of the images: "float32", "float16" or "uint16" (offset and scale in the TIFF metadata, read with storage.read_tiff)
+storage_dtype_tl = "float32"
+storage_dtype_cb = "float32"
+storage_layout_tl = "planes" # "planes" (0/45/90/135 deg and raw) or "mosaic" (only the dark subtracted raw mosaic, demosaiced by storage.read_thorlabs)
+compression_tl = None        # TIFF codec: None, "lzw", "deflate" or "zstd", compare with python storage.py benchmark
+compression_cb = None
+predictor_tl = "auto"        # None, "horizontal", "floatingpoint" (byte shuffle + delta) or "auto" (by storage dtype)
+predictor_cb = "auto"
+
+# Packed bitmask of saturated pixels saved next to every image (<name>_thorlabs_saturation.npz, <name>_cubert_saturation.npz)
+save_saturation_masks = True
+
+# JSONL file with the stage durations of every capture, summarize with "python metrics.py summary <file>"
+# ("auto": metrics.jsonl next to the image folders, None to disable)
+metrics_path = "auto"
+
+# Run manifest with one line per saved pair (display image, paths, exposures, darks), written atomically after every pair
+# ("auto": manifest.jsonl next to the image folders, so every dataset folder has its own run)
+manifest_path = "auto"
+resume = False # skip the display images already saved in manifest_path (also "python create_dataset_display.py --resume")
+breaker_waits = 1 # times in a row the run waits out the cooldown of a camera whose circuit opened (camera_supervisor.breaker_cooldown) before it stops
+
+# id of the run (from the manifest), embedded in the TIFFs so the index can tell runs apart
+run_id = None
+
+## file of the run, "auto" places it in the folder above thorlabs_image_folder
+def run_file(path, name):
+    if path != "auto":
+        return path
+    return os.path.join(os.path.dirname(os.path.normpath(thorlabs_image_folder)), name)
+
 ## Main function
 def main():
-    # Setup the Thorlabs cam
-    cam_tl = setup_thorlabs_cam()
+    global run_id
+    metrics.open_log(run_file(metrics_path, "metrics.jsonl"))
+    manifest = run_manifest.RunManifest(run_file(manifest_path, "manifest.jsonl"), resume)
+    run_id = manifest.run_id
+
+    # Setup the Thorlabs cam, failures are handled by a supervisor with staged recovery
+    cam_tl = camera_supervisor.thorlabs_supervisor(setup_thorlabs_cam(), setup_thorlabs_cam)
     print("TL setup done.")
 
-    # Get Thorlabs masterdark calibration frame
+    # Crop in coordinates of the sensor readout
+    readout_roi = cam_tl.handle.get_roi()[:4]
+    frame_crop_tl = sensor_roi.shift_crop(crop_tl, roi_tl, readout_roi)
+
+    # Get Thorlabs masterdark calibration frame (taken with roi_tl) and cut it to the readout
+    dark_calibration_tl = None
     if do_dark_subtract_tl:
-        dark_calibration_tl = np.load(path_dark_tl)
+        dark_calibration_tl = sensor_roi.crop_frame(np.load(path_dark_tl), roi_tl, readout_roi)
+    ae_tl, darks_tl = setup_auto_exposure_tl(readout_roi)
 
     # Setup the the Cubert cam
     acquisitionContext, processingContext, cubeExporter = setup_cubert_cam()
+    acquisitionContext = camera_supervisor.cubert_supervisor(acquisitionContext, camera_backend, configure_cubert_acquisition,
+                                                             lambda: setup_cubert_cam()[0], get_time_cb * 1e-3)
     print("CB setup done.")
 
     # Calibrate the Cubert cam
+    dark_calibration_cb = None
     if do_dark_subtract_cb:
         dark_calibration_cb = np.load(path_dark_cb)
+    ae_cb, darks_cb = setup_auto_exposure_cb()
 
     # Set up the pygame display and images
-    scrn, images_disp = setup_pygame_display(display_x, display_y, img_size_x, img_size_y, display_image_folder)
+    completed = manifest.completed()
+    if resume:
+        print(f"Resuming run of {manifest.path}: skipping {len(completed)} display images that were already saved.")
+    display, images_disp = setup_pygame_display(display_x, display_y, img_size_x, img_size_y, display_image_folder, completed)
     print("Pygame setup done.")
 
-    # Wait a few seconds so the monitor can update
-    pygame.time.wait(1000)
+    # Wait a few seconds so the monitor can switch to fullscreen
+    display.wait(display_startup_time)
 
     # Loop over all loaded display images
+    ref_thumb = None
+    waits_left = breaker_waits
+    stop = False
     for img_disp in images_disp:
+        while True:
+
+            # Display image and wait until the monitor shows it
+            img_name, flip_time = display_image(img_disp=img_disp, display=display)
+            ref_thumb = wait_for_display(flip_time, cam_tl, ref_thumb)
+
+            # Taking and saving photo with Thorlabs cam
+            settings_tl = capture_settings(exposure_time_tl, path_dark_tl if do_dark_subtract_tl else None, ae_tl, darks_tl)
+            tl_success, cam_tl = take_and_save_thorlabs_image(img_name=img_name, dark_cal=current_dark(dark_calibration_tl, ae_tl, darks_tl), crop=frame_crop_tl, cam_tl=cam_tl, ae=ae_tl, settings=settings_tl)
+
+            # Taking and saving photo with Cubert cam
+            if tl_success:
+                settings_cb = capture_settings(exposure_time_cb, path_dark_cb if do_dark_subtract_cb else None, ae_cb, darks_cb)
+                if take_and_save_cubert_image(img_name=img_name, dark_cal=current_dark(dark_calibration_cb, ae_cb, darks_cb), acquContext=acquisitionContext, procContext=processingContext, ae=ae_cb, settings=settings_cb):
+                    record_pair(manifest, img_name, settings_tl, settings_cb)
+                    waits_left = breaker_waits
+            else:
+                print("Skipping CB image because TL imaging was unsuccessful.")
 
-        # Display image
-        img_name = display_image(img_disp=img_disp, scrn=scrn)
-
-        # Taking and saving photo with Thorlabs cam
-        tl_success, cam_tl = take_and_save_thorlabs_image(img_name=img_name, dark_cal=dark_calibration_tl, cam_tl=cam_tl)
-
-        # Taking and saving photo with Cubert cam
-        if tl_success:
-            take_and_save_cubert_image(img_name=img_name, dark_cal=dark_calibration_cb, acquContext=acquisitionContext, procContext=processingContext)
-        else:
-            print("Skipping CB image because TL imaging was unsuccessful.")
-
-        # wait half a second
-        pygame.time.wait(500)
+            # With an open circuit every further image would fail at once: wait out the cooldown and take
+            # this image again, or stop if the camera stays broken
+            open_cams = [sup for sup in (cam_tl, acquisitionContext) if sup.open_for() > 0]
+            if not open_cams:
+                break
+            names = " and ".join(sup.name for sup in open_cams)
+            if waits_left == 0:
+                print(f"Stopping: circuit of {names} still open after {breaker_waits} waits for its cooldown. "
+                      f"Check the camera and continue with --resume.")
+                stop = True
+                break
+            waits_left -= 1
+            wait = max(sup.open_for() for sup in open_cams)
+            print(f"Circuit of {names} open, waiting {wait:.0f} s before taking {img_name} again.")
+            display.wait(int(wait * 1e3))
 
         # test if pygame should stop
-        for e in pygame.event.get():
-            if e.type == pygame.QUIT or e.type == pygame.KEYDOWN:
-                print("Quitting.")
-                pygame.quit()
+        if stop or display.quit_requested():
+            print("Quitting.")
+            break
 
     print("\nDataset creation finished. Quitting.")
+    manifest.close()
     cam_tl.close()
-    pygame.quit()
+    display.close()
 
 
 ## setup everything for the Thorlabs camera
-def setup_thorlabs_cam():
-    tl.list_cameras_tlcam()
-    cam = tl.ThorlabsTLCamera()
+def setup_thorlabs_cam(serial=None):
+    cam = backends.open_thorlabs(camera_backend, serial)
     cam.set_exposure(exposure_time_tl * 1e-3)
-    cam.set_roi(*roi_tl, hbin=1, vbin=1)
+    roi = sensor_roi.roi_from_crop(crop_tl, roi_tl, cam) if sensor_roi_tl else roi_tl
+    cam.set_roi(*roi, hbin=1, vbin=1)
+    if tl_acquisition_mode == "stream":
+        cam = thorlabs_stream.ThorlabsStream(cam).start()
     return cam
 
+## single frame, or the float32 mean of n_average_tl frames / of as many frames as target_snr_tl needs
+def grab_thorlabs_frame(cam, dark=None, ae=None):
+    if ae is not None:
+        ae.apply(cam)
+    if n_average_tl == 1 and target_snr_tl is None:
+        return cam.snap()
+    dark = 0.0 if dark is None else dark
+    acc = frame_averaging.average_frames(frame_averaging.thorlabs_frames(cam), n_average_tl, target_snr_tl, snr_roi_tl, dark)
+    print(f"TL: Averaged {acc.n} frames (SNR {acc.snr(snr_roi_tl, dark):.1f}).")
+    return acc.mean
+
+## auto exposure of the Thorlabs cam (None if off) and the master darks of all exposures it may pick
+def setup_auto_exposure_tl(readout_roi):
+    if not auto_exposure_tl:
+        return None, None
+    darks = auto_exposure.MasterDarks(os.path.dirname(path_dark_tl), "masterdark_tl_", lambda dark: sensor_roi.crop_frame(dark, roi_tl, readout_roi))
+    ae = auto_exposure.AutoExposure("TL", exposure_time_tl, auto_exposure.max_counts_tl,
+                                    lambda cam: cam.get_exposure() * 1e3, lambda cam, ms: cam.set_exposure(ms * 1e-3),
+                                    ladder=darks.exposures if do_dark_subtract_tl else None)
+    return ae, darks
+
+## master dark of the exposure the next capture is taken with
+def current_dark(dark_cal, ae, darks):
+    if dark_cal is None or ae is None:
+        return dark_cal
+    return darks.get(ae.exposure)
+
+## exposure and master dark file of the next capture, as recorded in the run manifest
+def capture_settings(exposure, path_dark, ae, darks):
+    if ae is not None:
+        exposure = ae.exposure
+        if path_dark is not None:
+            path_dark = darks.path(exposure)
+    return {"exposure_ms": exposure, "dark": path_dark}
+
+## feed a raw capture to the auto exposure and return its packed saturation mask, cropped like the saved image
+def exposure_feedback(raw, ae, exposure, crop, max_counts, m, band_axis=None):
+    with m.stage("exposure"):
+        if ae is not None:
+            exposure = ae.exposure
+            ae.observe(raw)
+        if not save_saturation_masks:
+            return None
+        raw = raw[crop[1][0]:crop[1][1], crop[0][0]:crop[0][1]]
+        packed, shape = auto_exposure.saturation_mask(raw, max_counts, band_axis)
+        return packed, shape, exposure
+
 ## take cubert image as array, do dark calibration and save that as a tiff
-def take_and_save_thorlabs_image(img_name, dark_cal, cam_tl):
-    imaging_failed_counter = 0
+thorlabs_kernel = processing_kernels.ThorlabsKernel()
+def take_and_save_thorlabs_image(img_name, dark_cal, crop, cam_tl, ae=None, settings=None):
+    m = metrics.CaptureMetrics("tl", img_name[:-4])
     success = False
 
-    # Try taking and saving images until it works (max 15 times).
-    while imaging_failed_counter < 15:
-        print(f"Taking {exposure_time_tl}ms exposure with TL cam...")
-        try:
-            if do_dark_subtract_tl:
-                img_tl = cam_tl.snap() - dark_cal
-                img_tl = np.maximum(img_tl, 0)
-            else:
-                img_tl = cam_tl.snap()
-            print("TL imaging successfull.")
-            success = True
-            break
-        except:
-            imaging_failed_counter += 1
-            print(f"Thorlabs imaging failed. Restarting cam. Counter {imaging_failed_counter}")
-            cam_tl.close()
-            cam_tl = setup_thorlabs_cam()
+    # The supervisor retries and recovers the cam, the display waits while it reconnects
+    print(f"Taking {exposure_time_tl if ae is None else ae.exposure:g}ms exposure with TL cam...")
+    try:
+        with m.stage("acquire"):
+            img_tl = cam_tl.run(lambda cam: grab_thorlabs_frame(cam, dark_cal, ae), m, block=True)
+        saturation = exposure_feedback(img_tl, ae, exposure_time_tl, crop, auto_exposure.max_counts_tl, m)
+        print("TL imaging successfull.")
+        success = True
+    except camera_supervisor.CameraUnavailable as e:
+        print(f"Thorlabs imaging failed. {e}")
 
     if success:
-        # Demonsaicing to different polarization channels
-        img_tl_pol = pa.demosaicing(img_raw=img_tl, code=pa.COLOR_PolarMono)
-        img_tl_pol = np.append(img_tl_pol, [img_tl], axis=0)
-
-        # Crop to size of DFA
-        img_tl_pol = img_tl_pol[:, crop_tl[1][0]:crop_tl[1][1], crop_tl[0][0]:crop_tl[0][1]]
+        # Dark calibration, demonsaicing to different polarization channels and cropping to size of DFA,
+        # fused into one kernel that only works on the crop window. In "mosaic" layout only the dark
+        # subtracted mosaic around the crop is saved and demosaiced when it is read.
+        dark = dark_cal if do_dark_subtract_tl else None
+        metadata = None
+        if storage_layout_tl == "mosaic":
+            with m.stage("calibrate"):
+                img_tl_pol = thorlabs_kernel.calibrate_window(img_tl, dark, crop)
+            metadata = storage.mosaic_metadata(processing_kernels.window_crop(crop, img_tl.shape))
+        else:
+            with m.stage("demosaic"):
+                img_tl_pol = thorlabs_kernel.process(img_tl, dark, crop)
 
-        # Save Thorlabs image
+        # Save Thorlabs image with the capture settings and band statistics in its description
         path = os.path.join(thorlabs_image_folder, img_name[:-4] + "_thorlabs.tif")
-        tifffile.imwrite(path, img_tl_pol,  photometric='minisblack')
-        print(f"Saved TL image as tiff. (Shape: {img_tl_pol.shape}, Max: {np.max(img_tl_pol)}, Min: {np.min(img_tl_pol)}, Avg: {np.average(img_tl_pol)}, SNR: {snr(img_tl_pol)})")
+        metadata = {**(metadata or {}), **capture_metadata(img_name, "tl", img_tl_pol, settings)}
+        # encoding and writing are one stage, the file is written directly without an in-memory copy
+        with m.stage("write"):
+            storage.save_tiff(path, img_tl_pol, storage_dtype_tl, metadata, compression_tl, predictor_tl)
+            if saturation is not None:
+                auto_exposure.save_saturation_mask(os.path.join(thorlabs_image_folder, img_name[:-4] + "_thorlabs_saturation.npz"), *saturation)
+        print(f"Saved TL image as tiff. (Shape: {img_tl_pol.shape}, {quality_gate.describe(metadata['stats'])})")
+        thorlabs_kernel.release(img_tl_pol)
     else:
         print("No TL image to save.")
+    m.finish()
 
     # Returnign cam_tl in case the camera had to be restarted
     return success, cam_tl
 
 ## setup everything for the Thorlabs camera
 def setup_cubert_cam():
-    # Default directories and files:
-    data_dir = None
-    lib_dir = None
-
-    if platform.system() == "Windows":
-        lib_dir = os.getenv("CUVIS")
-        data_dir = os.path.normpath(os.path.join(lib_dir, os.path.pardir, "sdk", "sample_data", "set_examples"))
-    elif platform.system() == "Linux":
-        lib_dir = os.getenv("CUVIS_DATA")
-        data_dir = os.path.normpath(os.path.join(lib_dir, "sample_data", "set_examples"))
-
-    # Default factory directory:
-    factory_dir = os.path.join(lib_dir, os.pardir, "factory")
-
-    # Default settings and output directories:
-    userSettingsDir = os.path.join(data_dir, "settings")
-
-    # Start camera
-    print("Loading user settings...")
-    settings = cuvis.General(userSettingsDir)
-    settings.set_log_level("info")
-
-    print("Loading calibration, processing, and acquisition context (factory)...")
-    calibration = cuvis.Calibration(factory_dir)
-    processingContext = cuvis.ProcessingContext(calibration)
-    acquisitionContext = cuvis.AcquisitionContext(calibration)
-
-    saveArgs = cuvis.SaveArgs(export_dir=cubert_image_folder, allow_overwrite=True, allow_session_file=True)
-    cubeExporter = cuvis.CubeExporter(saveArgs)
-
-    # Wait for camera to come online
-    while acquisitionContext.state == cuvis.HardwareState.Offline:
-        print(".", end="")
-        time.sleep(1)
-    print("\nCubert camera is online.")
-
-    # Set acquisition context parameters
-    acquisitionContext.operation_mode = cuvis.OperationMode.Software
-    acquisitionContext.integration_time = exposure_time_cb
+    acquisitionContext, processingContext, cubeExporter = backends.open_cubert(camera_backend, export_dir=cubert_image_folder)
+    acquisitionContext = configure_cubert_acquisition(acquisitionContext)
     processingContext.calc_distance(distance_cb)
-
     return acquisitionContext, processingContext, cubeExporter
 
-## take cubert image, extract raw data, do dark calibration and save that as a tiff
-def take_and_save_cubert_image(img_name, dark_cal, acquContext, procContext):
+## auto exposure of the Cubert cam (None if off) and the master darks of all integration times it may pick
+def setup_auto_exposure_cb():
+    if not auto_exposure_cb:
+        return None, None
+    darks = auto_exposure.MasterDarks(os.path.dirname(path_dark_cb), "masterdark_cb_")
+    ae = auto_exposure.AutoExposure("CB", exposure_time_cb, auto_exposure.max_counts_cb,
+                                    lambda context: context.integration_time, lambda context, ms: setattr(context, "integration_time", ms),
+                                    ladder=darks.exposures if do_dark_subtract_cb else None, spatial_axes=(0, 1))
+    return ae, darks
+
+## set acquisition context parameters (also used when the supervisor reopens the context)
+def configure_cubert_acquisition(acquisitionContext):
+    acquisitionContext.integration_time = exposure_time_cb
+    return acquisitionContext
+
+## one capture of the Cubert cam, raising if no measurement came back
+def fetch_cubert_measurement(acquContext):
+    am = acquContext.capture()
+    mesu, res = am.get(timedelta(milliseconds=get_time_cb))
+    if mesu is None:
+        raise RuntimeError(f"Capture failed ({res}).")
+    return mesu
+
+## single measurement, or the float32 mean cube (height, width, bands) of n_average_cb captures / of as
+# many captures as target_snr_cb needs. Every capture of an average goes through procContext.apply()
+# first, like single captures and the master dark, so averages are processed the same way.
+def fetch_cubert_average(acquContext, dark=None, procContext=None):
+    if n_average_cb == 1 and target_snr_cb is None:
+        return fetch_cubert_measurement(acquContext)
+    # accumulate band first, so snr_roi_cb addresses the spatial axes
+    def next_cube():
+        mesu = fetch_cubert_measurement(acquContext)
+        if procContext is not None:
+            procContext.apply(mesu)
+        return np.asarray(mesu.data['cube'].array).transpose(2, 0, 1)
+    dark = 0.0 if dark is None else dark.transpose(2, 0, 1)
+    acc = frame_averaging.average_frames(next_cube, n_average_cb, target_snr_cb, snr_roi_cb, dark)
+    print(f"CB: Averaged {acc.n} captures (SNR {acc.snr(snr_roi_cb, dark):.1f}).")
+    return acc.mean.transpose(1, 2, 0)
+
+## take cubert image, extract raw data, do dark calibration and save that as a tiff (True if saved)
+cubert_kernel = processing_kernels.CubertKernel()
+def take_and_save_cubert_image(img_name, dark_cal, acquContext, procContext, ae=None, settings=None):
+    m = metrics.CaptureMetrics("cb", img_name[:-4])
     imaging_failed_counter = 0
     saved = False
-    # Try taking and siving images until it works (max 5 times).
-    while imaging_failed_counter < 15:
+    # Try taking images until one passes the quality gate, capture errors are handled by the supervisor
+    while imaging_failed_counter < quality_tries_cb:
         # Take photo with Cubert cam
-        print(f"Taking {exposure_time_cb}ms exposure with CB cam...")
+        print(f"Taking {exposure_time_cb if ae is None else ae.exposure:g}ms exposure with CB cam...")
         try:
-            am = acquContext.capture()
-            mesu, res = am.get(timedelta(milliseconds=get_time_cb))
-        except:
-            mesu = None
-            imaging_failed_counter += 1
-            print(f"CB imaging failed. Counter: {imaging_failed_counter}")
+            with m.stage("acquire"):
+                if ae is not None:
+                    acquContext.run(ae.apply, block=True)
+                mesu = acquContext.run(lambda context: fetch_cubert_average(context, dark_cal, procContext), m, block=True)
+        except camera_supervisor.CameraUnavailable as e:
+            print(f"CB imaging failed. {e}")
+            break
 
 
         # Save Cubert image
         if mesu is not None:
-            mesu.set_name(img_name[:-4] + "_cubert")
-            procContext.apply(mesu)
-            print("Export CB image to multi-channel .tif...")
-            # get array from mesurement
-            data_array = np.array(mesu.data['cube'].array)
-            # dark subtraction
-            if do_dark_subtract_cb:
-                data_array = data_array.astype(float) - dark_cal.astype(float)
-                data_array = np.maximum(data_array, 0)
-            else:
-                data_array = data_array.astype(float)
-            # switch third (spectral) dimension to first dimension
-            data_array = data_array.transpose(2,0,1)
-            # crop cube
-            data_array = data_array[:, crop_cb[1][0]:crop_cb[1][1], crop_cb[0][0]:crop_cb[0][1]]
-            if snr(data_array) > 0.1:
-                # save as tif
-                path = os.path.join(cubert_image_folder, img_name[:-4] + "_cubert.tif")
-                tifffile.imwrite(path, data_array,  photometric='minisblack')
-                print(f"Saved CB image as tiff. (Shape: {data_array.shape}, Max: {np.max(data_array)}, Min: {np.min(data_array)}, Avg: {np.average(data_array)}, SNR: {snr(data_array)})")
-                saved = True
-                # end while loop
-                break
-            else:
+            raw_cube = mesu if isinstance(mesu, np.ndarray) else np.asarray(mesu.data['cube'].array)
+            saturation = exposure_feedback(raw_cube, ae, exposure_time_cb, crop_cb, auto_exposure.max_counts_cb, m, band_axis=2)
+            # Quality gate on a strided sample of the raw cube, rejected captures are retried before any processing
+            with m.stage("quality"):
+                dark = quality_gate.sample(dark_cal, crop_cb) if do_dark_subtract_cb else None
+                stats = quality_gate.sample_stats(quality_gate.sample(raw_cube, crop_cb), dark, auto_exposure.max_counts_cb, band_axis=2)
+                if ae is None:
+                    for note in quality_gate.evaluate(stats, quality_gate.exposure_checks):
+                        print(f"Keeping CB capture ({note}), the exposure is fixed.")
+                reasons = quality_gate.evaluate(stats, quality_gate.gate_checks(quality_checks_cb, ae is not None))
+            if reasons:
                 imaging_failed_counter += 1
-                print(f"CB image saving failed. Counter: {imaging_failed_counter}")
-        else:   
-            imaging_failed_counter += 1
-            print(f"CB image saving failed. Counter: {imaging_failed_counter}")
+                m.retries += 1
+                print(f"CB capture rejected ({'; '.join(reasons)}). Counter: {imaging_failed_counter}")
+                continue
+
+            if isinstance(mesu, np.ndarray):
+                # mean of several applied cubes
+                data_array = mesu
+            else:
+                with m.stage("apply"):
+                    mesu.set_name(img_name[:-4] + "_cubert")
+                    procContext.apply(mesu)
+                # get array from mesurement
+                data_array = np.asarray(mesu.data['cube'].array)
+            print("Export CB image to multi-channel .tif...")
+            # crop, dark subtraction and switching the third (spectral) dimension to the first one in one
+            # kernel, into a float32 buffer that is reused for the next capture
+            with m.stage("calibrate"):
+                data_array = cubert_kernel.process(data_array, dark_cal if do_dark_subtract_cb else None, crop_cb)
+            # save as tif
+            path = os.path.join(cubert_image_folder, img_name[:-4] + "_cubert.tif")
+            metadata = capture_metadata(img_name, "cb", data_array, settings)
+            with m.stage("write"):
+                storage.save_tiff(path, data_array, storage_dtype_cb, metadata, compression_cb, predictor_cb)
+                if saturation is not None:
+                    auto_exposure.save_saturation_mask(os.path.join(cubert_image_folder, img_name[:-4] + "_cubert_saturation.npz"), *saturation)
+            print(f"Saved CB image as tiff. (Shape: {data_array.shape}, {quality_gate.describe(metadata['stats'])})")
+            cubert_kernel.release(data_array)
+            saved = True
+            # end while loop
+            break
+    m.finish()
     if saved == False:
         # delete TL image
         try: 
             os.remove(os.path.join(thorlabs_image_folder, img_name[:-4] + "_thorlabs.tif"))
+            if os.path.exists(os.path.join(thorlabs_image_folder, img_name[:-4] + "_thorlabs_saturation.npz")):
+                os.remove(os.path.join(thorlabs_image_folder, img_name[:-4] + "_thorlabs_saturation.npz"))
             print("Deleted corresponding TL image because CB image saving failed.")
         except:
             print("TL image could not be deleted.")
-        
-
-## setup pygame and load images for the display
-def setup_pygame_display(X, Y, img_size_x, img_size_y, img_path):
+    return saved
+
+## add a saved pair with its display image, files, exposures and darks to the run manifest
+def record_pair(manifest, img_name, settings_tl, settings_cb):
+    paths = {"tl": os.path.join(thorlabs_image_folder, img_name[:-4] + "_thorlabs.tif"),
+             "cb": os.path.join(cubert_image_folder, img_name[:-4] + "_cubert.tif")}
+    if save_saturation_masks:
+        paths["tl_saturation"] = os.path.join(thorlabs_image_folder, img_name[:-4] + "_thorlabs_saturation.npz")
+        paths["cb_saturation"] = os.path.join(cubert_image_folder, img_name[:-4] + "_cubert_saturation.npz")
+    manifest.add(img_name, paths=paths, tl=settings_tl, cb=settings_cb, crop_tl=crop_tl, crop_cb=crop_cb)
+
+## setup pygame and the loader for the display images
+def setup_pygame_display(X, Y, img_size_x, img_size_y, img_path, skip=()):
     # Pygame and display setup
-    pygame.init()
-    try:
-        scrn = pygame.display.set_mode((X, Y), pygame.FULLSCREEN, display=1) # show on second monitor
-    except:
-        print("No second monitor available, using main monitor.")
-        scrn = pygame.display.set_mode((X, Y), pygame.FULLSCREEN)
-
-    def transformScaleKeepRatio(image, size):
-        iwidth, iheight = image.get_size()
-        scale = min(size[0] / iwidth, size[1] / iheight)
-        new_size = (round(iwidth * scale), round(iheight * scale))
-        scaled_image = pygame.transform.scale(image, new_size)
-        image_rect = scaled_image.get_rect(center = (size[0] // 2, size[1] // 2))
-        return scaled_image, image_rect
-
-    # Load images
-    images = []
-    filenames = sorted([f for f in os.listdir(img_path) if f.endswith('.jpg') | f.endswith('.png')], reverse=False)
-    print("Filenames:", filenames)
-    for name in filenames:
-        img = pygame.image.load(os.path.join(img_path, name))
-        images.append((*transformScaleKeepRatio(img, (img_size_x, img_size_y)), name))
-
-    return scrn, images
+    display = backends.open_display(display_backend, X, Y)
+
+    # Images are loaded and scaled on demand (with prefetching and an on-disk cache)
+    images = display_loader.DisplayImageLoader(img_path, img_size_x, img_size_y, skip=skip)
+    print(f"Found {len(images)} display images.")
+
+    return display, images
 
 ## display image on screen with pygame
-def display_image(img_disp, scrn):
+def display_image(img_disp, display):
     img_data, img_center, img_name = img_disp
     img_center.center = (display_x//2 + img_offset_x, display_y//2 + img_offset_y)
-    scrn.blit(img_data, img_center) # image data, image center
-    pygame.display.flip()
-    pygame.display.set_caption(img_name) # image name
+    flip_time = display.show(img_data, img_center, img_name)
     print(f"\nShowing image {img_name} on display.")
-    return img_name
-
-## calc SNR
-def snr(img, axis=None, ddof=0):
-    img = np.asanyarray(img)
-    m = img.mean(axis)
-    sd = img.std(axis=axis, ddof=ddof)
-    return np.where(sd == 0, 0, m/sd)
+    return img_name, flip_time
+
+## wait until the settle time after the flip has passed and optionally confirm the change on the TL cam
+# Returns the thumbnail of the confirming frame, which is the reference for the next image.
+def wait_for_display(flip_time, cam_tl, ref_thumb):
+    remaining = flip_time + display_settle_time * 1e-3 - time.monotonic()
+    if remaining > 0:
+        time.sleep(remaining)
+    if not confirm_display_change:
+        return None
+
+    t_start = time.monotonic()
+    while True:
+        try:
+            thumb = cam_tl.run(snap_check_frame)
+        except Exception as e:
+            print(f"Display check failed ({e!r}), capturing anyway.")
+            return None
+        if ref_thumb is None:
+            return thumb
+        change = np.mean(np.abs(thumb - ref_thumb)) / max(np.mean(ref_thumb), 1)
+        if change > confirm_threshold:
+            print(f"Display change confirmed after {(time.monotonic() - flip_time) * 1e3:.0f} ms (change {change:.3f}).")
+            return thumb
+        if time.monotonic() - t_start > confirm_timeout * 1e-3:
+            print(f"Display change not confirmed within {confirm_timeout} ms (change {change:.3f}), capturing anyway.")
+            return thumb
+
+## subsampled TL frame for the display check, taken with the short confirm_exposure
+# In stream mode the exposure is left alone (frames exposed with it are already in flight), a check
+# then costs the wait for the next frame.
+def snap_check_frame(cam):
+    if hasattr(cam, "get_burst"):
+        return cam.snap()[::confirm_stride, ::confirm_stride].astype(np.float32)
+    exposure = cam.get_exposure()
+    cam.set_exposure(confirm_exposure * 1e-3)
+    try:
+        return cam.snap()[::confirm_stride, ::confirm_stride].astype(np.float32)
+    finally:
+        cam.set_exposure(exposure)
+
+## capture settings and per-band statistics (from a strided sample) embedded in the TIFF description, indexed by dataset_index.py
+def capture_metadata(img_name, camera, img, settings=None):
+    capture = {"pair": img_name[:-4], "run": run_id, "display_image": img_name, "camera": camera, "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+               **(settings or {}), "crop": crop_tl if camera == "tl" else crop_cb}
+    if camera == "cb":
+        capture.update({"distance_mm": distance_cb, "wavelengths_nm": np.linspace(*wavelength_range_cb, len(img)).round(2).tolist()})
+    return {"capture": capture, "stats": quality_gate.summary(img)}
 
 ## Run main
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Show the display images and capture a pair for each of them.")
+    parser.add_argument("--resume", action="store_true", help="continue the run recorded in manifest_path")
+    resume = parser.parse_args().resume or resume
     main()
@@ -1,6 +1,8 @@
 import numpy as np
-import tifffile
-import os
+import storage
+import paired_dataset
+import dataset_index
+import quality_gate
 
 import matplotlib.pyplot as plt
 
@@ -24,63 +26,72 @@ def main():
 
 
 def show_crop():
-    print("Loading image paths.")
-    x_paths = sorted([os.path.join(TRAIN_DIR_X, f) for f in os.listdir(TRAIN_DIR_X)[20:23]])
-    y_paths = sorted([os.path.join(TRAIN_DIR_Y, f) for f in os.listdir(TRAIN_DIR_Y)[20:23]])
+    print("Loading image pairs.")
+    dataset = paired_dataset.PairedDataset(TRAIN_DIR_X, TRAIN_DIR_Y)[20:23]
 
     print("Cropping images to show.")
 
     x_imgs = []
     y_imgs = []
 
-    for i, (x_path, y_path) in enumerate(zip(x_paths, y_paths)): 
+    for i in range(len(dataset)):
         print(i)
-        x_imgs.append(do_crop_x(tifffile.imread(x_path)))
-        y_imgs.append(do_crop_y(tifffile.imread(y_path)))       
+        # only the shown plane / channel inside the crop is read
+        x_imgs.append(dataset.tl(i, 0, crop_x))
+        y_imgs.append(dataset.cb(i, 53, crop_y))
 
     print("Plotting.")
 
     plt.subplot(231)
-    plt.imshow(x_imgs[0][0])
+    plt.imshow(x_imgs[0])
     plt.subplot(232)
-    plt.imshow(y_imgs[0][53])
+    plt.imshow(y_imgs[0])
     plt.subplot(233)
-    plt.imshow(x_imgs[1][0])
+    plt.imshow(x_imgs[1])
     plt.subplot(234)
-    plt.imshow(y_imgs[1][53])
+    plt.imshow(y_imgs[1])
     plt.subplot(235)
-    plt.imshow(x_imgs[2][0])
+    plt.imshow(x_imgs[2])
     plt.subplot(236)
-    plt.imshow(y_imgs[2][53])
+    plt.imshow(y_imgs[2])
 
 
 def image_loop():
-    print("Loading image paths.")
-    # List available files in each folder
-    x_train = sorted([os.path.join(TRAIN_DIR_X, f) for f in os.listdir(TRAIN_DIR_X)])
-    y_train = sorted([os.path.join(TRAIN_DIR_Y, f) for f in os.listdir(TRAIN_DIR_Y)])
+    print("Loading image pairs.")
+    # Pairs of the folders matched by name
+    dataset = paired_dataset.PairedDataset(TRAIN_DIR_X, TRAIN_DIR_Y)
+    x_train = [dataset.tl_path(i) for i in range(len(dataset))]
+    y_train = [dataset.cb_path(i) for i in range(len(dataset))]
 
-    print(f"Dataset has {len(x_train)} X and {len(y_train)} Y images.")
-    if len(x_train) != len(y_train):
-        print("THAT'S BAD!")
+    print(f"Dataset has {len(dataset)} pairs.")
+    if len(dataset.unpaired) != 0:
+        print(f"THAT'S BAD! Images without a partner: {', '.join(dataset.unpaired)}")
 
     print("Dataset:")
     for i, (x_path, y_path) in enumerate(zip(x_train, y_train)):
         print("index:", i)
-        x_img = tifffile.imread(x_path)
-        y_img = tifffile.imread(y_path)
+        # cropping works on the stored values, so the images keep their on-disk dtype and scaling
+        x_img, x_description = storage.read_tiff_full(x_path)
+        y_img, y_description = storage.read_tiff_full(y_path)
 
         if verify_images: 
-            check_for_errors(i, x_img, y_img, x_path, y_path)
+            check_for_errors(i, x_img, y_img, x_path, y_path, x_description, y_description)
         if crop_all_images:
-            x_img, y_img = do_crop(x_img, y_img)
-        tifffile.imwrite(x_path, x_img)
-        tifffile.imwrite(y_path, y_img)
+            # Thorlabs images stored as raw mosaic keep a border for the demosaicing
+            x_img, x_description = storage.crop_thorlabs(x_img, x_description, crop_x)
+            y_img = do_crop_y(y_img)
+            # the embedded statistics describe the saved image, dataset_index.py picks them up on the next update
+            x_description = restat(x_img, x_description)
+            y_description = restat(y_img, y_description)
+            # rewritten with the compression, predictor and tiling they were saved with
+            storage.write_tiff(x_path, x_img, x_description.get("storage"), x_description, **storage.read_codec(x_path))
+            storage.write_tiff(y_path, y_img, y_description.get("storage"), y_description, **storage.read_codec(y_path))
     print("Image loop done.")
 
 
-def check_for_errors(i, x_img, y_img, x_path, y_path):
-    if y_path.split('/')[-1].split('_')[0] != x_path.split('/')[-1].split('_')[0]:
+def check_for_errors(i, x_img, y_img, x_path, y_path, x_description=None, y_description=None):
+    # pair names embedded at capture, older files fall back to the file names
+    if dataset_index.pair_name(y_path, y_description or {}) != dataset_index.pair_name(x_path, x_description or {}):
         print(f"Image index {i}: ")
         print(f"X ({x_path}) and Y ({y_path}) are probably not the same image.")
 
@@ -92,6 +103,11 @@ def check_for_errors(i, x_img, y_img, x_path, y_path):
     if y_nan != 0:
         print(f"Y image {i} ({y_path}) contains {y_nan} nan values.")   
 
+def restat(stored, description):
+    if "stats" not in description:
+        return description
+    return {**description, "stats": quality_gate.summary(storage.decode(stored, description.get("storage")))}
+
 def do_crop(x, y):
     x = x[:, crop_x[1][0]:crop_x[1][1], crop_x[0][0]:crop_x[0][1]]
     y = y[:, crop_y[1][0]:crop_y[1][1], crop_y[0][0]:crop_y[0][1]]
@@ -1,31 +1,17 @@
 import os
-import platform
 import sys
 import time
 from datetime import timedelta
-import cuvis
 import numpy as np
 
-def do_dark_calibration(exp_time = 16, n_frames = 10, dist = 6000):
+import backends
+import frame_averaging
 
-    print("REMEMBER TO PUT THE CAP ON.")
-
-    # Default directories and files:
-    data_dir = None
-    lib_dir = None
-
-    if platform.system() == "Windows":
-        lib_dir = os.getenv("CUVIS")
-        data_dir = os.path.normpath(os.path.join(lib_dir, os.path.pardir, "sdk", "sample_data", "set_examples"))
-    elif platform.system() == "Linux":
-        lib_dir = os.getenv("CUVIS_DATA")
-        data_dir = os.path.normpath(os.path.join(lib_dir, "sample_data", "set_examples"))
+def do_dark_calibration(exp_time = 16, n_frames = 10, dist = 6000, backend = "hardware"):
 
-    # Default factory directory:
-    factory_dir = os.path.join(lib_dir, os.pardir, "factory")
+    print("REMEMBER TO PUT THE CAP ON.")
 
-    # Default settings and output directories:
-    userSettingsDir = os.path.join(data_dir, "settings")
+    # Default output directory:
     recDir = os.path.join(os.getcwd(), "images", "calibration", "cubert_dark")
 
     # Parameters
@@ -34,47 +20,29 @@ def do_dark_calibration(exp_time = 16, n_frames = 10, dist = 6000):
     n_calibration_frames = n_frames
 
     # Start camera
-    print("Loading user settings...")
-    settings = cuvis.General(userSettingsDir)
-    settings.set_log_level("info")
-
-    print("Loading calibration, processing, and acquisition context (factory)...")
-    calibration = cuvis.Calibration(factory_dir)
-    processingContext = cuvis.ProcessingContext(calibration)
-    acquisitionContext = cuvis.AcquisitionContext(calibration)
-
-    saveArgs = cuvis.SaveArgs(export_dir=recDir, allow_overwrite=True, allow_session_file=True)
-    cubeExporter = cuvis.CubeExporter(saveArgs)
-
-    # Wait for camera to come online
-    while acquisitionContext.state == cuvis.HardwareState.Offline:
-        print(".", end="")
-        time.sleep(1)
-    print("\nCamera is online")
+    acquisitionContext, processingContext, cubeExporter = backends.open_cubert(backend, export_dir=recDir)
+    if backend == "simulated":
+        acquisitionContext.lens_cap = True
 
     # Set acquisition context parameters
-    acquisitionContext.operation_mode = cuvis.OperationMode.Software
     acquisitionContext.integration_time = exposure
     processingContext.calc_distance(distance)
 
-    data_arrays = []
-
-    # Take pictures
-    i = 0
-    while i < n_calibration_frames:
-        print(f"Image recording... {i}")
+    # Take pictures and average them into a running mean
+    average = None
+    while average is None or average.n < n_calibration_frames:
+        print(f"Image recording... {0 if average is None else average.n}")
         am = acquisitionContext.capture()
         m, r = am.get(timedelta(milliseconds=1000))
         if m is not None:
             processingContext.apply(m)
-            data_arrays.append(np.array(m.data['cube'].array))
-            i += 1
+            data_array = np.array(m.data['cube'].array)
+            if average is None:
+                average = frame_averaging.RunningMean(data_array.shape)
+            average.add(data_array)
         else:
             print("Imaging failed. Trying again.")
-
-    # Stack the data arrays along a new axis and compute the average
-    stacked_data = np.stack(data_arrays, axis=0)
-    average_data = np.mean(stacked_data, axis=0)
+    average_data = average.mean
 
     # Print the shape of the averaged data
     print("Shape of Master Dark:", average_data.shape)
@@ -0,0 +1,46 @@
+import time
+from collections import deque
+
+import capture_workers
+
+
+## Cubert acquisition that keeps captures in flight while the previous measurement is processed
+# capture() issues a new capture and hands out the oldest outstanding one, so the camera is already
+# exposing the next cube while the caller runs am.get(), procContext.apply() and the export.
+# Measurements are returned in the order they were triggered. Only use this when the scene does not
+# change between captures (e.g. create_dataset), because the next cube is exposed before the caller
+# asks for it. The monotonic trigger time of the returned capture is last_trigger and is reported to
+# the capture worker (capture_workers.report_trigger), so the skew telemetry and the manifest show when
+# the cube was actually exposed. Attribute access (state, integration_time, ...) is passed through to
+# the context.
+class OverlappedCubertAcquisition:
+    def __init__(self, acquContext, n_in_flight=1):
+        object.__setattr__(self, "context", acquContext)
+        object.__setattr__(self, "n_in_flight", n_in_flight)
+        object.__setattr__(self, "pending", deque())
+        object.__setattr__(self, "last_trigger", None)
+        # the camera has to queue the outstanding captures plus the one being fetched
+        acquContext.queue_size = max(acquContext.queue_size, self.n_in_flight + 1)
+
+    def capture(self):
+        while len(self.pending) < self.n_in_flight + 1:
+            self.pending.append((self.context.capture(), time.monotonic()))
+        am, t_trigger = self.pending.popleft()
+        object.__setattr__(self, "last_trigger", t_trigger)
+        capture_workers.report_trigger(t_trigger)
+        return am
+
+    # wait for and throw away all outstanding captures (e.g. after the scene or the exposure changed)
+    def flush(self, timeout):
+        while self.pending:
+            am, _ = self.pending.popleft()
+            try:
+                am.get(timeout)
+            except Exception:
+                pass
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.context, name, value)
@@ -0,0 +1,166 @@
+import argparse
+import json
+import os
+import sqlite3
+import time
+
+import tifffile
+
+## Parameters
+db_path = "images/index.sqlite"
+folders = ("images/thorlabs", "images/cubert")
+
+schema_version = 2  # an index of another version is rebuilt from the files
+schema = """
+CREATE TABLE IF NOT EXISTS images (
+    path TEXT PRIMARY KEY, mtime REAL, size INTEGER, run TEXT, pair TEXT, camera TEXT, exposure_ms REAL, dark TEXT,
+    distance_mm REAL, crop TEXT, mean REAL, std REAL, snr REAL, min REAL, max REAL, dtype TEXT, shape TEXT, metadata TEXT);
+CREATE INDEX IF NOT EXISTS images_pair ON images (run, pair, camera);
+CREATE INDEX IF NOT EXISTS images_exposure ON images (camera, exposure_ms);
+CREATE TABLE IF NOT EXISTS bands (
+    path TEXT REFERENCES images (path) ON DELETE CASCADE, band INTEGER, wavelength_nm REAL, mean REAL, std REAL, snr REAL,
+    PRIMARY KEY (path, band));
+CREATE VIEW IF NOT EXISTS pairs AS SELECT tl.run AS run, tl.pair AS pair, tl.path AS tl_path, cb.path AS cb_path,
+    tl.exposure_ms AS tl_exposure_ms, cb.exposure_ms AS cb_exposure_ms, tl.dark AS tl_dark, cb.dark AS cb_dark,
+    cb.distance_mm AS distance_mm, tl.crop AS tl_crop, cb.crop AS cb_crop,
+    tl.mean AS tl_mean, tl.std AS tl_std, tl.snr AS tl_snr, tl.min AS tl_min, tl.max AS tl_max,
+    cb.mean AS cb_mean, cb.std AS cb_std, cb.snr AS cb_snr, cb.min AS cb_min, cb.max AS cb_max
+    FROM images tl JOIN images cb ON tl.run = cb.run AND tl.pair = cb.pair AND tl.camera = 'tl' AND cb.camera = 'cb';
+"""
+
+
+## SQLite index of the dataset TIFFs, built from the capture settings and statistics the writers embed in
+# the image description (see capture_metadata in create_dataset.py). Only the TIFF headers are read, never
+# pixel data, and update() only re-reads files whose mtime or size changed. images has one row per file,
+# bands the per-band statistics and wavelengths, the view pairs one row per TL / Cubert pair of the same
+# run with the columns of both prefixed tl_ and cb_. Files written before the metadata existed are indexed
+# with the pair and camera from their name, the folder above the image folder as run and without
+# settings or statistics.
+def connect(db=None):
+    db = db_path if db is None else db
+    os.makedirs(os.path.dirname(db) or ".", exist_ok=True)
+    connection = sqlite3.connect(db)
+    connection.execute("PRAGMA foreign_keys = ON")
+    if connection.execute("PRAGMA user_version").fetchone()[0] != schema_version:
+        connection.executescript("DROP VIEW IF EXISTS pairs; DROP TABLE IF EXISTS bands; DROP TABLE IF EXISTS images;")
+        connection.execute(f"PRAGMA user_version = {schema_version}")
+    connection.executescript(schema)
+    return connection
+
+
+## name of the pair of a TIFF, from its description or else from the file name (<pair>_thorlabs.tif, <pair>_cubert.tif)
+def pair_name(path, description=None):
+    if description is None:
+        description = read_description(path)[0]
+    pair = description.get("capture", {}).get("pair")
+    if pair is not None:
+        return str(pair)
+    name = os.path.basename(path)
+    for suffix in ("_thorlabs.tif", "_cubert.tif"):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name.split("_")[0]
+
+
+## run of a TIFF, from its description or else the folder above its image folder (<run>/thorlabs, <run>/cubert)
+def run_name(path, description):
+    run = description.get("capture", {}).get("run")
+    if run is not None:
+        return str(run)
+    return os.path.dirname(os.path.dirname(os.path.abspath(path)))
+
+
+## description, stored dtype and shape of a TIFF, from the header only
+def read_description(path):
+    with tifffile.TiffFile(path) as tif:
+        shaped = tif.shaped_metadata
+        series = tif.series[0]
+        return (shaped[0] if shaped else {}), series.dtype.name, list(series.shape)
+
+
+## images and bands rows of a TIFF
+def index_rows(path, stat):
+    description, dtype, shape = read_description(path)
+    capture = description.get("capture", {})
+    stats = description.get("stats", {})
+    camera = capture.get("camera") or ("tl" if path.endswith("_thorlabs.tif") else "cb")
+    crop = capture.get("crop")
+    image = (path, stat.st_mtime, stat.st_size, run_name(path, description), pair_name(path, description), camera, capture.get("exposure_ms"),
+             capture.get("dark"), capture.get("distance_mm"), None if crop is None else json.dumps(crop),
+             stats.get("mean"), stats.get("std"), stats.get("snr"), stats.get("min"), stats.get("max"),
+             (description.get("storage") or {}).get("dtype", dtype), json.dumps(shape), json.dumps(description))
+    wavelengths = capture.get("wavelengths_nm") or []
+    bands = [(path, band, wavelengths[band] if band < len(wavelengths) else None, mean, std, snr)
+             for band, (mean, std, snr) in enumerate(zip(stats.get("band_mean", []), stats.get("band_std", []), stats.get("band_snr", [])))]
+    return image, bands
+
+
+## bring the index up to date with the TIFFs in the folders: new and changed files are (re)indexed, rows of
+# removed files of the folders deleted, all in one transaction
+def update(folders=folders, db=None):
+    t_start = time.perf_counter()
+    connection = connect(db)
+    known = {path: (mtime, size) for path, mtime, size in connection.execute("SELECT path, mtime, size FROM images")}
+    folders = [os.path.normpath(folder) for folder in folders]
+    seen = set()
+    changed = 0
+    with connection:
+        for folder in folders:
+            for f in sorted(os.listdir(folder)):
+                if not (f.endswith("_thorlabs.tif") or f.endswith("_cubert.tif")):
+                    continue
+                path = os.path.join(folder, f)
+                stat = os.stat(path)
+                seen.add(path)
+                if known.get(path) == (stat.st_mtime, stat.st_size):
+                    continue
+                try:
+                    image, bands = index_rows(path, stat)
+                except Exception as e:
+                    print(f"Skipping {path}: {e}")
+                    continue
+                connection.execute("DELETE FROM images WHERE path = ?", (path,))
+                connection.execute(f"INSERT INTO images VALUES ({', '.join('?' * len(image))})", image)
+                connection.executemany("INSERT INTO bands VALUES (?, ?, ?, ?, ?, ?)", bands)
+                changed += 1
+        # only files of the given folders, other folders keep their rows
+        removed = [path for path in known if path not in seen and os.path.dirname(path) in folders]
+        connection.executemany("DELETE FROM images WHERE path = ?", [(path,) for path in removed])
+    connection.close()
+    print(f"Index {db_path if db is None else db}: {changed} files (re)indexed, {len(removed)} removed, "
+          f"{len(seen) - changed} unchanged in {time.perf_counter() - t_start:.2f} s.")
+    return changed, len(removed)
+
+
+## rows of the pairs view matching an SQL condition, e.g. "cb_exposure_ms = ? AND cb_snr > ?" with params (500, 5)
+def query(where="1", params=(), db=None, table="pairs"):
+    connection = connect(db)
+    connection.row_factory = sqlite3.Row
+    rows = [dict(row) for row in connection.execute(f"SELECT * FROM {table} WHERE {where} ORDER BY pair", params)]
+    connection.close()
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SQLite index of the dataset TIFF metadata.")
+    parser.add_argument("--db", default=db_path)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    update_parser = subparsers.add_parser("update", help="index new and changed TIFFs, drop removed ones")
+    update_parser.add_argument("folders", nargs="*", default=list(folders))
+    query_parser = subparsers.add_parser("query", help="list the pairs matching an SQL condition")
+    query_parser.add_argument("where", help='e.g. "cb_exposure_ms = 500 AND cb_snr > 5"')
+    query_parser.add_argument("--table", default="pairs", choices=("pairs", "images"))
+    args = parser.parse_args()
+
+    if args.command == "update":
+        update(args.folders, args.db)
+    elif args.command == "query":
+        t_start = time.perf_counter()
+        rows = query(args.where, db=args.db, table=args.table)
+        elapsed = time.perf_counter() - t_start
+        for row in rows:
+            if args.table == "pairs":
+                print(f"{row['run']} {row['pair']}: TL {row['tl_exposure_ms']} ms SNR {row['tl_snr']}, CB {row['cb_exposure_ms']} ms SNR {row['cb_snr']}")
+            else:
+                print(f"{row['path']}: {row['camera']} {row['exposure_ms']} ms SNR {row['snr']}")
+        print(f"{len(rows)} rows in {elapsed * 1000:.1f} ms.")
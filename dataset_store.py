@@ -0,0 +1,238 @@
+import argparse
+import json
+import os
+import threading
+
+import numpy as np
+
+import storage
+
+# h5py is only needed for the single-file dataset store
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+## Parameters
+chunk_px = 512        # spatial chunk size, every chunk holds one band of one pair
+compression = None    # HDF5 filter of the image datasets: None, "gzip" or "lzf"
+shuffle = True        # byte shuffle before compressing
+names_chunk = 1024    # pairs per chunk of the name and metadata datasets
+cameras = ("tl", "cb")  # a row is written once the images of all of them arrived
+
+
+## single HDF5 file holding a paired dataset along a sample axis
+# /tl and /cb are (pairs, ...) image datasets chunked per pair and band (and chunk_px tiles), so one
+# pair, one band of it or a window are read on their own and consecutive pairs lie next to each other
+# in the file. /names holds the pair names, /pairs one JSON record per pair with the storage metadata
+# of the images (dtype, uint16 offset/scale, Thorlabs layout) and the exposures, darks and crops.
+# Images are stored in the on-disk dtypes of storage.py. A pair is a row: the cameras are handed to
+# write() separately, kept in memory and written to the row of their name in one go once all cameras
+# arrived, so a failed capture (discard()) or a crash never leaves a half row. Writing a name again
+# overwrites its row (re-taken pairs on resume). The file is flushed after every row. Opening only
+# reads the names. Rows without all cameras (written before pairs were buffered) are skipped by read_rows.
+class DatasetStore:
+    def __init__(self, path, mode="a"):
+        if h5py is None:
+            raise ImportError("The dataset store needs h5py (pip install h5py).")
+        self.path = path
+        if mode != "r":
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = h5py.File(path, mode)
+        self._lock = threading.Lock()
+        self._rows = None
+        self._pending = {}
+
+    def __len__(self):
+        return self._file.attrs.get("count", 0)
+
+    # names of all pairs, in row order
+    @property
+    def names(self):
+        if "names" not in self._file:
+            return []
+        return [name.decode() for name in self._file["names"][:len(self)]]
+
+    # row of a pair (KeyError if it is not in the store)
+    def row(self, name):
+        with self._lock:
+            return self._row_index()[name]
+
+    # image of one camera ("tl" or "cb") of a pair, stored with storage.encode(image, dtype) once the
+    # other cameras of the pair arrived. metadata goes into the pair record next to the storage metadata
+    # (e.g. storage.mosaic_metadata). Raises ValueError if the pair does not fit the store.
+    def write(self, name, camera, image, dtype="float32", metadata=None):
+        stored, meta = storage.encode(image, dtype)
+        if np.shares_memory(stored, image):
+            # the caller may reuse its buffer before the pair is complete
+            stored = stored.copy()
+        with self._lock:
+            parts = self._pending.setdefault(name, {})
+            parts[camera] = (stored, {**(metadata or {}), "storage": meta})
+            if any(c not in parts for c in cameras):
+                return
+            del self._pending[name]
+            datasets = {c: self._dataset(c, parts[c][0]) for c in cameras}
+            # images first, the row only counts once the name is written
+            row = self._row_index().get(name, len(self))
+            for c in cameras:
+                if datasets[c].shape[0] <= row:
+                    datasets[c].resize(row + 1, axis=0)
+                datasets[c][row] = parts[c][0]
+            row = self._allocate(name)
+            self._update_record(row, {c: parts[c][1] for c in cameras})
+            self._file.flush()
+
+    # drop the images of a pair that was not completed (e.g. the other capture failed)
+    def discard(self, name):
+        with self._lock:
+            self._pending.pop(name, None)
+
+    # True if all cameras of the row were written
+    def is_complete(self, row):
+        record = self.record(row)
+        return all(c in record for c in cameras)
+
+    # add entries (exposures, darks, crops ...) to the record of a pair
+    def annotate(self, name, **record):
+        with self._lock:
+            self._update_record(self._allocate(name), record)
+            self._file.flush()
+
+    # metadata record of a pair by row
+    def record(self, row):
+        return json.loads(self._file["pairs"][row])
+
+    # float32 image of one camera of a pair (by row), optionally only some bands and the window crop
+    # ((x0, x1), (y0, y1)). Thorlabs images come as (5, h, w) planes, or one plane with angle.
+    def read(self, camera, row, bands=None, crop=None, angle=None):
+        dataset = self._file[camera]
+        description = self.record(row)[camera]
+        read = lambda bands, window: _read_sample(dataset, row, bands, window)
+        if camera == "tl":
+            return storage.thorlabs_window(read, dataset.shape[1:], description, angle, crop)
+        return storage.decode(read(bands, crop), description["storage"])
+
+    # float32 Thorlabs planes and Cubert cube of a pair (KeyError if the row is incomplete)
+    def read_pair(self, row):
+        if not self.is_complete(row):
+            raise KeyError(f"Pair {self.names[row]} (row {row}) is incomplete.")
+        return self.read("tl", row), self.read("cb", row)
+
+    # float32 images of one camera for the complete rows from start to stop, in one contiguous read
+    # returns the names of those rows and the images
+    def read_rows(self, camera, start, stop):
+        stored = self._file[camera][start:stop]
+        names = self.names
+        images = []
+        read_names = []
+        for row, sample in zip(range(start, stop), stored):
+            if not self.is_complete(row):
+                continue
+            read_names.append(names[row])
+            description = self.record(row)[camera]
+            read = lambda bands, window, sample=sample: _read_sample(sample[None], 0, bands, window)
+            if camera == "tl":
+                images.append(storage.thorlabs_window(read, sample.shape, description))
+            else:
+                images.append(storage.decode(sample, description["storage"]))
+        return read_names, images
+
+    def close(self):
+        with self._lock:
+            for name in self._pending:
+                print(f"Dataset store: pair {name} incomplete (got {', '.join(self._pending[name])}), not saved.")
+            self._pending.clear()
+            self._file.close()
+
+    def _row_index(self):
+        if self._rows is None:
+            self._rows = {name: row for row, name in enumerate(self.names)}
+        return self._rows
+
+    # row of a name, appended as a new row if it is not in the store yet
+    def _allocate(self, name):
+        rows = self._row_index()
+        if name in rows:
+            return rows[name]
+        row = len(self)
+        for key, dtype in (("names", h5py.string_dtype()), ("pairs", h5py.string_dtype())):
+            if key not in self._file:
+                self._file.create_dataset(key, (0,), dtype=dtype, maxshape=(None,), chunks=(names_chunk,))
+            if self._file[key].shape[0] <= row:
+                self._file[key].resize(row + 1, axis=0)
+        self._file["names"][row] = name
+        self._file["pairs"][row] = json.dumps({"name": name})
+        self._file.attrs["count"] = row + 1
+        rows[name] = row
+        return row
+
+    def _update_record(self, row, record):
+        self._file["pairs"][row] = json.dumps({**self.record(row), **record})
+
+    # image dataset of a camera, created for the shape and dtype of its first image
+    def _dataset(self, camera, stored):
+        if camera not in self._file:
+            chunks = (1,) + (1,) * (stored.ndim - 2) + tuple(min(n, chunk_px) for n in stored.shape[-2:])
+            return self._file.create_dataset(camera, (0,) + stored.shape, dtype=stored.dtype, maxshape=(None,) + stored.shape,
+                                             chunks=chunks, compression=compression, shuffle=shuffle and compression is not None)
+        dataset = self._file[camera]
+        if dataset.shape[1:] != stored.shape or dataset.dtype != stored.dtype:
+            raise ValueError(f"{camera} image {stored.shape} {stored.dtype} does not match the store ({dataset.shape[1:]} {dataset.dtype}), "
+                             "use one store per crop and storage dtype.")
+        return dataset
+
+
+## stored (bands, h, w) window ((x0, x1), (y0, y1)) of one pair of an image dataset (or a stack of
+# samples in memory), cut at the border, 2D images come as (1, h, w)
+def _read_sample(dataset, row, bands, window):
+    height, width = dataset.shape[-2:]
+    (x0, x1), (y0, y1) = ((0, width), (0, height)) if window is None else window
+    y, x = slice(max(y0, 0), min(y1, height)), slice(max(x0, 0), min(x1, width))
+    if dataset.ndim == 3:
+        return dataset[row, y, x][None]
+    if bands is None:
+        return dataset[row, :, y, x]
+    # h5py only selects increasing indices
+    order = sorted(set(bands))
+    return dataset[row, order, y, x][[order.index(band) for band in bands]]
+
+
+## copy the loose TIFF pairs of a thorlabs and a cubert folder (matched by name prefix) into a store
+def pack(thorlabs_folder, cubert_folder, path):
+    tl_files = {f.split("_")[0]: f for f in os.listdir(thorlabs_folder) if f.endswith("_thorlabs.tif")}
+    cb_files = {f.split("_")[0]: f for f in os.listdir(cubert_folder) if f.endswith("_cubert.tif")}
+    names = sorted(tl_files.keys() & cb_files.keys())
+    print(f"Packing {len(names)} pairs into {path}...")
+    store = DatasetStore(path)
+    skipped = 0
+    for name in names:
+        images = []
+        for camera, folder, f in (("tl", thorlabs_folder, tl_files[name]), ("cb", cubert_folder, cb_files[name])):
+            stored, description = storage.read_tiff_full(os.path.join(folder, f))
+            meta = description.pop("storage", None)
+            description.pop("shape", None)
+            # re-encoded in the dtype they are stored in
+            images.append((camera, storage.decode(stored, meta), "float32" if meta is None else meta["dtype"], description))
+        try:
+            for camera, image, dtype, description in images:
+                store.write(name, camera, image, dtype, description)
+        except ValueError as e:
+            store.discard(name)
+            skipped += 1
+            print(f"Skipping pair {name}: {e}")
+    store.close()
+    print(f"Done, {skipped} pairs skipped.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Single-file HDF5 store of the paired dataset.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    pack_parser = subparsers.add_parser("pack", help="copy loose TIFF pairs into a store")
+    pack_parser.add_argument("thorlabs_folder")
+    pack_parser.add_argument("cubert_folder")
+    pack_parser.add_argument("path")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        pack(args.thorlabs_folder, args.cubert_folder, args.path)
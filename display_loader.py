@@ -0,0 +1,103 @@
+import hashlib
+import os
+import queue
+import threading
+
+## Parameters
+prefetch = 4                      # images loaded ahead of the one currently shown
+cache_folder_name = ".scaled_cache"  # created inside the display image folder
+
+_DONE = object()
+
+
+## scale image to fit into size while keeping the aspect ratio
+def transformScaleKeepRatio(image, size):
+    # pygame is only needed where surfaces are built, the hash and cache helpers work without it
+    import pygame
+    iwidth, iheight = image.get_size()
+    scale = min(size[0] / iwidth, size[1] / iheight)
+    new_size = (round(iwidth * scale), round(iheight * scale))
+    scaled_image = pygame.transform.scale(image, new_size)
+    image_rect = scaled_image.get_rect(center = (size[0] // 2, size[1] // 2))
+    return scaled_image, image_rect
+
+
+## hash of the file content, used as cache key
+def file_hash(path):
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+## streams the display images in order, prefetching a few in a background thread
+# Scaled images are kept in an on-disk cache keyed by the hash of the source file and the target size,
+# so every image is only decoded and rescaled once, no matter how often a dataset run is restarted.
+# Iterating yields (scaled_image, image_rect, name) tuples like the old list of preloaded images.
+# Names in skip (e.g. the images a resumed run already captured) are left out.
+class DisplayImageLoader:
+    def __init__(self, img_path, img_size_x, img_size_y, prefetch=None, cache_dir=None, skip=()):
+        self.img_path = img_path
+        self.size = (img_size_x, img_size_y)
+        self.prefetch = globals()["prefetch"] if prefetch is None else prefetch
+        self.cache_dir = os.path.join(img_path, cache_folder_name) if cache_dir is None else cache_dir
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.filenames = sorted([f for f in os.listdir(img_path) if f.endswith('.jpg') | f.endswith('.png')], reverse=False)
+        self.filenames = [f for f in self.filenames if f not in skip]
+
+    def __len__(self):
+        return len(self.filenames)
+
+    # load one image, from the cache if it was scaled before
+    def load(self, name):
+        import pygame
+        path = os.path.join(self.img_path, name)
+        cache_path = os.path.join(self.cache_dir, f"{file_hash(path)}_{round(self.size[0])}x{round(self.size[1])}.png")
+        if os.path.exists(cache_path):
+            scaled_image = pygame.image.load(cache_path)
+            image_rect = scaled_image.get_rect(center = (self.size[0] // 2, self.size[1] // 2))
+        else:
+            scaled_image, image_rect = transformScaleKeepRatio(pygame.image.load(path), self.size)
+            # write to a temporary file first so an interrupted run never leaves a broken cache entry
+            tmp_path = cache_path[:-4] + f".{threading.get_ident()}.tmp.png"
+            pygame.image.save(scaled_image, tmp_path)
+            os.replace(tmp_path, cache_path)
+        return scaled_image, image_rect, name
+
+    def __iter__(self):
+        loaded = queue.Queue(maxsize=max(self.prefetch, 1))
+        stop = threading.Event()
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    loaded.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def prefetch_loop():
+            for name in self.filenames:
+                try:
+                    item = self.load(name)
+                except Exception as e:
+                    item = e
+                if not put(item):
+                    return
+            put(_DONE)
+
+        thread = threading.Thread(target=prefetch_loop, name="display-prefetch", daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = loaded.get()
+                if item is _DONE:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            stop.set()
+            thread.join()
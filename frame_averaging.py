@@ -0,0 +1,76 @@
+import numpy as np
+
+## Parameters
+max_frames = 64  # upper limit of the adaptive mode
+min_frames = 3   # frames before the SNR is trusted in the adaptive mode
+
+
+## running mean and variance of a frame sequence (Welford), in place in float32 accumulators
+# Memory is four frames, independent of the number of frames averaged.
+class RunningMean:
+    def __init__(self, shape):
+        self.n = 0
+        self.mean = np.zeros(shape, dtype=np.float32)
+        self.m2 = np.zeros(shape, dtype=np.float32)
+        self._delta = np.empty(shape, dtype=np.float32)
+        self._delta_new = np.empty(shape, dtype=np.float32)
+
+    def add(self, frame):
+        self.n += 1
+        np.subtract(frame, self.mean, out=self._delta, casting="unsafe")
+        np.divide(self._delta, np.float32(self.n), out=self._delta_new)
+        self.mean += self._delta_new
+        # m2 += (frame - old mean) * (frame - new mean)
+        np.subtract(frame, self.mean, out=self._delta_new, casting="unsafe")
+        self._delta *= self._delta_new
+        self.m2 += self._delta
+
+    # per pixel variance of the single frames
+    def variance(self, ddof=1):
+        if self.n <= ddof:
+            return np.zeros_like(self.m2)
+        return self.m2 / np.float32(self.n - ddof)
+
+    # SNR of the averaged frame in roi ((x0, x1), (y0, y1) on the last two axes, None = everything)
+    # signal is the mean above the dark level, noise the standard error of the mean
+    def snr(self, roi=None, dark=0.0):
+        if self.n < 2:
+            return 0.0
+        index = (Ellipsis,) if roi is None else (Ellipsis, slice(*roi[1]), slice(*roi[0]))
+        signal = np.mean(self.mean[index], dtype=np.float64) - np.mean(np.asarray(dark)[index] if np.ndim(dark) else dark)
+        noise = np.sqrt(np.mean(self.m2[index], dtype=np.float64) / (self.n - 1) / self.n)
+        return float(signal / noise) if noise > 0 else float("inf")
+
+
+## average frames from next_frame() until n_frames were taken, or, with target_snr, until the SNR in
+# roi reaches it (between min_frames and max_frames). Returns the RunningMean.
+def average_frames(next_frame, n_frames=1, target_snr=None, roi=None, dark=0.0, max_n=None):
+    max_n = (max_frames if target_snr is not None else n_frames) if max_n is None else max_n
+    acc = None
+    while acc is None or acc.n < max_n:
+        frame = next_frame()
+        if acc is None:
+            acc = RunningMean(frame.shape)
+        acc.add(frame)
+        if target_snr is None:
+            continue
+        if acc.n >= min_frames and acc.snr(roi, dark) >= target_snr:
+            break
+    return acc
+
+
+## frames of a Thorlabs cam or ThorlabsStream, back to back from the ring buffer when streaming
+def thorlabs_frames(cam):
+    if not hasattr(cam, "get_burst"):
+        return cam.snap
+    state = {"index": None, "out": None}
+
+    def next_frame():
+        if state["index"] is None:
+            frames, state["index"] = cam.get_burst(1)
+            state["out"] = frames
+        else:
+            state["index"] += 1
+            cam.get_frames(state["index"], 1, out=state["out"])
+        return state["out"][0]
+    return next_frame
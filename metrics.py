@@ -0,0 +1,168 @@
+import argparse
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import numpy as np
+
+## Parameters
+histogram_bins = 10
+histogram_width = 40  # characters of the longest bar
+max_records = 10000   # finished records kept in memory (the log file keeps all of them)
+
+_lock = threading.Lock()
+
+# latest finished capture records of this process
+records = deque(maxlen=max_records)
+
+# JSONL file every finished record is appended to (None = only keep them in memory)
+log_path = None
+
+
+## per-stage durations of one capture (one camera, one image)
+# The record travels with the image through capture, processing and writing, so the stages can run
+# in different threads. Durations of a stage that runs several times (e.g. on retries) add up.
+class CaptureMetrics:
+    def __init__(self, camera, img_name):
+        self.camera = camera
+        self.img_name = img_name
+        self.t_start = time.time()
+        self.stages = {}
+        self.retries = 0
+
+    @contextmanager
+    def stage(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - t0
+
+    def finish(self):
+        with _lock:
+            records.append(self)
+            if log_path is not None:
+                # a failing log must not stop the capture loop
+                try:
+                    with open(log_path, "a") as f:
+                        f.write(json.dumps(self.to_dict()) + "\n")
+                except OSError as e:
+                    print(f"Metrics: could not append to {log_path} ({e!r}).")
+
+    def to_dict(self):
+        return {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.t_start)),
+            "camera": self.camera,
+            "img_name": self.img_name,
+            "retries": self.retries,
+            "saved": "write" in self.stages,
+            "stages_ms": {stage: seconds * 1e3 for stage, seconds in self.stages.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        rec = cls(d["camera"], d["img_name"])
+        rec.t_start = time.mktime(time.strptime(d["time"], "%Y-%m-%dT%H:%M:%S"))
+        rec.retries = d["retries"]
+        rec.stages = {stage: ms * 1e-3 for stage, ms in d["stages_ms"].items()}
+        return rec
+
+
+## append every finished record to a JSONL file from now on (None to stop logging)
+def open_log(path):
+    global log_path
+    if path is not None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with _lock:
+        log_path = path
+
+
+## forget all records
+def reset():
+    with _lock:
+        records.clear()
+
+
+## records of a JSONL metrics file
+def load(path):
+    with open(path) as f:
+        return [CaptureMetrics.from_dict(json.loads(line)) for line in f if line.strip()]
+
+
+## all durations of every (camera, stage) in ms
+def stage_durations(recs=None):
+    durations = {}
+    for rec in records if recs is None else recs:
+        for stage, seconds in rec.stages.items():
+            durations.setdefault((rec.camera, stage), []).append(seconds * 1e3)
+    return durations
+
+
+## latency percentiles per (camera, stage) in ms
+def stage_percentiles(recs=None, percentiles=(50, 90, 99)):
+    stats = {}
+    for (camera, stage), values in sorted(stage_durations(recs).items()):
+        values = np.asarray(values)
+        stats[f"{camera}/{stage}"] = {
+            "n": len(values),
+            "mean": float(np.mean(values)),
+            **{f"p{p}": float(np.percentile(values, p)) for p in percentiles},
+        }
+    return stats
+
+
+## text histogram of durations in ms
+def print_histogram(values, bins=None):
+    counts, edges = np.histogram(values, bins=histogram_bins if bins is None else bins)
+    scale = histogram_width / max(counts.max(), 1)
+    for count, low, high in zip(counts, edges[:-1], edges[1:]):
+        print(f"  {low:9.1f} - {high:9.1f} ms |{'#' * int(round(count * scale)):<{histogram_width}}| {count}")
+
+
+## histograms per (camera, stage), retries and the stage that takes most of the time
+def print_summary(recs, bins=None):
+    if len(recs) == 0:
+        print("No records.")
+        return
+    durations = stage_durations(recs)
+    for (camera, stage), values in sorted(durations.items()):
+        values = np.asarray(values)
+        print(f"\n{camera}/{stage}: n={len(values)}, mean={np.mean(values):.1f} ms, p50={np.percentile(values, 50):.1f} ms, p99={np.percentile(values, 99):.1f} ms")
+        print_histogram(values, bins)
+
+    print("\nRetries and saved images:")
+    for camera in sorted({rec.camera for rec in recs}):
+        recs_cam = [rec for rec in recs if rec.camera == camera]
+        retries = np.array([rec.retries for rec in recs_cam])
+        saved = sum("write" in rec.stages for rec in recs_cam)
+        print(f"  {camera}: {len(recs_cam)} captures, {saved} saved, {retries.sum()} retries ({np.mean(retries > 0) * 100:.1f}% of captures retried, max {retries.max()})")
+
+    # share of the total time spent in every stage
+    totals = {key: np.sum(values) for key, values in durations.items()}
+    total = sum(totals.values())
+    print("\nTime spent per stage:")
+    for (camera, stage), t in sorted(totals.items(), key=lambda kv: -kv[1]):
+        print(f"  {camera}/{stage:<12}{t / 1e3:10.1f} s  {t / total * 100:5.1f}%")
+    slowest_mean = max(durations.items(), key=lambda kv: np.mean(kv[1]))
+    slowest_total = max(totals.items(), key=lambda kv: kv[1])
+    print(f"\nSlowest stage per capture: {'/'.join(slowest_mean[0])} ({np.mean(slowest_mean[1]):.1f} ms on average)")
+    print(f"Stage with most total time: {'/'.join(slowest_total[0])} ({slowest_total[1] / total * 100:.1f}% of all stage time)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stage timing metrics of the dataset creation scripts.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summary_parser = subparsers.add_parser("summary", help="aggregate a JSONL metrics file")
+    summary_parser.add_argument("path")
+    summary_parser.add_argument("--camera", default=None, help="only show this camera (tl or cb)")
+    summary_parser.add_argument("--bins", type=int, default=histogram_bins)
+    args = parser.parse_args()
+
+    if args.command == "summary":
+        recs = load(args.path)
+        if args.camera is not None:
+            recs = [rec for rec in recs if rec.camera == args.camera]
+        print_summary(recs, args.bins)
@@ -0,0 +1,132 @@
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import tifffile
+
+import storage
+
+## Parameters
+cache_size = 8       # decoded Cubert cubes kept in memory (Thorlabs images are cached by storage.read_thorlabs)
+memmap_cache = 256   # open memory maps kept (each holds a file handle)
+
+
+## TL / Cubert pairs of a thorlabs and a cubert folder, matched by name (<name>_thorlabs.tif, <name>_cubert.tif)
+# Uncompressed contiguous float32 TIFFs (the default of the dataset scripts) are returned as read-only
+# memory-mapped views, so random access does not depend on the RAM size and selecting a polarization,
+# bands or a window does not copy. Other files fall back to decoding: Thorlabs images through
+# storage.read_thorlabs, Cubert cubes cached here, and band or window selections of files that are not
+# cached through storage.read_window, which only decodes what is selected. dataset[i] is the pair
+# (tl, cb), dataset[a:b] a dataset of those pairs sharing the caches.
+class PairedDataset:
+    def __init__(self, thorlabs_folder, cubert_folder, names=None):
+        self.thorlabs_folder = thorlabs_folder
+        self.cubert_folder = cubert_folder
+        if names is None:
+            tl_names = {f[:-len("_thorlabs.tif")] for f in os.listdir(thorlabs_folder) if f.endswith("_thorlabs.tif")}
+            cb_names = {f[:-len("_cubert.tif")] for f in os.listdir(cubert_folder) if f.endswith("_cubert.tif")}
+            names = sorted(tl_names & cb_names)
+            # names with only one of the images
+            self.unpaired = sorted(tl_names ^ cb_names)
+        else:
+            self.unpaired = []
+        self.names = list(names)
+        self._memmaps = OrderedDict()
+        self._cubes = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            subset = PairedDataset(self.thorlabs_folder, self.cubert_folder, self.names[index])
+            subset._memmaps, subset._cubes, subset._lock = self._memmaps, self._cubes, self._lock
+            return subset
+        return self.tl(index), self.cb(index)
+
+    def tl_path(self, index):
+        return os.path.join(self.thorlabs_folder, self.names[index] + "_thorlabs.tif")
+
+    def cb_path(self, index):
+        return os.path.join(self.cubert_folder, self.names[index] + "_cubert.tif")
+
+    # (height, width) of the Thorlabs and the Cubert image of a pair, from the TIFF headers
+    def image_sizes(self, index):
+        sizes = []
+        for path in (self.tl_path(index), self.cb_path(index)):
+            with tifffile.TiffFile(path) as tif:
+                shaped = tif.shaped_metadata
+                layout = (shaped[0] if shaped else {}).get("thorlabs", {"layout": "planes"})
+                if layout["layout"] == "mosaic":
+                    (x0, x1), (y0, y1) = layout["crop"]
+                    sizes.append((y1 - y0, x1 - x0))
+                else:
+                    sizes.append(tuple(tif.series[0].shape[-2:]))
+        return tuple(sizes)
+
+    # float32 (5, h, w) Thorlabs planes, or the plane of angle (0, 45, 90, 135, "raw"), inside crop ((x0, x1), (y0, y1))
+    def tl(self, index, angle=None, crop=None):
+        path = self.tl_path(index)
+        planes = self._memmap(path, thorlabs=True)
+        if planes is None:
+            return storage.read_thorlabs(path, angle, crop=crop)
+        planes = _window(planes, crop)
+        return planes if angle is None else planes[storage.thorlabs_planes[angle]]
+
+    # float32 (bands, h, w) Cubert cube, bands an index, slice or list of indices, inside crop ((x0, x1), (y0, y1))
+    # An index or slice of a memory-mapped or cached cube is a view, a list always copies.
+    def cb(self, index, bands=None, crop=None):
+        path = self.cb_path(index)
+        cube = self._memmap(path)
+        key = (path, os.path.getmtime(path))
+        if cube is None:
+            with self._lock:
+                cube = self._cubes.get(key)
+                if cube is not None:
+                    self._cubes.move_to_end(key)
+        if cube is None and (bands is not None or crop is not None):
+            # only the selected bands and window are decoded
+            selection = np.arange(storage.image_shape(path)[0])[slice(None) if bands is None else bands]
+            window = storage.read_window(path, np.atleast_1d(selection), crop)
+            return window if np.ndim(selection) else window[0]
+        if cube is None:
+            cube = storage.read_tiff(path)
+            cube.flags.writeable = False
+            if cache_size > 0:
+                with self._lock:
+                    self._cubes[key] = cube
+                    while len(self._cubes) > cache_size:
+                        self._cubes.popitem(last=False)
+        cube = _window(cube, crop)
+        return cube if bands is None else cube[bands]
+
+    # read-only memory map of a contiguous, uncompressed float32 image (None if the file is not one)
+    def _memmap(self, path, thorlabs=False):
+        key = (path, os.path.getmtime(path))
+        with self._lock:
+            if key in self._memmaps:
+                self._memmaps.move_to_end(key)
+                return self._memmaps[key]
+        view = None
+        with tifffile.TiffFile(path) as tif:
+            shaped = tif.shaped_metadata
+            description = shaped[0] if shaped else {}
+            meta = description.get("storage") or {"dtype": tif.series[0].dtype.name}
+            mosaic = thorlabs and description.get("thorlabs", {}).get("layout") == "mosaic"
+            if meta["dtype"] == "float32" and not mosaic and tif.series[0].dataoffset is not None:
+                view = tifffile.memmap(path, mode="r")
+        with self._lock:
+            self._memmaps[key] = view
+            while len(self._memmaps) > memmap_cache:
+                self._memmaps.popitem(last=False)
+        return view
+
+
+## view of the window ((x0, x1), (y0, y1)) of the last two axes, cut at the border
+def _window(arr, crop):
+    if crop is None:
+        return arr
+    (x0, x1), (y0, y1) = crop
+    return arr[..., max(y0, 0):y1, max(x0, 0):x1]
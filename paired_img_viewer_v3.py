@@ -1,6 +1,7 @@
 import matplotlib.pyplot as plt
 import numpy as np
-import tifffile
+import storage
+import paired_dataset
 import os
 from matplotlib import widgets
 
@@ -8,9 +9,10 @@ from matplotlib import widgets
 thorlabs_image_folder = 'images/thorlabs'
 cubert_image_folder = 'images/cubert'
 
-# List available files in each folder
-thorlabs_files = sorted([f for f in os.listdir(thorlabs_image_folder) if f.endswith(".tif")])
-cubert_files = sorted([f for f in os.listdir(cubert_image_folder) if f.endswith(".tif")])
+# Pairs of the folders matched by name, contiguous float32 files are memory-mapped
+dataset = paired_dataset.PairedDataset(thorlabs_image_folder, cubert_image_folder)
+thorlabs_files = [os.path.basename(dataset.tl_path(i)) for i in range(len(dataset))]
+cubert_files = [os.path.basename(dataset.cb_path(i)) for i in range(len(dataset))]
 
 # Initial selections
 current_img_index = 0
@@ -24,32 +26,34 @@ current_pol = 0
 # List to keep track of multiple selected regions
 selected_regions = []
 
-# Load CB image from file path
-def load_cb_image(cb_file):
-    cb_image_path = os.path.join(cubert_image_folder, cb_file)
+# Load one channel of a CB image, only that band page is read (or a view of the memory map)
+def load_cb_image(cb_file, channel):
     # Load Cubert image
-    cb_image = tifffile.imread(cb_image_path)
+    cb_image = dataset.cb(cubert_files.index(cb_file), channel)
     return cb_image
 
-# Load TL image from file path
+# Number of channels of a CB image
+def cb_channel_count(cb_file):
+    return storage.image_shape(os.path.join(cubert_image_folder, cb_file))[0]
+
+# Load TL image
 def load_tl_image(tl_file):
-    tl_image_path = os.path.join(thorlabs_image_folder, tl_file)
-    # Load Cubert image
-    tl_image = tifffile.imread(tl_image_path)
+    # Load Thorlabs image
+    tl_image = dataset.tl(thorlabs_files.index(tl_file))
     return tl_image
 
 # Update the CB plot with the selected image and channel
 def update_cb_plot(cb_file, channel):
     global ax_tl, fig  # Make sure cb_image is accessible in the callback
     global colorbar_cb
-    global cb_image
+    global cb_channels
     # Clear the current plot
     ax_cb.clear()
     # Plot selected channel of Cubert image
-    img = cb_image[channel, :, :]
+    img = load_cb_image(cb_file, channel)
     im_cb = ax_cb.imshow(img, cmap='viridis')
     wavelength = wavelengths[channel]
-    ax_cb.set_title(f"Cubert Image: {cb_file} (Channel {channel}/{cb_image.shape[0]-1}, {wavelength:.1f} nm)")
+    ax_cb.set_title(f"Cubert Image: {cb_file} (Channel {channel}/{cb_channels-1}, {wavelength:.1f} nm)")
     ax_cb.annotate(f"Channel Stats: \nSNR: {snr(img):.2f}, Min: {np.min(img):.2f}, Max: {np.max(img):.2f}, Avg: {np.mean(img):.2f}, Std: {np.std(img):.2f}", 
                    (-0.05,-0.18), xycoords='axes fraction')
     # create or update colorbars
@@ -98,12 +102,12 @@ def change_thorlabs_file(text):
 
 # Change the Cubert file
 def change_cubert_file(text):
-    global current_cb_file, channel_slider, cb_image
+    global current_cb_file, channel_slider, cb_channels
     if text in cubert_files:
         current_cb_file = text
-        cb_image = load_cb_image(current_cb_file)
+        cb_channels = cb_channel_count(current_cb_file)
         update_cb_plot(current_cb_file, current_channel)
-        channel_slider.valmax = load_cb_image(current_cb_file).shape[2] - 1
+        channel_slider.valmax = cb_channels - 1
         channel_slider.set_val(current_channel)  # Update channel slider to new file's channel count
     else:
         print(f"File '{text}' not found in Cubert folder.")
@@ -139,24 +143,24 @@ def change_pol(val):
 
 # Show next image
 def next_image(_):
-    global cb_image, tl_image, current_img_index
+    global cb_channels, tl_image, current_img_index, current_tl_file, current_cb_file
     current_img_index += 1
     current_tl_file = thorlabs_files[current_img_index%len(thorlabs_files)]
     current_cb_file = cubert_files[current_img_index%len(cubert_files)]
     tl_image = load_tl_image(current_tl_file)
-    cb_image = load_cb_image(current_cb_file)
+    cb_channels = cb_channel_count(current_cb_file)
     update_tl_plot(current_tl_file, current_pol)
     update_cb_plot(current_cb_file, current_channel)
     print(f"Showing next images: {current_tl_file} (TL), {current_cb_file} (CB)")
 
 # Show prev image
 def prev_image(_):
-    global cb_image, tl_image, current_img_index
+    global cb_channels, tl_image, current_img_index, current_tl_file, current_cb_file
     current_img_index -= 1
     current_tl_file = thorlabs_files[current_img_index%len(thorlabs_files)]
     current_cb_file = cubert_files[current_img_index%len(cubert_files)]
     tl_image = load_tl_image(current_tl_file)
-    cb_image = load_cb_image(current_cb_file)
+    cb_channels = cb_channel_count(current_cb_file)
     update_tl_plot(current_tl_file, current_pol)
     update_cb_plot(current_cb_file, current_channel)
     print(f"Showing previous images: {current_tl_file} (TL), {current_cb_file} (CB)")
@@ -170,7 +174,7 @@ def snr(img, axis=None, ddof=0):
 
 # Callback function for region selection
 def onselect(eclick, erelease):
-    global selected_regions, cb_image, ax_intensity, fig
+    global selected_regions, ax_intensity, fig
 
     # Get the coordinates of the rectangle
     x1, y1 = int(eclick.xdata), int(eclick.ydata)
@@ -182,8 +186,8 @@ def onselect(eclick, erelease):
     if y1 > y2:
         y1, y2 = y2, y1
 
-    # Extract the reflectance values for the selected area
-    selected_area = cb_image[:, y1:y2+1, x1:x2+1]
+    # Extract the reflectance values for the selected area, only the tiles under it are read
+    selected_area = dataset.cb(cubert_files.index(current_cb_file), crop=((x1, x2+1), (y1, y2+1)))
 
     # Calculate the average reflectance values for the selected area
     reflectance_values = np.mean(selected_area, axis=(1, 2))
@@ -224,7 +228,7 @@ def onselect(eclick, erelease):
 # Main program
 def main():
     global ax_tl, ax_cb, ax_intensity, fig, channel_slider
-    global tl_image, cb_image
+    global tl_image, cb_channels
     global colorbar_tl, colorbar_cb
     colorbar_tl, colorbar_cb = None, None
     # Create the plot
@@ -236,7 +240,7 @@ def main():
 
     # Initial plot
     tl_image = load_tl_image(current_tl_file)
-    cb_image = load_cb_image(current_cb_file)
+    cb_channels = cb_channel_count(current_cb_file)
     update_tl_plot(current_tl_file, current_pol)
     update_cb_plot(current_cb_file, current_channel)
 
@@ -254,7 +258,7 @@ def main():
         ax=ax_channel_slider,
         label='Wavelength',
         valmin=0,
-        valmax=cb_image.shape[0] - 1,
+        valmax=cb_channels - 1,
         valinit=current_channel,
         valstep=1
     )
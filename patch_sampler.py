@@ -0,0 +1,192 @@
+import argparse
+import multiprocessing as mp
+import time
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import paired_dataset
+import storage
+
+## Parameters
+batch_size = 16
+patch_cb = 16              # patch size in Cubert px, the Thorlabs patch covers the same field of view
+planes_tl = (0, 45, 90, 135)  # Thorlabs planes of the patches (0, 45, 90, 135, "raw")
+bands_cb = None            # Cubert bands of the patches (None = all)
+field_tl = None            # common field of view ((x0, x1), (y0, y1)) in the Thorlabs images, None = whole image
+field_cb = None            # the same field of view in the Cubert images, None = whole image
+augment = True             # random flips and 90 deg rotations, the same for both patches of a pair
+n_workers = 4              # prefetch processes
+prefetch = 8               # batches kept ready in shared memory
+
+
+## random co-registered TL / Cubert patch batches, prefetched by worker processes into shared memory
+# A patch is drawn on the Cubert grid and mapped onto the Thorlabs image through the common field of
+# view (field_tl, field_cb, the whole images if both were saved cropped to it). Workers only read the two
+# windows (views of memory maps for contiguous files, storage.read_window for others), augment them
+# and write the batch into a free shared memory slot, so the trainer never decodes. next() returns
+# (tl, cb) float32 arrays (batch, planes, h, w) and (batch, bands, patch_cb, patch_cb) that stay valid
+# until the following next() call, copy them (or move them to the GPU) before that.
+class PatchSampler:
+    def __init__(self, thorlabs_folder, cubert_folder, seed=0, workers=None):
+        # without a worker or a slot next() would wait forever
+        n = n_workers if workers is None else workers
+        if n < 1 or prefetch < 1:
+            raise ValueError(f"The sampler needs at least one worker and one prefetch slot (workers {n}, prefetch {prefetch}).")
+        dataset = paired_dataset.PairedDataset(thorlabs_folder, cubert_folder)
+        if len(dataset) == 0:
+            raise ValueError(f"No pairs in {thorlabs_folder} and {cubert_folder}.")
+        self.geometry = patch_geometry(*dataset.image_sizes(0))
+        tl_size, _ = self.geometry["patch"]
+        n_bands = len(dataset.cb(0, slice(None) if bands_cb is None else bands_cb, ((0, 1), (0, 1))))
+        self.tl_shape = (batch_size, len(planes_tl)) + tl_size
+        self.cb_shape = (batch_size, n_bands, patch_cb, patch_cb)
+        self.wait_time = 0.0
+
+        # one shared memory slot per prefetched batch, workers take free slots and hand back ready ones
+        nbytes = 4 * (np.prod(self.tl_shape) + np.prod(self.cb_shape))
+        self._slots = [shared_memory.SharedMemory(create=True, size=int(nbytes)) for _ in range(prefetch)]
+        self._free = mp.Queue()
+        self._ready = mp.Queue()
+        for slot in range(prefetch):
+            self._free.put(slot)
+        self._current = None
+        config = {"names": dataset.names, "thorlabs_folder": thorlabs_folder, "cubert_folder": cubert_folder,
+                  "geometry": self.geometry, "tl_shape": self.tl_shape, "cb_shape": self.cb_shape,
+                  "slots": [shm.name for shm in self._slots], "planes_tl": planes_tl, "bands_cb": bands_cb, "augment": augment}
+        self._workers = [mp.Process(target=_worker, args=(config, self._free, self._ready, seed, i), daemon=True) for i in range(n)]
+        for worker in self._workers:
+            worker.start()
+
+    def __iter__(self):
+        return self
+
+    # next batch (tl, cb), the previous one is handed back to the workers
+    def __next__(self):
+        if self._current is not None:
+            self._free.put(self._current)
+        t_start = time.perf_counter()
+        message = self._ready.get()
+        self.wait_time += time.perf_counter() - t_start
+        if message[0] == "error":
+            raise RuntimeError(f"Patch sampler worker failed:\n{message[1]}")
+        self._current = message[1]
+        return _batch_views(self._slots[self._current].buf, self.tl_shape, self.cb_shape)
+
+    def close(self):
+        for _ in self._workers:
+            self._free.put(None)
+        for worker in self._workers:
+            worker.join(timeout=5)
+            if worker.is_alive():
+                worker.terminate()
+        for shm in self._slots:
+            shm.close()
+            shm.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+## mapping of Cubert patches onto the Thorlabs image of one pair size (both (height, width))
+# returns the fields of view, the scale (Thorlabs px per Cubert px) and the patch sizes
+def patch_geometry(tl_size, cb_size):
+    f_tl = ((0, tl_size[1]), (0, tl_size[0])) if field_tl is None else field_tl
+    f_cb = ((0, cb_size[1]), (0, cb_size[0])) if field_cb is None else field_cb
+    scale = ((f_tl[1][1] - f_tl[1][0]) / (f_cb[1][1] - f_cb[1][0]), (f_tl[0][1] - f_tl[0][0]) / (f_cb[0][1] - f_cb[0][0]))
+    patch_tl = (round(patch_cb * scale[0]), round(patch_cb * scale[1]))
+    if f_cb[0][1] - f_cb[0][0] < patch_cb or f_cb[1][1] - f_cb[1][0] < patch_cb:
+        raise ValueError(f"patch_cb {patch_cb} is larger than the Cubert field of view {f_cb}.")
+    return {"tl_size": tuple(tl_size), "cb_size": tuple(cb_size), "field_tl": f_tl, "field_cb": f_cb, "scale": scale, "patch": (patch_tl, (patch_cb, patch_cb))}
+
+
+## windows ((x0, x1), (y0, y1)) of a random patch in the Cubert and the Thorlabs image
+def draw_windows(geometry, rng):
+    (cx0, cx1), (cy0, cy1) = geometry["field_cb"]
+    (tx0, tx1), (ty0, ty1) = geometry["field_tl"]
+    (th, tw), (ch, cw) = geometry["patch"]
+    sy, sx = geometry["scale"]
+    y = int(rng.integers(cy0, cy1 - ch + 1))
+    x = int(rng.integers(cx0, cx1 - cw + 1))
+    # rounded to the nearest Thorlabs px, kept inside the field of view
+    ty = min(ty0 + round((y - cy0) * sy), ty1 - th)
+    tx = min(tx0 + round((x - cx0) * sx), tx1 - tw)
+    return ((x, x + cw), (y, y + ch)), ((tx, tx + tw), (ty, ty + th))
+
+
+## the same random flips and rotation of both patches (rotations by 90 deg only if both are square)
+def augment_pair(tl, cb, rng):
+    if rng.random() < 0.5:
+        tl, cb = tl[..., ::-1, :], cb[..., ::-1, :]
+    if rng.random() < 0.5:
+        tl, cb = tl[..., ::-1], cb[..., ::-1]
+    k = int(rng.integers(4)) if tl.shape[-1] == tl.shape[-2] else 2 * int(rng.integers(2))
+    return np.rot90(tl, k, axes=(-2, -1)), np.rot90(cb, k, axes=(-2, -1))
+
+
+def _batch_views(buf, tl_shape, cb_shape):
+    tl = np.ndarray(tl_shape, dtype=np.float32, buffer=buf)
+    cb = np.ndarray(cb_shape, dtype=np.float32, buffer=buf, offset=tl.nbytes)
+    return tl, cb
+
+
+## worker process: fill free slots with batches until it gets None
+def _worker(config, free, ready, seed, worker_id):
+    slots = [shared_memory.SharedMemory(name=name) for name in config["slots"]]
+    try:
+        dataset = paired_dataset.PairedDataset(config["thorlabs_folder"], config["cubert_folder"], config["names"])
+        geometry = config["geometry"]
+        rng = np.random.default_rng([seed, worker_id])
+        bands = slice(None) if config["bands_cb"] is None else config["bands_cb"]
+        planes = [storage.thorlabs_planes[angle] for angle in config["planes_tl"]]
+        checked = set()
+        while True:
+            slot = free.get()
+            if slot is None:
+                break
+            tl_out, cb_out = _batch_views(slots[slot].buf, config["tl_shape"], config["cb_shape"])
+            for j in range(len(tl_out)):
+                index = int(rng.integers(len(dataset)))
+                if index not in checked:
+                    sizes = dataset.image_sizes(index)
+                    if sizes != (geometry["tl_size"], geometry["cb_size"]):
+                        raise ValueError(f"Pair {dataset.names[index]} has image sizes {sizes}, the sampler was set up for "
+                                         f"{(geometry['tl_size'], geometry['cb_size'])}.")
+                    checked.add(index)
+                window_cb, window_tl = draw_windows(geometry, rng)
+                tl = dataset.tl(index, crop=window_tl)[planes]
+                cb = dataset.cb(index, bands, window_cb)
+                if config["augment"]:
+                    tl, cb = augment_pair(tl, cb, rng)
+                tl_out[j], cb_out[j] = tl, cb
+            del tl_out, cb_out
+            ready.put(("batch", slot))
+    except Exception:
+        ready.put(("error", traceback.format_exc()))
+    finally:
+        for shm in slots:
+            shm.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Draw random patch batches and report the throughput.")
+    parser.add_argument("thorlabs_folder")
+    parser.add_argument("cubert_folder")
+    parser.add_argument("--batches", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=n_workers)
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    with PatchSampler(args.thorlabs_folder, args.cubert_folder, workers=args.workers) as sampler:
+        next(sampler)  # workers warming up
+        sampler.wait_time = 0.0
+        t_start = time.perf_counter()
+        for _ in range(args.batches):
+            tl, cb = next(sampler)
+        elapsed = time.perf_counter() - t_start
+    print(f"TL {tl.shape}, CB {cb.shape}: {args.batches / elapsed:.1f} batches/s, waited {sampler.wait_time / elapsed * 100:.0f}% of the time for batches.")
@@ -0,0 +1,151 @@
+import queue
+import threading
+
+## Parameters
+queue_size = 4          # max. number of items waiting in front of each stage
+n_process_workers = 2   # threads doing calibration, demosaicing and cropping
+backpressure = "block"  # "block" (capture waits) or "drop_oldest" (oldest raw frame is discarded)
+
+_STOP = object()
+
+
+## bounded queue that either blocks the producer or drops the oldest waiting item when it is full
+class BoundedQueue(queue.Queue):
+    def __init__(self, maxsize, policy="block"):
+        if policy not in ("block", "drop_oldest"):
+            raise ValueError(f"Unknown backpressure policy '{policy}'. Use 'block' or 'drop_oldest'.")
+        super().__init__(maxsize)
+        self.policy = policy
+        self.dropped = 0
+
+    # put an item according to the policy, returns the dropped item (or None)
+    def push(self, item):
+        if self.policy == "block":
+            self.put(item)
+            return None
+        dropped = None
+        while True:
+            try:
+                self.put_nowait(item)
+                return dropped
+            except queue.Full:
+                try:
+                    dropped = self.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+
+## capture -> process -> write pipeline
+# Capture threads call submit() with raw items. A pool of worker threads runs process_fn on them
+# and a single writer thread runs write_fn on the results, so the cameras never wait for the disk.
+# Items dropped by the backpressure policy, failing in process_fn or processed to None go to on_drop.
+class Pipeline:
+    def __init__(self, process_fn, write_fn, n_workers=None, maxsize=None, policy=None, on_drop=None):
+        self.process_fn = process_fn
+        self.write_fn = write_fn
+        self.on_drop = on_drop
+        n_workers = n_process_workers if n_workers is None else n_workers
+        maxsize = queue_size if maxsize is None else maxsize
+        policy = backpressure if policy is None else policy
+
+        # Backpressure policy applies on the capture side, processed results are never dropped
+        self.raw_queue = BoundedQueue(maxsize, policy)
+        self.write_queue = BoundedQueue(maxsize, "block")
+
+        self.workers = [threading.Thread(target=self._process_loop, name=f"process-{i}", daemon=True) for i in range(n_workers)]
+        self.writer = threading.Thread(target=self._write_loop, name="writer", daemon=True)
+        self.n_failed = 0
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+        self.writer.start()
+        return self
+
+    # hand a raw item to the processing stage
+    def submit(self, item):
+        dropped = self.raw_queue.push(item)
+        if dropped is not None:
+            print(f"Pipeline: queue full, dropped oldest item ({self.raw_queue.dropped} dropped so far).")
+            if self.on_drop is not None:
+                self.on_drop(dropped)
+        return dropped is None
+
+    # report an item that never made it into the pipeline (e.g. its capture raised) to on_drop
+    def drop(self, item):
+        if self.on_drop is not None:
+            self.on_drop(item)
+
+    # wait until every submitted item is written and stop all threads
+    def close(self):
+        for _ in self.workers:
+            self.raw_queue.put(_STOP)
+        for worker in self.workers:
+            worker.join()
+        self.write_queue.put(_STOP)
+        self.writer.join()
+        print(f"Pipeline: closed. Dropped: {self.raw_queue.dropped}, failed: {self.n_failed}")
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _process_loop(self):
+        while True:
+            item = self.raw_queue.get()
+            if item is _STOP:
+                break
+            try:
+                result = self.process_fn(item)
+            except Exception as e:
+                self.n_failed += 1
+                print(f"Pipeline: processing failed ({e!r}).")
+                result = None
+            if result is not None:
+                self.write_queue.push(result)
+            elif self.on_drop is not None:
+                # the rest of the pair is not kept waiting until close()
+                self.on_drop(item)
+
+    def _write_loop(self):
+        while True:
+            item = self.write_queue.get()
+            if item is _STOP:
+                break
+            try:
+                self.write_fn(item)
+            except Exception as e:
+                self.n_failed += 1
+                print(f"Pipeline: writing failed ({e!r}).")
+
+
+## collects the per-camera results belonging to one image and hands them on together
+# Items are dicts with at least "camera", "img_name" and "data". An item with data None marks a failed
+# or dropped capture, so the whole pair can be skipped instead of leaving single files behind.
+class PairCollector:
+    def __init__(self, cameras, write_pair_fn):
+        self.cameras = tuple(cameras)
+        self.write_pair_fn = write_pair_fn
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def add(self, item):
+        with self.lock:
+            parts = self.pending.setdefault(item["img_name"], {})
+            parts[item["camera"]] = item
+            if len(parts) < len(self.cameras):
+                return
+            del self.pending[item["img_name"]]
+        self.write_pair_fn(item["img_name"], parts)
+
+    # mark a capture as failed or dropped
+    def discard(self, item):
+        self.add({**item, "data": None})
+
+    def close(self):
+        for img_name, parts in self.pending.items():
+            print(f"Pipeline: pair {img_name} incomplete (got {', '.join(parts)}), nothing saved.")
+        self.pending.clear()
@@ -0,0 +1,262 @@
+import threading
+
+import numpy as np
+
+## Parameters
+kernel_border = 2  # in px read around the crop, bilinear demosaicing needs one, two keep the mosaic phase
+pool_size = 8      # released output buffers kept for reuse
+
+# mosaic position (row, column parity) of the 0, 45, 90 and 135 deg pixels, same order as pa.demosaicing
+polarization_phases = ((1, 1), (0, 1), (0, 0), (1, 0))
+
+# Equivalence check against the reference paths the kernels replaced ("python processing_kernels.py")
+tolerance_uint16 = 0.5  # in counts, OpenCV rounds the interpolated values of uint16 frames to integers
+tolerance_float = 0.1   # in counts, polanalyser quantizes float frames to uint16 steps of max / 65535 (0.06 for 12 bit)
+tolerance_cubert = 1e-3  # in counts, float32 instead of float64 rounding of 12 bit values and the dark
+check_crops = (None, ((0, 20), (0, 16)), ((7, 41), (5, 30)), ((50, 80), (41, 64)))  # frame corners and odd offsets
+
+
+## pool of float32 output buffers and cache of float32 darks shared by the kernels
+# acquire() returns a released buffer of the same shape if there is one, release() hands a buffer back
+# once its data was written. Buffers that are never released are simply garbage collected.
+class _Kernel:
+    def __init__(self):
+        self._free = []
+        self._lock = threading.Lock()
+        self._darks = {}
+
+    # output buffer from the pool (or a new one)
+    def acquire(self, shape):
+        with self._lock:
+            for i, buffer in enumerate(self._free):
+                if buffer.shape == shape:
+                    return self._free.pop(i)
+        return np.empty(shape, dtype=np.float32)
+
+    # hand an output buffer back once it is not needed anymore
+    def release(self, buffer):
+        with self._lock:
+            if len(self._free) < pool_size:
+                self._free.append(buffer)
+
+    # prepare(dark) (a float32 copy of it) computed once per dark and key
+    def _cached_dark(self, dark, key, prepare):
+        with self._lock:
+            entry = self._darks.get((id(dark), key))
+            if entry is None or entry[0] is not dark:
+                entry = (dark, prepare(dark))
+                self._darks[(id(dark), key)] = entry
+            return entry[1]
+
+
+## fused processing of raw Thorlabs polarization frames
+# process() subtracts the dark, clips at 0, demosaics and crops in one go and only touches the crop
+# window plus kernel_border px. The result is float32 (5, h, w): the 0, 45, 90 and 135 deg channels,
+# interpolated bilinearly like pa.demosaicing (including its replicated 1 px frame border), and the
+# dark subtracted raw frame. Output buffers come from a small pool, release() hands them back once the
+# data was written. Scratch buffers are per thread, so one kernel can be shared by the pipeline workers.
+class ThorlabsKernel(_Kernel):
+    def __init__(self):
+        super().__init__()
+        self._local = threading.local()
+
+    # frame (height, width) uint16 or float, dark of the same shape or None, crop ((x0, x1), (y0, y1))
+    # channels selects the output planes (0-3: 0, 45, 90, 135 deg, 4: dark subtracted raw)
+    def process(self, raw, dark=None, crop=None, out=None, channels=(0, 1, 2, 3, 4)):
+        frame_h, frame_w = raw.shape
+        (x0, x1), (y0, y1) = ((0, frame_w), (0, frame_h)) if crop is None else crop
+        h, w = y1 - y0, x1 - x0
+        out = self.acquire((len(channels), h, w)) if out is None else out
+
+        (wy0, wy1), (wx0, wx1) = window_bounds(crop, raw.shape)
+        padded, rows = self._scratch((wy1 - wy0 + 2, wx1 - wx0 + 2), (h // 2 + 2, w))
+
+        # dark subtraction and clipping in float32, straight from the raw frame into the padded window
+        self._calibrate(raw, dark, (wy0, wy1), (wx0, wx1), padded[1:-1, 1:-1])
+        # the padding is only read for pixels on the frame border, which are replaced below
+        padded[0], padded[-1] = padded[1], padded[-2]
+        padded[:, 0], padded[:, -1] = padded[:, 1], padded[:, -2]
+
+        # position of frame pixel (y0, x0) in the padded window
+        oy, ox = y0 - wy0 + 1, x0 - wx0 + 1
+        for plane, channel in zip(out, channels):
+            if channel == 4:
+                plane[...] = padded[oy:oy + h, ox:ox + w]
+                continue
+            py, px = polarization_phases[channel]
+            _demosaic_channel(padded, plane, rows, py, px, y0, x0, oy, ox)
+
+            # pa.demosaicing (OpenCV) replicates the second row/column into the outermost one of the frame
+            if y0 == 0:
+                plane[0] = plane[1]
+            if y1 == frame_h:
+                plane[-1] = plane[-2]
+            if x0 == 0:
+                plane[:, 0] = plane[:, 1]
+            if x1 == frame_w:
+                plane[:, -1] = plane[:, -2]
+        return out
+
+    # only the dark subtracted, clipped raw mosaic of the window around crop (see window_bounds)
+    # process(mosaic, crop=window_crop(crop, raw.shape)) later gives the same planes as process(raw, dark, crop)
+    def calibrate_window(self, raw, dark=None, crop=None):
+        (wy0, wy1), (wx0, wx1) = window_bounds(crop, raw.shape)
+        out = self.acquire((wy1 - wy0, wx1 - wx0))
+        self._calibrate(raw, dark, (wy0, wy1), (wx0, wx1), out)
+        return out
+
+    def _calibrate(self, raw, dark, window_y, window_x, out):
+        window = (slice(*window_y), slice(*window_x))
+        if dark is None:
+            np.copyto(out, raw[window], casting="unsafe")
+        else:
+            np.subtract(raw[window], self._dark32(dark)[window], out=out, casting="unsafe")
+        np.maximum(out, 0, out=out)
+
+    def _scratch(self, padded_shape, rows_shape):
+        local = self._local
+        if getattr(local, "padded", None) is None or local.padded.shape != padded_shape:
+            local.padded = np.empty(padded_shape, dtype=np.float32)
+        if getattr(local, "rows", None) is None or local.rows.shape != rows_shape:
+            local.rows = np.empty(rows_shape, dtype=np.float32)
+        return local.padded, local.rows
+
+    # float32 copy of a dark, converted once per dark
+    def _dark32(self, dark):
+        if dark.dtype == np.float32:
+            return dark
+        return self._cached_dark(dark, None, lambda dark: dark.astype(np.float32))
+
+
+## fused post-processing of Cubert cubes
+# process() slices the crop window out of the (height, width, bands) cube first and copies it band
+# first and as float32 into a pooled (bands, h, w) buffer, where the dark (cropped, transposed and cast
+# once per dark) is subtracted in place and the result clipped at 0. After warm-up nothing is allocated.
+class CubertKernel(_Kernel):
+    # cube (height, width, bands), dark of the same shape or None, crop ((x0, x1), (y0, y1))
+    def process(self, cube, dark=None, crop=None, out=None):
+        if crop is not None:
+            cube = cube[crop[1][0]:crop[1][1], crop[0][0]:crop[0][1]]
+        h, w, bands = cube.shape
+        out = self.acquire((bands, h, w)) if out is None else out
+        np.copyto(out, cube.transpose(2, 0, 1), casting="unsafe")
+        if dark is not None:
+            out -= self._cached_dark(dark, crop, lambda dark: _band_first(dark, crop))
+            np.maximum(out, 0, out=out)
+        return out
+
+
+## ((y0, y1), (x0, x1)) of the frame read for crop: kernel_border px around it, starting on the mosaic so
+# the channel phases stay the same, cut at the frame border
+def window_bounds(crop, frame_shape):
+    frame_h, frame_w = frame_shape
+    (x0, x1), (y0, y1) = ((0, frame_w), (0, frame_h)) if crop is None else crop
+    wy0, wx0 = max(0, y0 - kernel_border) // 2 * 2, max(0, x0 - kernel_border) // 2 * 2
+    return (wy0, min(frame_h, y1 + kernel_border)), (wx0, min(frame_w, x1 + kernel_border))
+
+
+## crop in coordinates of the window returned by calibrate_window
+def window_crop(crop, frame_shape):
+    frame_h, frame_w = frame_shape
+    (x0, x1), (y0, y1) = ((0, frame_w), (0, frame_h)) if crop is None else crop
+    (wy0, _), (wx0, _) = window_bounds(crop, frame_shape)
+    return ((x0 - wx0, x1 - wx0), (y0 - wy0, y1 - wy0))
+
+
+## cropped, band first, contiguous float32 copy of a (height, width, bands) cube
+def _band_first(cube, crop=None):
+    if crop is not None:
+        cube = cube[crop[1][0]:crop[1][1], crop[0][0]:crop[0][1]]
+    return np.ascontiguousarray(cube.transpose(2, 0, 1), dtype=np.float32)
+
+
+## bilinear interpolation of one mosaic channel (pixels at row/column parity py, px of the frame)
+# padded is the window, (oy, ox) the position of frame pixel (y0, x0) in it. First the rows of the
+# channel are interpolated horizontally into rows, then the output rows vertically from those.
+def _demosaic_channel(padded, out, rows, py, px, y0, x0, oy, ox):
+    h, w = out.shape
+    # channel rows from frame row y0 - 1 to y0 + h
+    first = oy - 1 + (py - y0 + 1) % 2
+    src = padded[first:oy + h + 1:2]
+    n_rows = src.shape[0]
+    horizontal = rows[:n_rows]
+
+    cx = (px - x0) % 2
+    horizontal[:, cx::2] = src[:, ox + cx:ox + w:2]
+    between = horizontal[:, 1 - cx::2]
+    np.add(src[:, ox - cx:ox + w - 1:2], src[:, ox + 2 - cx:ox + w + 1:2], out=between)
+    between *= 0.5
+
+    sy = (py - y0) % 2
+    same = out[sy::2]
+    same[...] = horizontal[sy:sy + same.shape[0]]
+    between = out[1 - sy::2]
+    n = between.shape[0]
+    np.add(horizontal[:n], horizontal[1:n + 1], out=between)
+    between *= 0.5
+
+
+## reference Thorlabs processing the kernel replaced: float64 dark subtraction and clipping, pa.demosaicing,
+# the calibrated frame appended as fifth plane, then the crop
+def reference_thorlabs(raw, dark=None, crop=None):
+    import polanalyser as pa
+    img = raw if dark is None else np.maximum(raw - dark.astype(np.float64), 0)
+    planes = np.append(pa.demosaicing(img_raw=img, code=pa.COLOR_PolarMono), [img], axis=0)
+    if crop is not None:
+        planes = planes[:, crop[1][0]:crop[1][1], crop[0][0]:crop[0][1]]
+    return planes
+
+
+## max. deviation of ThorlabsKernel from reference_thorlabs on a random 12 bit frame, uint16 without and
+# float with a dark, for every crop of check_crops, as planes and through the mosaic layout (calibrate_window,
+# then process on the window). Raises AssertionError above tolerance_uint16 / tolerance_float.
+def check_thorlabs(shape=(64, 80), seed=0):
+    rng = np.random.default_rng(seed)
+    raw = rng.integers(0, 4096, shape, dtype=np.uint16)
+    dark = rng.normal(100, 10, shape).astype(np.float32)
+    kernel = ThorlabsKernel()
+    for frame_dark, tolerance in ((None, tolerance_uint16), (dark, tolerance_float)):
+        for crop in check_crops:
+            reference = reference_thorlabs(raw, frame_dark, crop)
+            planes = kernel.process(raw, frame_dark, crop)
+            mosaic = kernel.process(kernel.calibrate_window(raw, frame_dark, crop), crop=window_crop(crop, shape))
+            for layout, result in (("planes", planes), ("mosaic", mosaic)):
+                deviation = float(np.max(np.abs(result - reference)))
+                name = f"TL {'uint16' if frame_dark is None else 'float'} {layout}, crop {crop}"
+                print(f"{name}: max. deviation {deviation:.3f} counts (tolerance {tolerance})")
+                assert deviation <= tolerance, f"{name} deviates by {deviation:.3f} counts from the reference."
+
+
+## reference Cubert processing the kernel replaced: float64 dark subtraction and clipping, bands first, then the crop
+def reference_cubert(cube, dark=None, crop=None):
+    cube = cube.astype(float)
+    if dark is not None:
+        cube = np.maximum(cube - dark.astype(float), 0)
+    cube = cube.transpose(2, 0, 1)
+    if crop is not None:
+        cube = cube[:, crop[1][0]:crop[1][1], crop[0][0]:crop[0][1]]
+    return cube
+
+
+## max. deviation of CubertKernel from reference_cubert on a random 12 bit cube, without and with a dark,
+# for every crop of check_crops, with pooled buffers and the cached dark reused across the crops. Raises
+# AssertionError above tolerance_cubert.
+def check_cubert(shape=(64, 80, 6), seed=0):
+    rng = np.random.default_rng(seed)
+    cube = rng.integers(0, 4096, shape, dtype=np.uint16)
+    dark = rng.normal(100, 10, shape)
+    kernel = CubertKernel()
+    for cube_dark in (None, dark):
+        for crop in check_crops:
+            result = kernel.process(cube, cube_dark, crop)
+            deviation = float(np.max(np.abs(result - reference_cubert(cube, cube_dark, crop))))
+            kernel.release(result)
+            name = f"CB {'raw' if cube_dark is None else 'dark subtracted'}, crop {crop}"
+            print(f"{name}: max. deviation {deviation:.5f} counts (tolerance {tolerance_cubert})")
+            assert deviation <= tolerance_cubert, f"{name} deviates by {deviation:.5f} counts from the reference."
+
+
+if __name__ == "__main__":
+    check_thorlabs()
+    check_cubert()
+    print("Kernels match the reference processing.")
@@ -0,0 +1,103 @@
+import numpy as np
+
+## Parameters
+sample_stride = 4         # spatial subsampling of the statistics
+min_snr = 0.1             # mean / std of the dark subtracted sample
+max_saturated = 0.05      # fraction of saturated sample values
+saturation_level = 0.98   # fraction of full scale that counts as saturated
+blank_range = 1.0         # in counts, a frame with less spread than this ...
+blank_mean = 1.0          # ... or a lower mean signal is considered blank
+
+
+## strided sample of the spatial axes inside crop ((x0, x1), (y0, y1))
+def sample(arr, crop=None, spatial_axes=(0, 1), stride=None):
+    stride = sample_stride if stride is None else stride
+    index = [slice(None)] * arr.ndim
+    y_axis, x_axis = spatial_axes
+    if crop is not None:
+        index[y_axis] = slice(*crop[1])
+        index[x_axis] = slice(*crop[0])
+    arr = arr[tuple(index)]
+    index = [slice(None)] * arr.ndim
+    index[y_axis] = slice(None, None, stride)
+    index[x_axis] = slice(None, None, stride)
+    return arr[tuple(index)]
+
+
+## statistics of a sample, with per-band sums in one pass over it (band_mean and band_std per band)
+# raw and dark are samples taken the same way, band_axis None for single frames. max_counts enables
+# the saturation fraction, which is computed on the raw values.
+def sample_stats(raw, dark=None, max_counts=None, band_axis=None):
+    stats = {}
+    if max_counts is not None:
+        stats["saturated"] = float(np.mean(raw >= saturation_level * max_counts))
+    x = raw.astype(np.float32)
+    if dark is not None:
+        x -= dark
+        np.maximum(x, 0, out=x)
+    bands = x.reshape(-1, 1) if band_axis is None else np.moveaxis(x, band_axis, -1).reshape(-1, x.shape[band_axis])
+    n = bands.shape[0]
+    s1 = bands.sum(axis=0, dtype=np.float64)
+    s2 = np.einsum("ij,ij->j", bands, bands, dtype=np.float64)
+    mean = s1.sum() / bands.size
+    std = np.sqrt(max(s2.sum() / bands.size - mean ** 2, 0))
+    stats.update({
+        "mean": float(mean),
+        "std": float(std),
+        "min": float(bands.min()),
+        "max": float(bands.max()),
+        "snr": float(mean / std) if std > 0 else 0.0,
+        "band_mean": s1 / n,
+        "band_std": np.sqrt(np.maximum(s2 / n - (s1 / n) ** 2, 0)),
+    })
+    return stats
+
+
+## checks, each returns the reason for rejecting the capture or None
+def check_snr(stats):
+    if stats["snr"] <= min_snr:
+        return f"SNR {stats['snr']:.2f} <= {min_snr}"
+
+def check_saturation(stats):
+    if stats.get("saturated", 0) > max_saturated:
+        return f"{stats['saturated'] * 100:.1f}% saturated"
+
+def check_blank(stats):
+    if stats["max"] - stats["min"] < blank_range or stats["mean"] < blank_mean:
+        return f"blank frame (mean {stats['mean']:.2f}, range {stats['max'] - stats['min']:.2f})"
+
+default_checks = [check_snr, check_blank]
+# only another exposure passes these, a fixed exposure fails them again on every retry: they reject
+# captures only with auto exposure (gate_checks) and are otherwise just logged
+exposure_checks = [check_saturation]
+
+
+## reasons for rejecting a capture, empty if it passes all checks
+def evaluate(stats, checks=None):
+    reasons = [check(stats) for check in (default_checks if checks is None else checks)]
+    return [reason for reason in reasons if reason is not None]
+
+
+## checks of the gate, with the exposure_checks when the exposure adapts between the tries
+def gate_checks(checks=None, exposure_adapts=False):
+    checks = default_checks if checks is None else checks
+    return checks + exposure_checks if exposure_adapts else checks
+
+
+## overall and per-band statistics of a (bands, height, width) or (height, width) image from a strided
+# sample, with 6 significant digits as plain floats and lists for the TIFF metadata
+def summary(img, stride=None):
+    if img.ndim == 2:
+        img = img[None]
+    stats = sample_stats(sample(img, spatial_axes=(1, 2), stride=stride), band_axis=0)
+    band_snr = np.divide(stats["band_mean"], stats["band_std"], out=np.zeros_like(stats["band_mean"]), where=stats["band_std"] > 0)
+    rounded = lambda values: [float(f"{v:.6g}") for v in values]
+    result = {key: float(f"{stats[key]:.6g}") for key in ("mean", "std", "min", "max", "snr")}
+    result.update({"band_mean": rounded(stats["band_mean"]), "band_std": rounded(stats["band_std"]), "band_snr": rounded(band_snr),
+                   "sample_stride": sample_stride if stride is None else stride})
+    return result
+
+
+## short description of the stats for the log
+def describe(stats):
+    return f"Max: {stats['max']:.1f}, Min: {stats['min']:.1f}, Avg: {stats['mean']:.1f}, SNR: {stats['snr']:.2f}, sampled every {sample_stride} px"
@@ -0,0 +1,70 @@
+import json
+import os
+import threading
+import time
+
+
+## append-only manifest of the completed pairs of a dataset run (JSONL, one line per pair)
+# Every line is written with a single write() and fsync'd before add() returns, so after a crash the
+# file lists exactly the pairs that were saved completely. A torn last line is ignored when loading.
+# Without resume an existing manifest is an error instead of silently overwriting the run it describes.
+class RunManifest:
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.entries = load(path) if resume else []
+        # id of the run, kept when it is resumed, so images of different runs with the same names can be told apart
+        self.run_id = next((e["run"] for e in self.entries if "run" in e), None) or f"{time.strftime('%Y%m%dT%H%M%S')}-{os.getpid()}"
+        if not resume and os.path.exists(path) and os.path.getsize(path) > 0:
+            raise FileExistsError(f"Manifest {path} exists, start with --resume to continue that run or move it away.")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "ab")
+        self._lock = threading.Lock()
+        # start on a fresh line after a torn last line
+        if self._file.tell() > 0 and not _ends_with_newline(path):
+            self._write(b"\n")
+
+    # names of the completed pairs whose files are all still there
+    def completed(self):
+        return {e["name"] for e in self.entries if all(os.path.exists(p) for p in e.get("paths", {}).values())}
+
+    # first free number after the highest numeric name, at least start
+    def next_index(self, start):
+        numbers = [int(name) for name in self.completed() if name.isdigit()]
+        return max([start] + [n + 1 for n in numbers])
+
+    # record a completed pair, record holds the output paths ("paths"), exposures, calibration etc.
+    def add(self, name, **record):
+        entry = {"name": name, "run": self.run_id, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), **record}
+        with self._lock:
+            self._write((json.dumps(entry) + "\n").encode())
+            self.entries.append(entry)
+
+    def _write(self, data):
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+## entries of a manifest (empty if it does not exist), skipping a torn last line
+def load(path):
+    if not os.path.exists(path):
+        return []
+    entries = []
+    with open(path, "rb") as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                if line.strip():
+                    print(f"Manifest: ignoring incomplete entry in {path}.")
+    return entries
+
+
+def _ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
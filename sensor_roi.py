@@ -0,0 +1,53 @@
+import math
+
+## Parameters
+roi_margin = 8   # in px around the crop, so the demosaicing at the crop border interpolates from real pixels
+mosaic_size = 2  # polarization super pixel, the ROI has to start on one to keep the channel order
+
+
+## mosaic-aligned sensor ROI (hstart, hend, vstart, vend) that covers crop plus margin
+# crop is ((x0, x1), (y0, y1)) in coordinates of full_roi, the readout used so far. The ROI start and
+# size are rounded to the super pixel and to the position/size steps of the camera (get_roi_limits).
+def roi_from_crop(crop, full_roi, cam=None, margin=None):
+    margin = roi_margin if margin is None else margin
+    hsteps, vsteps = roi_steps(cam)
+    (x0, x1), (y0, y1) = crop
+    hstart, hend = _align(full_roi[0] + x0 - margin, full_roi[0] + x1 + margin, full_roi[0], full_roi[1], *hsteps)
+    vstart, vend = _align(full_roi[2] + y0 - margin, full_roi[2] + y1 + margin, full_roi[2], full_roi[3], *vsteps)
+    return (hstart, hend, vstart, vend)
+
+
+## (position step, size step) of the horizontal and vertical ROI axis, combined with the super pixel
+def roi_steps(cam=None):
+    steps = ((1, 1), (1, 1))
+    if cam is not None:
+        try:
+            hlim, vlim = cam.get_roi_limits()
+            steps = ((hlim[2], hlim[3]), (vlim[2], vlim[3]))
+        except Exception:
+            pass
+    return tuple((math.lcm(mosaic_size, pstep), math.lcm(mosaic_size, sstep)) for pstep, sstep in steps)
+
+
+def _align(start, end, lower, upper, pstep, sstep):
+    start = max(lower, start // pstep * pstep)
+    size = math.ceil((end - start) / sstep) * sstep
+    end = min(upper, start + size)
+    # the sensor border cut the size, move the start back instead
+    start = max(lower, end - size) // pstep * pstep
+    return start, end
+
+
+## crop in coordinates of full_roi -> crop in coordinates of the frames read with roi
+def shift_crop(crop, full_roi, roi):
+    dx, dy = roi[0] - full_roi[0], roi[2] - full_roi[2]
+    (x0, x1), (y0, y1) = crop
+    return ((x0 - dx, x1 - dx), (y0 - dy, y1 - dy))
+
+
+## cut a frame taken with full_roi (e.g. the master dark) down to roi
+def crop_frame(frame, full_roi, roi):
+    if frame.shape[-2:] == (roi[3] - roi[2], roi[1] - roi[0]):
+        return frame
+    dx, dy = roi[0] - full_roi[0], roi[2] - full_roi[2]
+    return frame[..., dy:dy + roi[3] - roi[2], dx:dx + roi[1] - roi[0]]
@@ -0,0 +1,408 @@
+import argparse
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import tifffile
+
+import processing_kernels
+
+## Parameters
+dtypes = ("float32", "float16", "uint16")
+compressions = (None, "lzw", "deflate", "zstd")  # TIFF codecs (tifffile / imagecodecs)
+predictors = (None, "horizontal", "floatingpoint", "auto")  # floatingpoint = byte shuffle + delta, auto picks by dtype
+compression_level = None  # codec default
+tile_size = None  # px, None = strips: fast to write and uncompressed float32 files can be memory-mapped (paired_dataset)
+                 # 64 - 512 = every band in tiles, so windows decode only what they need, for archives read by window
+                 # (written tile by tile in Python: 64 px tiles cost about 1 s per full TL frame, 256 px about 0.1 s)
+n_workers = 4   # processes of the migration
+cache_size = 8  # demosaiced Thorlabs images kept in memory by read_thorlabs (0 = no cache)
+
+# planes of the Thorlabs images by polarization angle
+thorlabs_planes = {0: 0, 45: 1, 90: 2, 135: 3, "raw": 4}
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+_kernel = processing_kernels.ThorlabsKernel()
+
+
+## stored array and storage metadata of an image in the given on-disk dtype
+# uint16 maps [min, max] of the image linearly to [0, 65535], the offset and scale go into the metadata
+# (round-trip error at most scale / 2). float16 keeps 11 significant bits, float32 is lossless for the
+# float32 images of the dataset scripts.
+def encode(arr, dtype):
+    if dtype not in dtypes:
+        raise ValueError(f"Unknown storage dtype '{dtype}'. Use one of {', '.join(dtypes)}.")
+    meta = {"dtype": dtype}
+    if dtype == "uint16":
+        offset = float(np.min(arr))
+        scale = (float(np.max(arr)) - offset) / 65535 or 1.0
+        stored = np.empty(arr.shape, dtype=np.uint16)
+        np.rint((arr - np.float32(offset)) / np.float32(scale), out=stored, casting="unsafe")
+        meta.update({"offset": offset, "scale": scale})
+        return stored, meta
+    return arr.astype(dtype, copy=False), meta
+
+
+## float32 image of a stored array (meta None for files without storage metadata)
+def decode(stored, meta=None):
+    if meta is None or meta.get("dtype") != "uint16":
+        return stored.astype(np.float32, copy=False)
+    out = stored.astype(np.float32)
+    out *= np.float32(meta["scale"])
+    out += np.float32(meta["offset"])
+    return out
+
+
+## max. round-trip error allowed per value of arr in the storage format of meta
+def error_bound(arr, meta):
+    magnitude = np.abs(arr).astype(np.float32)
+    if meta["dtype"] == "uint16":
+        return meta["scale"] / 2 + (magnitude + abs(meta["offset"])) * 2.0 ** -22
+    if meta["dtype"] == "float16":
+        return magnitude * 2.0 ** -11 + 2.0 ** -24
+    return magnitude * 2.0 ** -24
+
+
+## TIFF of an image in the given dtype, in memory (for the codec benchmark, files are written with save_tiff),
+# with the storage metadata in the image description
+# compression is one of compressions, the predictor decorrelates neighbouring values before compressing
+def tiff_bytes(arr, dtype, metadata=None, compression=None, predictor="auto"):
+    stored, meta = encode(arr, dtype)
+    buffer = io.BytesIO()
+    tifffile.imwrite(buffer, stored, photometric='minisblack', metadata={**(metadata or {}), "storage": meta},
+                     tile=_tile(), **codec_args(stored.dtype, compression, predictor))
+    return buffer
+
+
+## tifffile.imwrite arguments of a codec, "auto" predicts floats with floatingpoint and integers horizontally
+def codec_args(dtype, compression=None, predictor="auto"):
+    if compression not in compressions:
+        raise ValueError(f"Unknown compression '{compression}'. Use one of {', '.join(map(str, compressions))}.")
+    if predictor not in predictors:
+        raise ValueError(f"Unknown predictor '{predictor}'. Use one of {', '.join(map(str, predictors))}.")
+    if compression is None:
+        return {}
+    if predictor == "auto":
+        predictor = "floatingpoint" if np.issubdtype(dtype, np.floating) else "horizontal"
+    args = {"compression": compression if compression_level is None else (compression, compression_level)}
+    if predictor is not None:
+        args["predictor"] = predictor
+    return args
+
+
+## stored array and storage metadata of a TIFF (None for files written before storage dtypes existed)
+def read_tiff_raw(path):
+    stored, description = read_tiff_full(path)
+    return stored, description.get("storage")
+
+
+## stored array and the whole description (storage metadata under "storage", layout under "thorlabs")
+def read_tiff_full(path):
+    with tifffile.TiffFile(path) as tif:
+        stored = tif.asarray()
+        shaped = tif.shaped_metadata
+    return stored, (shaped[0] if shaped else {})
+
+
+## metadata of a Thorlabs image stored as dark subtracted raw mosaic, crop ((x0, x1), (y0, y1)) is the
+# saved image inside the mosaic (which has a border for the demosaicing, see processing_kernels.window_bounds)
+def mosaic_metadata(crop):
+    return {"thorlabs": {"layout": "mosaic", "demosaic": "bilinear", "phases": processing_kernels.polarization_phases, "crop": crop}}
+
+
+## Thorlabs image as float32 (5, h, w) planes (0, 45, 90, 135 deg, raw), or the plane of one angle
+# (0, 45, 90, 135 or "raw"), optionally only the window crop ((x0, x1), (y0, y1)). Images stored as raw
+# mosaic are demosaiced here, the last cache_size whole demosaiced images are kept in memory. A single
+# angle or a window that is not cached is read (see read_window) and demosaiced on its own.
+def read_thorlabs(path, angle=None, cache=True, crop=None):
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    with _cache_lock:
+        planes = _cache.get(key)
+        if planes is not None:
+            _cache.move_to_end(key)
+            return _select_thorlabs(planes, angle, crop)
+
+    if angle is not None or crop is not None:
+        return _read_thorlabs_window(path, angle, crop)
+    stored, description = read_tiff_full(path)
+    image = decode(stored, description.get("storage"))
+    layout = description.get("thorlabs", {"layout": "planes"})
+    if layout["layout"] != "mosaic":
+        return image
+
+    planes = _kernel.process(image, crop=tuple(tuple(c) for c in layout["crop"]))
+    if cache and cache_size > 0:
+        with _cache_lock:
+            _cache[key] = planes
+            while len(_cache) > cache_size:
+                _cache.popitem(last=False)
+    return planes
+
+
+def _select_thorlabs(planes, angle, crop):
+    if crop is not None:
+        planes = planes[:, max(crop[1][0], 0):crop[1][1], max(crop[0][0], 0):crop[0][1]]
+    return planes if angle is None else planes[thorlabs_planes[angle]]
+
+
+def _read_thorlabs_window(path, angle, crop):
+    with tifffile.TiffFile(path) as tif:
+        shaped = tif.shaped_metadata
+        description = shaped[0] if shaped else {}
+        return thorlabs_window(lambda bands, window: _read_window(tif, bands, window), tif.series[0].shape, description, angle, crop)
+
+
+## float32 planes (or the plane of one angle) inside crop of a stored Thorlabs image of either layout
+# read(bands, window) returns the stored (bands, h, w) window ((x0, x1), (y0, y1)) of the given bands
+# (None = all), shape is the stored shape and description holds the "storage" and "thorlabs" metadata.
+# Of a mosaic only the window around the crop with the border the demosaicing needs is read.
+def thorlabs_window(read, shape, description, angle=None, crop=None):
+    layout = description.get("thorlabs", {"layout": "planes"})
+    if layout["layout"] != "mosaic":
+        bands = None if angle is None else [thorlabs_planes[angle]]
+        planes = decode(read(bands, crop), description.get("storage"))
+        return planes if angle is None else planes[0]
+
+    (cx0, cx1), (cy0, cy1) = layout["crop"]
+    if crop is not None:
+        (x0, x1), (y0, y1) = crop
+        crop = ((cx0 + max(x0, 0), cx0 + min(x1, cx1 - cx0)), (cy0 + max(y0, 0), cy0 + min(y1, cy1 - cy0)))
+    else:
+        crop = ((cx0, cx1), (cy0, cy1))
+    (wy0, wy1), (wx0, wx1) = processing_kernels.window_bounds(crop, shape)
+    window = decode(read(None, ((wx0, wx1), (wy0, wy1)))[0], description.get("storage"))
+    channels = (0, 1, 2, 3, 4) if angle is None else (thorlabs_planes[angle],)
+    planes = _kernel.process(window, crop=processing_kernels.window_crop(crop, shape), channels=channels)
+    return planes if angle is None else planes[0]
+
+
+## crop ((x0, x1), (y0, y1)) of a stored Thorlabs image in coordinates of the read image, keeping its layout
+# returns the stored array and description to write back with write_tiff
+def crop_thorlabs(stored, description, crop):
+    layout = description.get("thorlabs", {"layout": "planes"})
+    if layout["layout"] != "mosaic":
+        return stored[:, crop[1][0]:crop[1][1], crop[0][0]:crop[0][1]], description
+    (cx0, _), (cy0, _) = layout["crop"]
+    crop = ((cx0 + crop[0][0], cx0 + crop[0][1]), (cy0 + crop[1][0], cy0 + crop[1][1]))
+    (wy0, wy1), (wx0, wx1) = processing_kernels.window_bounds(crop, stored.shape)
+    description = {**description, **mosaic_metadata(processing_kernels.window_crop(crop, stored.shape))}
+    return stored[wy0:wy1, wx0:wx1], description
+
+
+## float32 image of a TIFF written by the dataset scripts, whatever dtype it is stored in
+def read_tiff(path):
+    return decode(*read_tiff_raw(path))
+
+
+## write a stored array with its storage metadata (and further description entries), through a temporary
+# file so the old file survives a crash. tile is the tile size in px, None for strips, "auto" = tile_size
+def write_tiff(path, stored, meta, description=None, compression=None, predictor="auto", tile="auto"):
+    metadata = {key: value for key, value in (description or {}).items() if key != "shape"}
+    if meta:
+        metadata["storage"] = meta
+    tmp_path = path + ".tmp"
+    tifffile.imwrite(tmp_path, stored, photometric='minisblack', metadata=metadata or None,
+                     tile=_tile() if tile == "auto" else (None if tile is None else (tile, tile)),
+                     **codec_args(stored.dtype, compression, predictor))
+    os.replace(tmp_path, path)
+
+
+## compression, predictor and tile size a TIFF was written with, as write_tiff arguments, so a rewritten
+# file keeps them
+def read_codec(path):
+    with tifffile.TiffFile(path) as tif:
+        page = tif.pages.first
+        name = page.compression.name.lower()
+        compression = {"none": None, "adobe_deflate": "deflate"}.get(name, name)
+        predictor = {2: "horizontal", 3: "floatingpoint"}.get(int(page.predictor))
+        return {"compression": compression, "predictor": predictor, "tile": page.tilewidth if page.is_tiled else None}
+
+
+## encode an image in the given dtype and write it straight to path (through a temporary file)
+def save_tiff(path, arr, dtype, metadata=None, compression=None, predictor="auto"):
+    stored, meta = encode(arr, dtype)
+    write_tiff(path, stored, meta, metadata, compression, predictor)
+
+
+def _tile():
+    return None if tile_size is None else (tile_size, tile_size)
+
+
+## float32 (bands, h, w) window of a TIFF, only the pages of the bands (indices into the first axis,
+# None = all) and the tiles or strips intersecting crop ((x0, x1), (y0, y1)) are read and decoded.
+# The crop is cut at the image border, 2D images are returned as (1, h, w).
+def read_window(path, bands=None, crop=None):
+    return decode(*read_window_raw(path, bands, crop))
+
+
+## stored window and storage metadata of a TIFF, see read_window
+def read_window_raw(path, bands=None, crop=None):
+    with tifffile.TiffFile(path) as tif:
+        shaped = tif.shaped_metadata
+        return _read_window(tif, bands, crop), (shaped[0] if shaped else {}).get("storage")
+
+
+## shape of the image in a TIFF without reading it
+def image_shape(path):
+    with tifffile.TiffFile(path) as tif:
+        return tif.series[0].shape
+
+
+def _read_window(tif, bands, crop):
+    series = tif.series[0]
+    height, width = series.shape[-2:]
+    (x0, x1), (y0, y1) = ((0, width), (0, height)) if crop is None else crop
+    x0, x1, y0, y1 = max(x0, 0), min(x1, width), max(y0, 0), min(y1, height)
+    bands = range(int(np.prod(series.shape[:-2]))) if bands is None else bands
+    out = np.zeros((len(bands), max(y1 - y0, 0), max(x1 - x0, 0)), dtype=series.dtype)
+    if out.size == 0:
+        return out
+
+    # the pages of the bands only as frames (offsets and byte counts), their layout is the one of the first page
+    tif.pages.useframes = True
+    keyframe = tif.pages.first
+    chunk_h, chunk_w = keyframe.chunks[-2:]
+    n_x = keyframe.chunked[-1]
+    for plane, band in zip(out, bands):
+        page = tif.pages[band]
+        indices = [iy * n_x + ix for iy in range(y0 // chunk_h, (y1 - 1) // chunk_h + 1)
+                   for ix in range(x0 // chunk_w, (x1 - 1) // chunk_w + 1)]
+        segments = tif.filehandle.read_segments([page.dataoffsets[i] for i in indices],
+                                                [page.databytecounts[i] for i in indices], indices)
+        for data, index in segments:
+            segment, (_, _, sy, sx, _), _ = keyframe.decode(data, index)
+            segment = segment[0, :, :, 0]
+            # intersection of the segment (padded for edge tiles) and the window
+            ty0, ty1 = max(sy, y0), min(sy + segment.shape[0], y1)
+            tx0, tx1 = max(sx, x0), min(sx + segment.shape[1], x1)
+            plane[ty0 - y0:ty1 - y0, tx0 - x0:tx1 - x0] = segment[ty0 - sy:ty1 - sy, tx0 - sx:tx1 - sx]
+    return out
+
+
+## convert one TIFF to dtype (and to the tile layout of tile_size) and verify the round trip before replacing it
+# returns (path, bytes before, bytes after, max. error, status)
+def migrate_file(path, dtype, compression=None):
+    size_before = os.path.getsize(path)
+    stored, description = read_tiff_full(path)
+    meta = description.get("storage")
+    if meta is not None and meta["dtype"] == dtype and compression is None and _has_tile_layout(path):
+        return path, size_before, size_before, 0.0, "skipped"
+    original = decode(stored, meta) if meta is not None else stored
+    converted, new_meta = encode(original, dtype)
+    error = np.abs(decode(converted, new_meta) - original)
+    if not np.all(error <= error_bound(original, new_meta)):
+        return path, size_before, size_before, float(np.max(error)), "failed"
+    write_tiff(path, converted, new_meta, description, compression)
+    return path, size_before, os.path.getsize(path), float(np.max(error)), "converted"
+
+
+# True if the file is tiled exactly when tile_size asks for tiles
+def _has_tile_layout(path):
+    with tifffile.TiffFile(path) as tif:
+        return tif.pages[0].is_tiled == (tile_size is not None)
+
+
+def _set_tile_size(size):
+    global tile_size
+    tile_size = size
+
+
+## convert all Thorlabs and Cubert TIFFs below the folders in parallel
+def migrate(folders, dtype_tl=None, dtype_cb=None, workers=None, compression=None):
+    jobs = []
+    for folder in folders:
+        for root, _, files in os.walk(folder):
+            for f in sorted(files):
+                if f.endswith("_thorlabs.tif") and dtype_tl is not None:
+                    jobs.append((os.path.join(root, f), dtype_tl, compression))
+                elif f.endswith("_cubert.tif") and dtype_cb is not None:
+                    jobs.append((os.path.join(root, f), dtype_cb, compression))
+    print(f"Migrating {len(jobs)} files...")
+    if len(jobs) == 0:
+        return []
+
+    t_start = time.perf_counter()
+    before = after = 0
+    failed = []
+    # the worker processes write with the tile_size of this one (also where they are spawned, not forked)
+    with ProcessPoolExecutor(n_workers if workers is None else workers, initializer=_set_tile_size, initargs=(tile_size,)) as pool:
+        for path, size_before, size_after, error, status in pool.map(migrate_file, *zip(*jobs)):
+            before += size_before
+            after += size_after
+            if status == "failed":
+                failed.append(path)
+                print(f"{path}: round-trip error {error:g} above the bound, left unchanged.")
+    print(f"Done in {time.perf_counter() - t_start:.1f} s: {before / 2**20:.1f} MB -> {after / 2**20:.1f} MB, {len(failed)} files failed.")
+    return failed
+
+
+## sample images for the codec benchmark: the given files, or frames of the simulated cameras
+def benchmark_samples(tl_paths=(), cb_paths=()):
+    samples = [("tl", os.path.basename(p), read_thorlabs(p, cache=False)) for p in tl_paths]
+    samples += [("cb", os.path.basename(p), read_tiff(p)) for p in cb_paths]
+    if len(samples) == 0:
+        import backends
+        backends.sim_latency = 0
+        samples.append(("tl", "simulated", _kernel.process(backends.SimulatedThorlabsCamera().snap())))
+        cube = backends.SimulatedAcquisitionContext()._cube()
+        samples.append(("cb", "simulated", np.ascontiguousarray(cube.transpose(2, 0, 1), dtype=np.float32)))
+    return samples
+
+
+## compression ratio, encode and decode throughput (MB/s of float32 image data) of every codec and dtype
+def benchmark(samples, repeat=3, storage_dtypes=dtypes):
+    results = []
+    for camera, name, image in samples:
+        size = image.astype(np.float32, copy=False).nbytes
+        for dtype in storage_dtypes:
+            for compression in compressions:
+                for predictor in ((None,) if compression is None else (None, "auto")):
+                    t_start = time.perf_counter()
+                    for _ in range(repeat):
+                        data = tiff_bytes(image, dtype, compression=compression, predictor=predictor).getvalue()
+                    t_encode = (time.perf_counter() - t_start) / repeat
+                    t_start = time.perf_counter()
+                    for _ in range(repeat):
+                        decode(*read_tiff_raw(io.BytesIO(data)))
+                    t_decode = (time.perf_counter() - t_start) / repeat
+                    results.append({"camera": camera, "image": name, "dtype": dtype, "compression": compression or "none",
+                                    "predictor": predictor or "none", "ratio": size / len(data),
+                                    "encode_mb_s": size / t_encode / 2**20, "decode_mb_s": size / t_decode / 2**20})
+    return results
+
+
+def print_benchmark(results):
+    print(f"{'camera':<8}{'image':<20}{'dtype':<9}{'codec':<9}{'predictor':<11}{'ratio':>7}{'enc MB/s':>10}{'dec MB/s':>10}")
+    for r in results:
+        print(f"{r['camera']:<8}{r['image'][:19]:<20}{r['dtype']:<9}{r['compression']:<9}{r['predictor']:<11}"
+              f"{r['ratio']:>7.2f}{r['encode_mb_s']:>10.0f}{r['decode_mb_s']:>10.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="On-disk dtypes of the dataset TIFFs.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="convert existing *_thorlabs.tif / *_cubert.tif files in place")
+    migrate_parser.add_argument("folders", nargs="+")
+    migrate_parser.add_argument("--tl", choices=dtypes, default=None, help="dtype of the Thorlabs images (default: unchanged)")
+    migrate_parser.add_argument("--cb", choices=dtypes, default=None, help="dtype of the Cubert images (default: unchanged)")
+    migrate_parser.add_argument("--workers", type=int, default=n_workers)
+    migrate_parser.add_argument("--compression", choices=compressions[1:], default=None, help="codec of the converted files (default: uncompressed)")
+    migrate_parser.add_argument("--tile-size", type=int, default=tile_size, help="write the converted files in tiles of this size (default: strips)")
+    benchmark_parser = subparsers.add_parser("benchmark", help="compare the codecs on sample TL frames and Cubert cubes")
+    benchmark_parser.add_argument("--tl", nargs="*", default=[], help="Thorlabs TIFFs to use (default: simulated frames)")
+    benchmark_parser.add_argument("--cb", nargs="*", default=[], help="Cubert TIFFs to use (default: simulated cubes)")
+    benchmark_parser.add_argument("--dtype", choices=dtypes, nargs="*", default=list(dtypes))
+    benchmark_parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.command == "migrate":
+        tile_size = args.tile_size
+        failed = migrate(args.folders, args.tl, args.cb, args.workers, args.compression)
+        raise SystemExit(1 if failed else 0)
+    if args.command == "benchmark":
+        print_benchmark(benchmark(benchmark_samples(args.tl, args.cb), args.repeat, args.dtype))
@@ -1,9 +1,9 @@
 import matplotlib.pyplot as plt
 import numpy as np
-import tifffile
 import os
 import scipy
 import polanalyser as pa
+import storage  # run from the repository root: python -m testing.dfa_crosscorr
 
 def main():
     # images
@@ -11,12 +11,14 @@ def main():
     names = ['M','B','C','G','Y','R']
     names_pol = ['0', '45', '90', '135']
 
-    M = tifffile.imread(os.path.join(img_folder, 'M.tif'))
-    B = tifffile.imread(os.path.join(img_folder, 'B.tif'))
-    C = tifffile.imread(os.path.join(img_folder, 'C.tif'))
-    G = tifffile.imread(os.path.join(img_folder, 'G.tif'))
-    Y = tifffile.imread(os.path.join(img_folder, 'Y.tif'))
-    R = tifffile.imread(os.path.join(img_folder, 'R.tif'))
+    # only the dfa window plus a 2 px border for the demosaicing is read (starting on the mosaic)
+    window = ((1000 - 2, 1500 + 2), (700 - 2, 1200 + 2))
+    M = storage.read_window_raw(os.path.join(img_folder, 'M.tif'), crop=window)[0][0]
+    B = storage.read_window_raw(os.path.join(img_folder, 'B.tif'), crop=window)[0][0]
+    C = storage.read_window_raw(os.path.join(img_folder, 'C.tif'), crop=window)[0][0]
+    G = storage.read_window_raw(os.path.join(img_folder, 'G.tif'), crop=window)[0][0]
+    Y = storage.read_window_raw(os.path.join(img_folder, 'Y.tif'), crop=window)[0][0]
+    R = storage.read_window_raw(os.path.join(img_folder, 'R.tif'), crop=window)[0][0]
 
 
     imgs = np.array([M, B, C, G, Y, R])
@@ -27,8 +29,8 @@ def main():
     imgs = np.array([pa.demosaicing(img, code=pa.COLOR_PolarMono) for img in imgs])
 
     # cropping to dfa size
-    imgs = imgs[:, :, 700:1200, 1000:1500]
-    imgs_raw = imgs_raw[:, 700:1200, 1000:1500]
+    imgs = imgs[:, :, 2:-2, 2:-2]
+    imgs_raw = imgs_raw[:, 2:-2, 2:-2]
     print(imgs.shape)
 
     def plot_closeup(color, pol):
@@ -1,23 +1,40 @@
-import pylablib as pll
-
-from pylablib.devices import Thorlabs as tl
 import numpy as np
 import matplotlib.pyplot as plt
 
-def do_dark_calibration(exp_time = 10, n_frames = 25, roi_tl = (0, 2448, 0, 2048)):
+import backends
+import frame_averaging
+import thorlabs_stream
+
+## n_frames frames of one sequence acquisition, read one at a time (snap() would start and stop the
+# acquisition for every frame, grab() holds all of them), only the camera's ring buffer is allocated
+def dark_frames(cam, n_frames):
+    cam.setup_acquisition(nframes=thorlabs_stream.n_buffer_frames)
+    cam.start_acquisition()
+    try:
+        taken = 0
+        while taken < n_frames:
+            cam.wait_for_frame(since="lastread", nframes=1, timeout=thorlabs_stream.frame_timeout + cam.get_exposure())
+            for frame in cam.read_multiple_images()[:n_frames - taken]:
+                taken += 1
+                yield frame
+    finally:
+        cam.stop_acquisition()
+
+def do_dark_calibration(exp_time = 10, n_frames = 25, roi_tl = (0, 2448, 0, 2048), backend = "hardware"):
     print("REMEMBER TO PUT THE CAP ON.")
 
     # connecting cam
-    tl.list_cameras_tlcam()
-    cam = tl.ThorlabsTLCamera()
+    cam = backends.open_thorlabs(backend)
+    if backend == "simulated":
+        cam.lens_cap = True
 
     # doing exposures
     cam.set_exposure(exp_time*1e-3)
     cam.set_roi(*roi_tl, hbin=1, vbin=1)
-    frames = cam.grab(nframes=n_frames)
-
-    # averaging
-    avg = np.average(frames, axis = 0)
+    # averaged frame by frame into a running mean
+    frames = dark_frames(cam, n_frames)
+    avg = frame_averaging.average_frames(lambda: next(frames), n_frames).mean
+    frames.close()
     print("Shape of Master Dark:", avg.shape)
     print("Max of Master Dark:", np.max(avg))
     print("Min of Master Dark:", np.min(avg))
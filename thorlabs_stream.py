@@ -0,0 +1,146 @@
+import threading
+import time
+
+import numpy as np
+
+## Parameters
+n_buffer_frames = 16  # frames kept in the ring buffer (~10 MB each at full resolution)
+frame_timeout = 5     # in s, additional time to wait for a frame on top of the exposure time
+
+
+## continuous Thorlabs acquisition into a preallocated ring buffer
+# A reader thread moves every frame pylablib acquires into a fixed set of numpy buffers, slot = frame index
+# modulo the buffer size. Gaps in the frame indices are counted as dropped frames. The stream has the same
+# snap()/close() interface as the camera, so it can be used in place of the camera handle. Everything else
+# (set_exposure, get_exposure, ...) is passed through to the camera.
+class ThorlabsStream:
+    def __init__(self, cam, n_frames=None):
+        self.cam = cam
+        self.n_frames = n_buffer_frames if n_frames is None else n_frames
+        self.lock = threading.Condition()
+        self.reader = None
+        self.running = False
+        self.error = None
+        self._allocate()
+
+    def _allocate(self):
+        height, width = self.cam.get_data_dimensions()
+        self.buffer = np.zeros((self.n_frames, height, width), dtype=np.uint16)
+        self.indices = np.full(self.n_frames, -1, dtype=np.int64)
+        self.latest = -1
+        self.dropped = 0
+
+    def start(self):
+        self.cam.setup_acquisition(nframes=self.n_frames)
+        self.cam.start_acquisition()
+        self.running = True
+        self.error = None
+        self.reader = threading.Thread(target=self._read_loop, name="tl-stream", daemon=True)
+        self.reader.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.reader is not None:
+            self.reader.join()
+            self.reader = None
+        self.cam.stop_acquisition()
+
+    def close(self):
+        try:
+            self.stop()
+        finally:
+            self.cam.close()
+
+    # the ring buffer has to be reallocated if the frame size changes
+    def set_roi(self, *args, **kwargs):
+        running = self.running
+        if running:
+            self.stop()
+        result = self.cam.set_roi(*args, **kwargs)
+        self._allocate()
+        if running:
+            self.start()
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.cam, name)
+
+    def _read_loop(self):
+        while self.running:
+            try:
+                self.cam.wait_for_frame(since="lastread", nframes=1, timeout=0.5)
+            except Exception:
+                # timeout, check if we should still run
+                if not self.cam.acquisition_in_progress():
+                    self._fail(RuntimeError("TL: Acquisition stopped unexpectedly."))
+                    return
+                continue
+            try:
+                frames, infos = self.cam.read_multiple_images(return_info=True)
+            except Exception as e:
+                self._fail(e)
+                return
+            with self.lock:
+                for frame, info in zip(frames, infos):
+                    self._store(frame, info.frame_index)
+                self.lock.notify_all()
+
+    def _store(self, frame, index):
+        if self.latest >= 0 and index != self.latest + 1:
+            missed = index - self.latest - 1
+            self.dropped += missed
+            print(f"TL: Stream dropped {missed} frame(s) before frame {index} ({self.dropped} in total).")
+        slot = index % self.n_frames
+        self.buffer[slot] = frame
+        self.indices[slot] = index
+        self.latest = index
+
+    def _fail(self, error):
+        with self.lock:
+            self.error = error
+            self.running = False
+            self.lock.notify_all()
+
+    # block until the frame with the given index was received
+    def wait_for_index(self, index, timeout=None):
+        if timeout is None:
+            timeout = frame_timeout + self.cam.get_exposure() * (index - self.latest + 1)
+        deadline = time.monotonic() + timeout
+        with self.lock:
+            while self.latest < index:
+                if self.error is not None:
+                    raise self.error
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"TL: Frame {index} did not arrive within {timeout:.1f} s.")
+                self.lock.wait(remaining)
+
+    # copy n consecutive frames starting at first_index, raises if one of them was dropped or overwritten
+    def get_frames(self, first_index, n, out=None):
+        self.wait_for_index(first_index + n - 1)
+        if out is None:
+            out = np.empty((n, *self.buffer.shape[1:]), dtype=self.buffer.dtype)
+        with self.lock:
+            for i in range(n):
+                slot = (first_index + i) % self.n_frames
+                if self.indices[slot] != first_index + i:
+                    raise IndexError(f"TL: Frame {first_index + i} is not in the ring buffer (dropped or overwritten).")
+                out[i] = self.buffer[slot]
+        return out
+
+    # grab the next n back-to-back frames. skip frames are discarded first, by default the one
+    # that is already being exposed, so every returned frame started exposing after this call.
+    def get_burst(self, n, skip=1, out=None):
+        if n > self.n_frames:
+            raise ValueError(f"TL: Burst of {n} frames does not fit into the ring buffer ({self.n_frames} frames).")
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            first_index = self.latest + 1 + skip
+        return self.get_frames(first_index, n, out=out), first_index
+
+    # drop-in replacement for cam.snap()
+    def snap(self):
+        frames, _ = self.get_burst(1)
+        return frames[0]